@@ -1,34 +1,83 @@
-import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
+import pandas as pd
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
-import microdf as mdf
 import os
+import copy
+import importlib.util
+import json
+import logging
+import threading
+import uuid
+from urllib.parse import urlencode
+from collections import namedtuple
+import flask
 from numerize import numerize
+import data
+import figures
+import reform
+
+# NOTE: modules only some requests need (bootstrap, chunked, compare,
+# download, kernels, profiling, subsample and years) are imported by the
+# functions using them, so a worker starts without importing them
+from cache import Cancelled, LatestRequests, ResultCache, checkpoint, current_is_stale
 from components import make_html_label, set_options
 
 # ---------------------------------------------------------------------------- #
 #                       SECTION import pre-processed data                      #
 # ---------------------------------------------------------------------------- #
-# Import data from Ipums
-person = pd.read_csv("person.csv.gz")
-spmu = pd.read_csv("spmu.csv.gz")
-# import baseline poverty gap, gini by state & us
-all_state_stats = pd.read_csv("all_state_stats.csv.gz", index_col=0)
-# import baseline white/black/child etc. poverty rates & population
-demog_stats = pd.read_csv("demog_stats.csv.gz")
+# NOTE: the person and spmu microdata are read lazily by data.microdata(), see
+# wsgi.py for how they are loaded once before gunicorn forks its workers, and
+# each request reads the data that was current when it started, see
+# pin_data() and use_dataset().
+
+# number of scenarios whose outputs are kept in memory by each worker
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))
+# megabytes of intermediate arrays kept by each worker, see simulate()
+STAGE_POOL_MB = int(os.environ.get("STAGE_POOL_MB", 256))
+# number of simulations, which keep a column per unit, kept by each worker
+SIMULATION_CACHE_SIZE = int(os.environ.get("SIMULATION_CACHE_SIZE", 16))
+
+# rows of each chunk of a download, and downloads streamed at once by each
+# worker, see download.py
+DOWNLOAD_CHUNK_ROWS = int(os.environ.get("DOWNLOAD_CHUNK_ROWS", 16))
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 2))
+
+# formats of the download, Parquet needs pyarrow, see download.formats(),
+# which is looked up without importing it
+DOWNLOAD_FORMATS = ["csv"]
+if importlib.util.find_spec("pyarrow") is not None:
+    DOWNLOAD_FORMATS.append("parquet")
+
+# default groups of the poverty breakdown chart, see figures.BREAKDOWN_LABELS
+DEMOGS = ["child", "adult", "pwd", "white", "black", "hispanic"]
+
 
-# Colors
-BLUE = "#1976D2"
+# requested scenarios, see SCENARIO_LOG in wsgi.py
+scenario_log = logging.getLogger("scenarios")
 
 # create a list of all states, including "US" as a state
-states_no_us = person.state.unique().tolist()
-states_no_us.sort()
-states = ["US"] + states_no_us
+states = data.state_names()
+state_options = [{"label": x, "value": x} for x in states]
+
+
+def survey_year_options():
+    """returns the options of the year dropdown: pooled survey years, each
+    year on its own if its baseline statistics have been generated, and all
+    years side by side"""
+    options = [{"label": "All years", "value": "all"}]
+    if data.years():
+        options += [{"label": str(year), "value": year} for year in data.years()]
+        if not data.CHUNKED_DATA_DIR:
+            options += [{"label": "Compare years", "value": "by_year"}]
+    return options
+
+
+year_options = survey_year_options()
 
 # ---------------------------------------------------------------------------- #
 #                            SECTION dash components                           #
@@ -49,9 +98,9 @@ cards = dbc.CardDeck(
                             id="state-dropdown",
                             multi=False,
                             value="US",
-                            # create a list of dicts of states and their labels
-                            # to be selected by user in dropdown
-                            options=[{"label": x, "value": x} for x in states],
+                            # list of dicts of states and their labels to be
+                            # selected by user in dropdown
+                            options=state_options,
                         ),
                         html.Br(),
                         make_html_label("Reform level:"),
@@ -64,6 +113,15 @@ cards = dbc.CardDeck(
                             labelStyle={"display": "block"},
                             inputStyle={"margin-right": "5px"},
                         ),
+                        html.Br(),
+                        make_html_label("Survey year:"),
+                        dcc.Dropdown(
+                            id="year-dropdown",
+                            multi=False,
+                            value="all",
+                            clearable=False,
+                            options=year_options,
+                        ),
                     ]
                 ),
             ],
@@ -82,7 +140,7 @@ cards = dbc.CardDeck(
                                 {
                                     "Non-citizens": "non_citizens",
                                     "Children": "children",
-                                    "Adult": "adults",
+                                    "Adults": "adults",
                                 }
                             ),
                             # specify checked items
@@ -203,6 +261,12 @@ cards = dbc.CardDeck(
                             },
                         ),
                         html.Div(id="slider-output-container"),
+                        # slider value passed on to the ubi callback, updated
+                        # at a capped rate while dragging (assets/clientside.js)
+                        dcc.Store(id="agi-rate", data=0),
+                        # True while the slider is dragged, for previews of the
+                        # results, see subsample.py
+                        dcc.Store(id="agi-preview", data=False),
                     ]
                 ),
                 html.Br(),
@@ -218,14 +282,14 @@ charts = dbc.CardDeck(
         dbc.Card(
             dcc.Graph(
                 id="econ-graph",
-                figure={},
+                figure=figures.ECON_FIGURE,
                 config={"displayModeBar": False},
             ),
         ),
         dbc.Card(
             dcc.Graph(
                 id="breakdown-graph",
-                figure={},
+                figure=figures.BREAKDOWN_FIGURE,
                 config={"displayModeBar": False},
             ),
             outline=True,
@@ -233,6 +297,78 @@ charts = dbc.CardDeck(
     ]
 )
 
+# intersections of demographics that can be added to the poverty breakdown:
+# any combination of at least two of an age, a race and having a disability
+INTERSECTION_OPTIONS = [
+    {
+        "label": figures.intersection_label(demogs),
+        "value": "+".join(demogs),
+    }
+    for race in [None, "white", "black", "hispanic"]
+    for age in [None, "child", "adult"]
+    for pwd in [None, "pwd"]
+    for demogs in [[demog for demog in [race, age, pwd] if demog]]
+    if len(demogs) >= 2
+]
+
+# average change in resources and winners by baseline income decile
+decile_chart = dbc.Card(
+    dcc.Graph(
+        id="decile-graph",
+        figure=figures.DECILE_FIGURE,
+        config={"displayModeBar": False},
+    ),
+)
+
+
+# the current reform side by side with a pinned one, see compare.py
+comparison = dbc.Card(
+    dbc.CardBody(
+        [
+            dbc.Button(
+                "Pin this reform to compare",
+                id="compare-pin",
+                color="primary",
+                outline=True,
+                size="sm",
+            ),
+            " ",
+            dbc.Button(
+                "Clear", id="compare-clear", color="secondary", outline=True, size="sm"
+            ),
+            # levers of the pinned reform, None until a reform is pinned
+            dcc.Store(id="compare-pinned", data=None),
+            html.Div(id="compare-description", style={"font-family": "Roboto"}),
+            html.Div(
+                [
+                    dbc.CardDeck(
+                        [
+                            dbc.Card(
+                                dcc.Graph(
+                                    id="compare-econ-graph",
+                                    figure=figures.COMPARE_ECON_FIGURE,
+                                    config={"displayModeBar": False},
+                                ),
+                            ),
+                            dbc.Card(
+                                dcc.Graph(
+                                    id="compare-breakdown-graph",
+                                    figure=figures.COMPARE_BREAKDOWN_FIGURE,
+                                    config={"displayModeBar": False},
+                                ),
+                            ),
+                        ]
+                    ),
+                    html.Div(id="compare-table", style={"font-family": "Roboto"}),
+                ],
+                id="compare-results",
+                style={"display": "none"},
+            ),
+        ]
+    ),
+    outline=False,
+)
+
 
 # ------------------------------- summary card ------------------------------- #
 # create the summary card that contains ubi amount, revenue, pct. better off
@@ -260,6 +396,8 @@ text = (
                     )
                     for x in SUMMARY_OUTPUTS
                 ]
+                # results by survey year, when comparing years
+                + [html.Div(id="year-table", style={"font-family": "Roboto"})]
             ),
         ],
         color="white",
@@ -289,8 +427,22 @@ app = dash.Dash(
 
 server = app.server  # the server object
 
-# Design the app
-app.layout = html.Div(
+
+@server.before_request
+def pin_data():
+    """reads the data that is current now until the request ends, so a
+    switch to a new release never changes the data under a request"""
+    data.pin()
+
+
+@server.teardown_request
+def unpin_data(exc):
+    data.unpin()
+
+
+# Design the app, served by serve_layout() with the outputs of the default
+# inputs embedded
+layout = html.Div(
     [
         # navbar (top)
         dbc.Navbar(
@@ -430,6 +582,111 @@ app.layout = html.Div(
                 ),
             ],
         ),
+        html.Br(),
+        dbc.Row(
+            [
+                dbc.Col(
+                    decile_chart,
+                    width={
+                        "size": 12,
+                    },
+                    md={"size": 10, "offset": 1},
+                ),
+            ],
+        ),
+        html.Br(),
+        dbc.Row(
+            [
+                dbc.Col(
+                    comparison,
+                    width={
+                        "size": 12,
+                    },
+                    md={"size": 10, "offset": 1},
+                ),
+            ],
+        ),
+        # extra groups of the poverty breakdown chart
+        dbc.Row(
+            [
+                dbc.Col(
+                    dcc.Dropdown(
+                        id="intersection-dropdown",
+                        options=INTERSECTION_OPTIONS,
+                        value=[],
+                        multi=True,
+                        placeholder="Add groups to the poverty breakdown, "
+                        "e.g. Black children",
+                        style={"font-family": "Roboto"},
+                    ),
+                    width={"size": 12},
+                    md={"size": 10, "offset": 1},
+                ),
+            ]
+        ),
+        # toggle bootstrap confidence intervals, see bootstrap.py
+        dbc.Row(
+            [
+                dbc.Col(
+                    dcc.Checklist(
+                        id="uncertainty-checklist",
+                        options=[
+                            dict(option, disabled=bool(data.CHUNKED_DATA_DIR))
+                            for option in set_options(
+                                {"Show 90% confidence intervals": "show"}
+                            )
+                        ],
+                        value=[],
+                        inputStyle={"margin-right": "5px"},
+                        style={"font-family": "Roboto"},
+                    ),
+                    width={"size": "auto"},
+                    md={"size": 10, "offset": 1},
+                ),
+            ]
+        ),
+        html.Br(),
+        # download the results of the current reform, see download.py
+        dbc.Row(
+            [
+                dbc.Col(
+                    [
+                        dbc.Button(
+                            "Download results",
+                            id="download-link",
+                            href="",
+                            external_link=True,
+                            color="primary",
+                            outline=True,
+                            size="sm",
+                        ),
+                        dcc.RadioItems(
+                            id="download-format",
+                            options=set_options(
+                                {
+                                    {"csv": "CSV", "parquet": "Parquet"}[fmt]: fmt
+                                    for fmt in DOWNLOAD_FORMATS
+                                }
+                            ),
+                            value="csv",
+                            labelStyle={"display": "inline-block"},
+                            inputStyle={"margin-left": "15px", "margin-right": "5px"},
+                            style={"display": "inline-block"},
+                        ),
+                        dcc.Checklist(
+                            id="download-options",
+                            options=set_options({"Include a row per state": "states"}),
+                            value=[],
+                            inputStyle={"margin-left": "15px", "margin-right": "5px"},
+                            style={"display": "inline-block"},
+                        ),
+                    ],
+                    width={"size": "auto"},
+                    md={"size": 10, "offset": 1},
+                    style={"font-family": "Roboto"},
+                ),
+            ]
+        ),
         # 6 line breaks at the end of the page to make it look nicer :)
         html.Br(),
         html.Br(),
@@ -530,192 +787,391 @@ app.layout = html.Div(
 # ---------------------------------------------------------------------------- #
 
 
-@app.callback(
-    Output(component_id="ubi-output", component_property="children"),
-    Output(component_id="revenue-output", component_property="children"),
-    Output(component_id="ubi-population-output", component_property="children"),
-    Output(component_id="winners-output", component_property="children"),
-    Output(component_id="resources-output", component_property="children"),
-    Output(component_id="econ-graph", component_property="figure"),
-    Output(component_id="breakdown-graph", component_property="figure"),
-    Input(component_id="state-dropdown", component_property="value"),
-    Input(component_id="level", component_property="value"),
-    Input(component_id="agi-slider", component_property="value"),
-    Input(component_id="benefits-checklist", component_property="value"),
-    Input(component_id="taxes-checklist", component_property="value"),
-    Input(component_id="include-checklist", component_property="value"),
+Scenario = namedtuple(
+    "Scenario",
+    [
+        "state_dropdown",
+        "level",
+        "agi_tax",
+        "benefits",
+        "taxes",
+        "include",
+        "uncertainty",
+        "year",
+        "intersections",
+        "preview",
+    ],
 )
-# TODO one function to translate args to params, another to run the function, another to return the output
-def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
-    """this does everything from microsimulation to figure creation.
-        Dash does something automatically where it takes the input arguments
-        in the order given in the @app.callback decorator
+
+
+def scenario_key(
+    state_dropdown,
+    level,
+    agi_tax,
+    benefits,
+    taxes,
+    include,
+    uncertainty=(),
+    year="all",
+    intersections=(),
+    preview=False,
+):
+    """returns the ubi() inputs as a hashable Scenario to cache results under
+
+    Inputs that cannot change the results are dropped, so equivalent
+    scenarios share a cache entry: a state-level reform ignores the benefits
+    checklist and every tax except income taxes.
+
+    uncertainty is the uncertainty checklist's value or, as in scenario_log
+    lines, already a bool.
+    """
+    if level == "state":
+        benefits = []
+        taxes = [tax for tax in taxes if tax == "fedtaxac"]
+    if not isinstance(uncertainty, bool):
+        uncertainty = "show" in uncertainty
+    return Scenario(
+        state_dropdown,
+        level,
+        agi_tax,
+        tuple(sorted(benefits)),
+        tuple(sorted(taxes)),
+        tuple(sorted(include)),
+        uncertainty,
+        year,
+        tuple(intersections),
+        preview,
+    )
+
+
+def funding(state_dropdown, level, agi_tax, benefits, taxes, include, year=None):
+    """returns the revenue of a reform and the UBI it funds
+
+    These are weighted totals of the funding population, looked up rather
+    than summed over units, so need no simulation.
+
     Args:
-        state_dropdown:  takes input from callback input, component_id="state-dropdown"
-        level:  component_id="level"
-        agi_tax:  component_id="agi-slider"
-        benefits:  component_id="benefits-checklist"
-        taxes:  component_id="taxes-checklist"
-        include: component_id="include-checklist"
+        year: a survey year, None if all years are pooled
+        other args: see compute_outputs()
 
     Returns:
-        ubi_line: outputs to  "ubi-output" in @app.callback
-        revenue_line: outputs to "revenue-output" in @app.callback
-        ubi_population_line: outputs to "revenue-output" in @app.callback
-        winners_line: outputs to "winners-output" in @app.callback
-        resources_line: outputs to "resources-output" in @app.callback
-        fig: outputs to "econ-graph" in @app.callback
-        fig2: outputs to "breakdown-graph" in @app.callback
+        dict of revenue, ubi_annual (per person), ubi_population and
+        state_ubi_population, the UBI population of the selected state
     """
+    # a federal reform is funded by the whole country, a state reform by the
+    # state selected in the dropdown
+    funding_state = "US" if level == "federal" else state_dropdown
+    funding_totals = data.weighted_total(funding_state, year)
+    spec = reform.from_inputs(level, agi_tax, benefits, taxes, include)
+    revenue = reform.revenue(funding_totals, spec)
+    ubi_population = reform.numper_ubi(funding_totals, include)
+    return {
+        "revenue": revenue,
+        "ubi_annual": revenue / ubi_population,
+        "ubi_population": ubi_population,
+        # population of the selected state recieving UBI
+        "state_ubi_population": reform.numper_ubi(
+            data.weighted_total(state_dropdown, year), include
+        ),
+    }
 
-    # -------------------- calculations based on reform level -------------------- #
-    # if the "Reform level" selected by the user is federal
-    if level == "federal":
-        # combine taxes and benefits checklists into one list to be used to
-        #  subset spmu dataframe
-        taxes_benefits = taxes + benefits
-        # initialize new resources column with old resources as baseline
-        spmu["new_resources"] = spmu.spmtotres
-        # initialize revenue at zero
-        revenue = 0
-
-        # Calculate the new revenue and spmu resources from tax and benefit change
-        for tax_benefit in taxes_benefits:
-            # subtract taxes and benefits that have been changed from spm unit's resources
-            spmu.new_resources -= spmu[tax_benefit]
-            # add that same value to revenue
-            revenue += mdf.weighted_sum(spmu, tax_benefit, "spmwt")
-
-        # if "Income taxes" = ? and "child_tax_credit" = ?
-        # in taxes/benefits checklist
-        if ("fedtaxac" in taxes_benefits) & ("ctc" in taxes_benefits):
-            spmu.new_resources += spmu.ctc
-            revenue -= mdf.weighted_sum(spmu, "ctc", "spmwt")
-
-        if ("fedtaxac" in taxes_benefits) & ("eitcred" in taxes_benefits):
-            spmu.new_resources += spmu.eitcred
-            revenue -= mdf.weighted_sum(spmu, "eitcred", "spmwt")
-
-        # Calculate the new taxes from flat tax on AGI
-        tax_rate = agi_tax / 100
-        spmu["new_taxes"] = np.maximum(spmu.adjginc, 0) * tax_rate
-        # subtract new taxes from new resources
-        spmu.new_resources -= spmu.new_taxes
-        # add new revenue when new taxes are applied on spmus, multiplied by weights
-        revenue += mdf.weighted_sum(spmu, "new_taxes", "spmwt")
-
-        # Calculate the total UBI a spmu recieves based on exclusions
-        spmu["numper_ubi"] = spmu.numper
-
-        # TODO make into linear equation on one line using array of some kind
-        if "children" not in include:
-            # subtract the number of children from the number of
-            # people in spm unit receiving ubi benefit
-            spmu["numper_ubi"] -= spmu.child
-
-        if "non_citizens" not in include:
-            spmu["numper_ubi"] -= spmu.non_citizen
-
-        if ("children" not in include) and ("non_citizens" not in include):
-            spmu["numper_ubi"] += spmu.non_citizen_child
-
-        if "adults" not in include:
-            spmu["numper_ubi"] -= spmu.adult
-
-        if ("adults" not in include) and ("non_citizens" not in include):
-            spmu["numper_ubi"] += spmu.non_citizen_adult
-
-        # Assign UBI
-        ubi_population = (spmu.numper_ubi * spmu.spmwt).sum()
-        ubi_annual = revenue / ubi_population
-        spmu["total_ubi"] = ubi_annual * spmu.numper_ubi
-
-        # Calculate change in resources
-        spmu.new_resources += spmu.total_ubi
-        spmu["new_resources_per_person"] = spmu.new_resources / spmu.numper
-        # Sort by state
-
-        # NOTE: the "target" here refers to the population being
-        # measured for gini/poverty rate/etc.
-        # I.e. the total population of the state/country and
-        # INCLUDING those excluding form recieving ubi payments
-
-        # state here refers to the selection from the drop down, not the reform level
-        if state_dropdown == "US":
-            target_spmu = spmu
-        else:
-            target_spmu = spmu[spmu.state == state_dropdown]
-
-    # if the "Reform level" dropdown selected by the user is State
-    if level == "state":
 
-        # Sort by state
-        if state_dropdown == "US":
-            target_spmu = spmu
-        else:
-            target_spmu = spmu[spmu.state == state_dropdown]
+def resource_change(
+    state_dropdown, level, agi_tax, benefits, taxes, include, year=None
+):
+    """returns the change a reform makes to the total resources of the
+    population measured, the selected state or the US
 
-        # Initialize
-        target_spmu["new_resources"] = target_spmu.spmtotres
-        revenue = 0
+    It is the UBI that population receives less the revenue raised from it,
+    both looked up from weighted totals like funding(), so it is the exact
+    total simulate() sums over units. A reform funded by the population it
+    measures, a state reform or a federal one for the US, is budget-neutral.
 
-        # Change income tax repeal to state level
-        if "fedtaxac" in taxes:
-            target_spmu.new_resources -= target_spmu.stataxac
-            revenue += mdf.weighted_sum(target_spmu, "stataxac", "spmwt")
+    Args:
+        year: a survey year, None if all years are pooled
+        other args: see compute_outputs()
+    """
+    if level == "state" or state_dropdown == "US":
+        return 0.0
+    totals = funding(state_dropdown, level, agi_tax, benefits, taxes, include, year)
+    spec = reform.from_inputs(level, agi_tax, benefits, taxes, include)
+    revenue = reform.revenue(data.weighted_total(state_dropdown, year), spec)
+    return totals["ubi_annual"] * totals["state_ubi_population"] - revenue
 
-        # Calculate change in tax revenue
-        tax_rate = agi_tax / 100
-        target_spmu["new_taxes"] = target_spmu.adjginc * tax_rate
 
-        target_spmu.new_resources -= target_spmu.new_taxes
-        revenue += mdf.weighted_sum(target_spmu, "new_taxes", "spmwt")
+# the stages of simulate() that are shared between reforms
+stage_pool = ResultCache(RESULT_CACHE_SIZE, maxbytes=STAGE_POOL_MB * 2**20)
 
-        # Calculate the total UBI a spmu recieves based on exclusions
-        target_spmu["numper_ubi"] = target_spmu.numper
 
-        if "children" not in include:
-            target_spmu["numper_ubi"] -= target_spmu.child
+def _call(stage, version, *args):
+    return stage(*args)
 
-        if "non_citizens" not in include:
-            target_spmu["numper_ubi"] -= target_spmu.non_citizen
 
-        if ("children" not in include) and ("non_citizens" not in include):
-            target_spmu["numper_ubi"] += target_spmu.non_citizen_child
+def pooled(stage, *args):
+    """returns stage(*args), kept in stage_pool for the next request"""
+    return stage_pool.get((stage, data.version()) + args, _call, current_is_stale())
 
-        if "adults" not in include:
-            target_spmu["numper_ubi"] -= target_spmu.adult
 
-        if ("adults" not in include) and ("non_citizens" not in include):
-            target_spmu["numper_ubi"] += target_spmu.non_citizen_adult
+def units(state_dropdown, level, year=None, preview=False):
+    """returns the units and people a reform is simulated on
 
-        # Assign UBI
-        ubi_population = (target_spmu.numper_ubi * target_spmu.spmwt).sum()
-        ubi_annual = revenue / ubi_population
-        target_spmu["total_ubi"] = ubi_annual * target_spmu.numper_ubi
+    The first stage of simulate(): it only depends on where and when a reform
+    is run, so is shared by every tax rate, repeal and include-checklist.
 
-        # Calculate change in resources
-        target_spmu.new_resources += target_spmu.total_ubi
-        target_spmu["new_resources_per_person"] = (
-            target_spmu.new_resources / target_spmu.numper
-        )
+    Args:
+        year: a survey year, None if all years are pooled
+        preview: True to run on the subsample of subsample.py
+        other args: see compute_outputs()
 
-    # NOTE: code after this applies to both reform levels
+    Returns:
+        dict of
+        funding_spmu: the units funding the UBI
+        target_rows: positions in funding_spmu of the units measured, or
+            None if they are all measured
+        target_spmu: the units measured, with the person_weight column
+        person_rows: position in target_spmu of each person measured
+        asecwt, demog_code: of each person measured
+    """
+    # work on a shallow copy so new columns are never added to the shared
+    # frame, which keeps it read-only across threads and forked workers
+    # a preview runs on a stratified subsample reweighted to the full data
+    source = data
+    if preview:
+        import subsample
+
+        source = subsample
+    if year is not None:
+        # the rows of one year are a slice of the shared tables
+        person, spmu = source.year_partition(year)
+        person = person.copy(deep=False)
+        spmu = spmu.copy(deep=False)
+        # scale the pooled weights back up to annual totals for the year
+        person["asecwt"] = person.asecwt * data.pooled_years()
+        spmu["spmwt"] = spmu.spmwt * data.pooled_years()
+    else:
+        person, spmu = source.microdata()
+        spmu = spmu.copy(deep=False)
+
+    # a federal reform is funded by the whole country, a state reform by the
+    # state selected in the dropdown
+    if level == "federal" or state_dropdown == "US":
+        funding_spmu = spmu
+    else:
+        funding_spmu = spmu[spmu.state == state_dropdown].copy(deep=False)
 
-    # Merge and create target_persons -
+    # the population measured, the state here refers to the selection from
+    # the drop down, not the reform level
+    if level == "state" or state_dropdown == "US":
+        target_rows = None
+        target_spmu = funding_spmu
+    else:
+        in_state = (funding_spmu.state == state_dropdown).to_numpy()
+        target_rows = np.flatnonzero(in_state)
+        # a copy of its own, which the columns below are added to
+        target_spmu = funding_spmu[in_state].copy(deep=False)
+
+    # Merge and create target persons -
     # NOTE: the "target" here refers to the population being
     # measured for gini/poverty rate/etc.
     # I.e. the total population of the state/country and
     # INCLUDING those excluding form recieving ubi payments
-    sub_spmu = target_spmu[
-        ["spmfamunit", "year", "new_resources", "new_resources_per_person"]
-    ]
-    target_persons = person.merge(sub_spmu, on=["spmfamunit", "year"])
+    # position in target_spmu of each row of the full spmu table, or -1,
+    # since person.unit is the row of a person's unit in the full table
+    sub_rows = np.full(len(data.microdata().spmu), -1)
+    sub_rows[target_spmu.index] = np.arange(len(target_spmu))
+    person_rows = sub_rows[person.unit.to_numpy()]
+    in_target = person_rows >= 0
+    person_rows = person_rows[in_target]
+    asecwt = person.asecwt.to_numpy()[in_target]
+    # sum of the weights of each unit's members, as passed in (so scaled for
+    # a single year or a preview)
+    target_spmu["person_weight"] = np.bincount(person_rows, asecwt, len(target_spmu))
+    return {
+        "funding_spmu": funding_spmu,
+        "target_rows": target_rows,
+        "target_spmu": target_spmu,
+        "person_rows": person_rows,
+        "asecwt": asecwt,
+        "demog_code": person.demog_code.to_numpy()[in_target],
+    }
+
+
+def after_repeals(state_dropdown, level, year, preview, benefits, taxes):
+    """returns the resources of each funding unit after the repeals, before
+    the flat tax on AGI and the UBI, see units() for the args"""
+    spec = reform.from_inputs(level, 0, benefits, taxes, ())
+    plan = reform.compile_plan(reform.repeal_terms(spec), base="spmtotres")
+    return reform.evaluate(
+        plan, pooled(units, state_dropdown, level, year, preview)["funding_spmu"]
+    )
 
-    # filter demog_stats for selected state from dropdown
-    baseline_demog = demog_stats[demog_stats.state == state_dropdown]
 
-    # TODO: return dictionary of results instead of return each variable
+def eligible(state_dropdown, level, year, preview, include):
+    """returns the number of people recieving UBI in each funding unit, see
+    units() for the args"""
+    funding_spmu = pooled(units, state_dropdown, level, year, preview)["funding_spmu"]
+    # looked up by row label, which is the position in the full spmu table
+    return data.eligible_counts()[data.include_code(include), funding_spmu.index]
+
+
+def simulate(
+    state_dropdown,
+    level,
+    agi_tax,
+    benefits,
+    taxes,
+    include,
+    year=None,
+    preview=False,
+):
+    """runs a reform on microdata held in memory
+
+    The stages that do not depend on agi_tax, units(), after_repeals() and
+    eligible(), are kept in stage_pool, so moving the tax rate slider only
+    reruns the flat tax and UBI and the reductions to totals.
+
+    Args:
+        year: a survey year, None if all years are pooled
+        preview: True to run on the subsample of subsample.py
+        other args: see compute_outputs()
+
+    Returns:
+        dict of the reform's totals, the same as chunked.simulate(), plus
+        "spmu", the units funding the UBI, and "target_spmu", with the
+        new_resources column
+    """
+    import kernels
+
+    totals = funding(state_dropdown, level, agi_tax, benefits, taxes, include, year)
+    ubi_annual = totals["ubi_annual"]
+    selection = (state_dropdown, level, year, preview)
+    stage = pooled(units, *selection)
+
+    # add this reform's columns to a shallow copy of the stage's units
+    funding_spmu = stage["funding_spmu"].copy(deep=False)
+    numper_ubi = pooled(eligible, *selection, tuple(include))
+    funding_spmu["numper_ubi"] = numper_ubi
+    funding_spmu["total_ubi"] = ubi_annual * funding_spmu.numper_ubi
+
+    # new resources after the flat tax on AGI and the UBI, in one pass over
+    # the units, see reform.py
+    spec = reform.from_inputs(level, agi_tax, benefits, taxes, include)
+    plan = reform.compile_plan(
+        reform.tax_terms(spec), base="after_repeals", scaled={"numper_ubi": 1}
+    )
+    funding_spmu["new_resources"] = reform.evaluate(
+        plan,
+        {
+            "after_repeals": pooled(
+                after_repeals, *selection, tuple(benefits), tuple(taxes)
+            ),
+            "adjginc": funding_spmu.adjginc,
+            "numper_ubi": numper_ubi,
+        },
+        scale=ubi_annual,
+    )
+
+    reform_columns = ["numper_ubi", "total_ubi", "new_resources"]
+    if stage["target_rows"] is None:
+        target_spmu = funding_spmu
+    else:
+        target_spmu = stage["target_spmu"].copy(deep=False)
+        for column in reform_columns:
+            target_spmu[column] = funding_spmu[column].to_numpy()[stage["target_rows"]]
+
+    # NOTE: code after this applies to both reform levels
+    checkpoint()
+
+    # DO NOT PREPROCESS, new_resources
+    # total resources, poverty gap, and change in resources per person and
+    # winners by baseline income decile, within the selected state or across
+    # the US, in one pass over the units, see kernels.py
+    new_resources = target_spmu.new_resources.to_numpy()
+    spmthresh = target_spmu.spmthresh.to_numpy()
+    spmtotres = target_spmu.spmtotres.to_numpy()
+    numper = target_spmu.numper.to_numpy()
+    decile_column = "decile_us" if state_dropdown == "US" else "decile_state"
+    unit_totals = kernels.unit_totals(
+        new_resources,
+        spmthresh,
+        spmtotres,
+        target_spmu.spmwt.to_numpy(),
+        numper,
+        target_spmu.person_weight.to_numpy(),
+        target_spmu[decile_column].to_numpy(),
+        data.N_DECILES,
+    )
+
+    # people in poverty and winners, and the population and people in
+    # poverty of each demographic code, which give the new poverty rate of
+    # any intersection of demographics, in one pass over the persons
+    asecwt = stage["asecwt"]
+    person_totals = kernels.person_totals(
+        new_resources,
+        numper,
+        spmthresh,
+        spmtotres,
+        stage["person_rows"],
+        asecwt,
+        stage["demog_code"],
+        data.N_DEMOG_CODES,
+    )
+
+    checkpoint()
+    # Calculate change in Gini
+    gini = kernels.gini(person_totals["resources_per_person"], asecwt)
+    decile_population = unit_totals["decile_population"]
+
+    return {
+        **totals,
+        "total_resources": unit_totals["total_resources"],
+        "poverty_gap": unit_totals["poverty_gap"],
+        "total_poor": person_totals["total_poor"],
+        "gini": gini,
+        "total_winners": person_totals["total_winners"],
+        "population_by_code": person_totals["population_by_code"],
+        "poor_by_code": person_totals["poor_by_code"],
+        "decile_change": unit_totals["decile_change"] / decile_population,
+        "decile_winners": unit_totals["decile_winners"] / decile_population * 100,
+        "spmu": funding_spmu,
+        "target_spmu": target_spmu,
+    }
+
+
+def _survey_year(key):
+    """returns the single survey year of a scenario, or None for all years"""
+    return key.year if key.year not in ["all", "by_year"] else None
+
+
+def baseline(state_dropdown, year=None):
+    """returns the precomputed baseline statistics of the selected state
+
+    Args:
+        state_dropdown: component_id="state-dropdown"
+        year: a survey year, None if all years are pooled
+
+    Returns:
+        dict of population, poverty_rate, total_resources, poverty_gap, gini
+        and demog_rates, the poverty rate of each demographic in demog_stats
+    """
+    # filter demog_stats and all_state_stats for selected state from dropdown
+    if year is None:
+        all_state_stats, demog_stats = data.baseline_stats()
+        baseline_demog = demog_stats[demog_stats.state == state_dropdown]
+        baseline_all_state_stats = all_state_stats[
+            all_state_stats.index == state_dropdown
+        ]
+    else:
+        year_demog_stats = data.year_stats().demog_stats
+        year_all_state_stats = data.year_stats().all_state_stats
+        baseline_demog = year_demog_stats[
+            (year_demog_stats.state == state_dropdown) & (year_demog_stats.year == year)
+        ]
+        baseline_all_state_stats = year_all_state_stats[
+            (year_all_state_stats.index == state_dropdown)
+            & (year_all_state_stats.year == year)
+        ]
+
     def return_demog(demog, metric):
         """
         retrieve pre-processed data by demographic
@@ -728,7 +1184,6 @@ def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
         returns:
             value - float
         """
-        # NOTE: baseline_demog is a dataframe with global scope
         value = baseline_demog.loc[
             (baseline_demog["demog"] == demog) & (baseline_demog["metric"] == metric),
             "value",
@@ -737,14 +1192,6 @@ def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
 
         return value
 
-    population = return_demog(demog="person", metric="pop")
-    child_population = return_demog(demog="child", metric="pop")
-    non_citizen_population = return_demog(demog="non_citizen", metric="pop")
-    non_citizen_child_population = return_demog(demog="non_citizen_child", metric="pop")
-
-    # filter all state stats gini, poverty_gap, etc. for dropdown state
-    baseline_all_state_stats = all_state_stats[all_state_stats.index == state_dropdown]
-
     def return_all_state(metric):
         """filter baseline_all_state_stats and return value of select metric
 
@@ -757,66 +1204,160 @@ def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
 
         return baseline_all_state_stats[metric].values[0]
 
-    # Calculate total change in resources
-    original_total_resources = return_all_state("total_resources")
-    # DO NOT PREPROCESS, new_resources
-    new_total_resources = (target_spmu.new_resources * target_spmu.spmwt).sum()
-    change_total_resources = new_total_resources - original_total_resources
-    change_pp = change_total_resources / population
+    return {
+        "population": return_demog(demog="person", metric="pop"),
+        "poverty_rate": return_demog("person", "pov_rate"),
+        "total_resources": return_all_state("total_resources"),
+        "poverty_gap": return_all_state("poverty_gap"),
+        # define orignal gini coefficient
+        "gini": return_all_state("gini"),
+        "demog_rates": {demog: return_demog(demog, "pov_rate") for demog in DEMOGS},
+    }
+
+
+# ---------------------------------------------------------------------------- #
+# The outputs are computed in stages, each cached on its own by cached_stage(),
+# so every output callback computes only what it needs and shares the rest:
+#     compute_funding: the UBI amount, from weighted totals alone
+#     compute_simulation: the reform simulated over every unit
+#     compute_outcomes: the changes from the baseline, overall and by group
+#     compute_intervals: bootstrap or preview error bounds
+#     compute_year_table: the results of each survey year
+# ---------------------------------------------------------------------------- #
+
+
+def compute_funding(key):
+    """returns funding() of a scenario, see scenario_key()"""
+    if data.CHUNKED_DATA_DIR:
+        # the chunked engine sums the totals over the units it streams
+        results = cached_stage(compute_simulation, key)
+        return {
+            name: results[name]
+            for name in ["revenue", "ubi_annual", "ubi_population"]
+            + ["state_ubi_population"]
+        }
+    return funding(
+        key.state_dropdown,
+        key.level,
+        key.agi_tax,
+        key.benefits,
+        key.taxes,
+        key.include,
+        _survey_year(key),
+    )
+
+
+def compute_simulation(key):
+    """returns the totals of the reform of a scenario, see simulate()
+
+    For a preview, the totals are estimated from the subsample as changes
+    from the exact baseline, see subsample.py.
+    """
+    year = _survey_year(key)
+    args = (key.state_dropdown, key.level, key.agi_tax, key.benefits, key.taxes)
+    if data.CHUNKED_DATA_DIR:
+        import chunked
+
+        # stream the microdata from disk, see chunked.py
+        return chunked.simulate(*args, key.include, year)
+
+    results = simulate(*args, key.include, year, key.preview)
+
+    if key.preview:
+        import subsample
+
+        # the subsample estimates the changes far more precisely than the
+        # levels, so its changes are added to the exact baseline
+        original = baseline(key.state_dropdown, year)
+        # the share of people better off is the subsample's winners over its
+        # own population, the ratio subsample.intervals() gives bounds of
+        sample_population = results["population_by_code"].sum()
+        results = subsample.difference_estimates(
+            results,
+            key.state_dropdown,
+            year,
+            {
+                "total_poor": original["poverty_rate"] * original["population"],
+                "poverty_gap": original["poverty_gap"],
+                "gini": original["gini"],
+            },
+        )
+        # the taxes paid by the subsample are too noisy for the change in
+        # resources, which is exact from the weighted totals instead
+        results["total_resources"] = original["total_resources"] + resource_change(
+            *args, key.include, year
+        )
+        results["total_winners"] *= original["population"] / sample_population
+    return results
 
-    original_poverty_rate = return_demog("person", "pov_rate")
 
-    original_poverty_gap = return_all_state("poverty_gap")
-    # define orignal gini coefficient
-    original_gini = return_all_state("gini")
+def compute_outcomes(key):
+    """returns the changes a scenario makes to the baseline statistics
+
+    Returns:
+        dict of the numbers and hover strings of the summary and the charts
+    """
+    results = cached_stage(compute_simulation, key)
+    checkpoint()
+    original = baseline(key.state_dropdown, _survey_year(key))
+    population = original["population"]
+    original_poverty_rate = original["poverty_rate"]
+    original_poverty_gap = original["poverty_gap"]
+    original_gini = original["gini"]
+
+    # Calculate total change in resources
+    change_total_resources = results["total_resources"] - original["total_resources"]
+    change_pp = change_total_resources / population
 
     # function to calculate rel difference between one number and another
     def rel_change(new, old, round=3):
         return ((new - old) / old).round(round)
 
-    # Calculate poverty gap
-    target_spmu["new_poverty_gap"] = np.where(
-        target_spmu.new_resources < target_spmu.spmthresh,
-        target_spmu.spmthresh - target_spmu.new_resources,
-        0,
-    )
-    poverty_gap = mdf.weighted_sum(target_spmu, "new_poverty_gap", "spmwt")
+    poverty_gap = results["poverty_gap"]
     poverty_gap_change = rel_change(poverty_gap, original_poverty_gap)
 
-    # Calculate the change in poverty rate
-    target_persons["poor"] = target_persons.new_resources < target_persons.spmthresh
-    total_poor = (target_persons.poor * target_persons.asecwt).sum()
-    poverty_rate = total_poor / population
+    poverty_rate = results["total_poor"] / population
     poverty_rate_change = rel_change(poverty_rate, original_poverty_rate)
 
-    # Calculate change in Gini
-    gini = mdf.gini(target_persons, "new_resources_per_person", "asecwt")
+    gini = results["gini"]
     gini_change = rel_change(gini, original_gini, 3)
 
-    # Calculate percent winners
-    target_persons["winner"] = target_persons.new_resources > target_persons.spmtotres
-    total_winners = (target_persons.winner * target_persons.asecwt).sum()
-    percent_winners = (total_winners / population * 100).round(1)
+    percent_winners = (results["total_winners"] / population * 100).round(1)
 
     # -------------- calculate all of the poverty breakdown numbers -------------- #
-    # Calculate the new poverty rate for each demographic
-    def pv_rate(column):
-        return mdf.weighted_mean(
-            target_persons[target_persons[column]], "poor", "asecwt"
-        )
-
     # Round all numbers for display in hover
     def hover_string(metric, round_by=1):
         """formats 0.121 to 12.1%"""
         string = str(round(metric * 100, round_by)) + "%"
         return string
 
-    DEMOGS = ["child", "adult", "pwd", "white", "black", "hispanic"]
+    # the user's intersections of demographics follow the default groups
+    breakdown_groups = DEMOGS + list(key.intersections)
+
+    def original_rate(group):
+        """returns the precomputed baseline poverty rate of group"""
+        if group in DEMOGS:
+            return original["demog_rates"][group]
+        population_by_code, poor_by_code = data.baseline_by_code(
+            key.state_dropdown, _survey_year(key)
+        )
+        demogs = group.split("+")
+        return data.intersection_total(poor_by_code, demogs) / data.intersection_total(
+            population_by_code, demogs
+        )
+
+    def new_rate(group):
+        """returns the poverty rate of group after the reform"""
+        demogs = group.split("+")
+        return data.intersection_total(
+            results["poor_by_code"], demogs
+        ) / data.intersection_total(results["population_by_code"], demogs)
+
     # create dictionary for demographic breakdown of poverty rates
     pov_breakdowns = {
         # return precomputed baseline poverty rates
-        "original_rates": {demog: return_demog(demog, "pov_rate") for demog in DEMOGS},
-        "new_rates": {demog: pv_rate(demog) for demog in DEMOGS},
+        "original_rates": {group: original_rate(group) for group in breakdown_groups},
+        "new_rates": {group: new_rate(group) for group in breakdown_groups},
     }
 
     # add poverty rate changes to dictionary
@@ -826,21 +1367,28 @@ def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
             pov_breakdowns["new_rates"][demog],
             pov_breakdowns["original_rates"][demog],
         )
-        for demog in DEMOGS
+        for demog in breakdown_groups
     }
 
+    # name of each group in the hover template and x-axis
+    group_names = dict(zip(DEMOGS, DEMOGS))
+    group_labels = dict(zip(DEMOGS, figures.BREAKDOWN_LABELS))
+    for group in key.intersections:
+        group_labels[group] = figures.intersection_label(group.split("+"))
+        group_names[group] = group_labels[group]
+
     # create string for hover template
     pov_breakdowns["strings"] = {
         demog: "Original "
-        + demog
+        + group_names[demog]
         + " poverty rate: "
         + hover_string(pov_breakdowns["original_rates"][demog])
         + "<br><extra></extra>"
         + "New "
-        + demog
+        + group_names[demog]
         + " poverty rate: "
         + hover_string(pov_breakdowns["new_rates"][demog])
-        for demog in DEMOGS
+        for demog in breakdown_groups
     }
 
     # format original and new overall poverty rate
@@ -854,6 +1402,170 @@ def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
     original_gini_string = str(round(original_gini, 3))
     gini_string = str(round(gini, 3))
 
+    econ_hovertemplate = [
+        # poverty rates
+        "Original poverty rate: " + original_poverty_rate_string + "<br><extra></extra>"
+        "New poverty rate: " + poverty_rate_string,
+        # poverty gap
+        "Original poverty gap: $"
+        + original_poverty_gap_billions
+        + "B<br><extra></extra>"
+        "New poverty gap: $" + poverty_gap_billions + "B",
+        # gini
+        "Original Gini index: <extra></extra>"
+        + original_gini_string
+        + "<br>New Gini index: "
+        + gini_string,
+    ]
+
+    return {
+        "original": original,
+        "change_pp": change_pp,
+        "poverty_rate_change": poverty_rate_change,
+        "poverty_gap_change": poverty_gap_change,
+        "gini_change": gini_change,
+        "percent_winners": percent_winners,
+        "econ_hovertemplate": econ_hovertemplate,
+        "breakdown_changes": [
+            pov_breakdowns["changes"][demog] for demog in breakdown_groups
+        ],
+        "breakdown_hovertemplate": [
+            pov_breakdowns["strings"][demog] for demog in breakdown_groups
+        ],
+        "breakdown_labels": [group_labels[group] for group in breakdown_groups],
+        "breakdown_original_rates": [
+            pov_breakdowns["original_rates"][demog] for demog in breakdown_groups
+        ],
+        "breakdown_new_rates": [
+            pov_breakdowns["new_rates"][demog] for demog in breakdown_groups
+        ],
+    }
+
+
+def compute_intervals(key):
+    """returns the error bounds of the outcomes of a scenario
+
+    Returns:
+        dict of (low, high) tuples, see bootstrap.intervals(), or None if
+        the scenario shows no intervals
+    """
+    if key.preview:
+        import subsample
+
+        # error bounds of the estimates, replaced by the exact results once
+        # the slider is released
+        outcomes = cached_stage(compute_outcomes, key)
+        original = outcomes["original"]
+        return subsample.intervals(
+            cached_stage(compute_simulation, key)["target_spmu"],
+            {
+                "poverty_rate": outcomes["poverty_rate_change"],
+                "poverty_gap": outcomes["poverty_gap_change"],
+                "gini": outcomes["gini_change"],
+                "winners": outcomes["percent_winners"],
+                "change_pp": outcomes["change_pp"],
+            },
+            {
+                metric: original[metric]
+                for metric in ["poverty_rate", "poverty_gap", "gini"]
+            },
+        )
+    # bootstrap intervals and the year comparison need the microdata in
+    # memory, so are not available with the chunked engine
+    if key.uncertainty and not data.CHUNKED_DATA_DIR:
+        import bootstrap
+
+        return bootstrap.intervals(
+            key.state_dropdown,
+            cached_stage(compute_simulation, key)["target_spmu"],
+            _survey_year(key),
+        )
+    return None
+
+
+def compute_year_table(key):
+    """returns the results of each survey year side by side, or None"""
+    if key.year != "by_year" or data.CHUNKED_DATA_DIR:
+        return None
+    import years
+
+    results = cached_stage(compute_simulation, key)
+    target_spmu = results["target_spmu"]
+    funding_spmu = results["spmu"] if key.level == "federal" else target_spmu
+    return years.year_table(
+        years.year_results(funding_spmu, target_spmu, key.state_dropdown)
+    )
+
+
+# inputs each stage does not depend on, reset so that scenarios differing
+# only in them share the stage's cache entry
+STAGE_DEFAULTS = {
+    compute_funding: dict(uncertainty=False, intersections=(), preview=False),
+    compute_simulation: dict(uncertainty=False, intersections=()),
+    compute_outcomes: dict(uncertainty=False),
+    compute_intervals: dict(intersections=()),
+    compute_year_table: dict(uncertainty=False, intersections=()),
+}
+
+result_cache = ResultCache(RESULT_CACHE_SIZE)
+simulation_cache = ResultCache(SIMULATION_CACHE_SIZE)
+latest_requests = LatestRequests()
+
+
+STAGES = {stage.__name__: stage for stage in STAGE_DEFAULTS}
+
+
+def _run_stage(name, version, key):
+    return STAGES[name](key)
+
+
+def cached_stage(stage, key, is_stale=None):
+    """returns stage(key), computing it once however many requests ask for
+    it at the same time
+
+    Args:
+        stage: one of the compute_* stages above
+        key: Scenario returned by scenario_key()
+        is_stale: optional function returning True once the requester has
+            moved on, see cache.ResultCache.get()
+    """
+    key = key._replace(**STAGE_DEFAULTS[stage])
+    # a stage needed by another is abandoned along with it
+    is_stale = is_stale or current_is_stale()
+    cache = simulation_cache if stage is compute_simulation else result_cache
+    # results of other data versions are never read, see use_dataset()
+    return cache.get((stage.__name__, data.version(), key), _run_stage, is_stale)
+
+
+def use_dataset(dataset):
+    """serves dataset to new requests, see warmup.watch_releases()
+
+    Requests already running finish on the data they started with. The
+    options of the state and year dropdowns follow the new data, and results
+    of other versions are dropped from the caches.
+    """
+    data.activate(dataset)
+    with data.pinned(dataset):
+        states[:] = data.state_names()
+        state_options[:] = [{"label": x, "value": x} for x in states]
+        year_options[:] = survey_year_options()
+    for cache in [result_cache, simulation_cache, stage_pool]:
+        cache.discard(lambda key: key[1] != dataset.version)
+    with data.pinned(dataset):
+        prerender()
+
+
+# ---------------------------------------------------------------------------- #
+# Each output callback formats the stages it needs, see the callbacks below
+# ---------------------------------------------------------------------------- #
+
+
+def funding_outputs(key, is_stale=None):
+    """returns the "ubi-output", "revenue-output" and "ubi-population-output"
+    lines of a scenario"""
+    totals = cached_stage(compute_funding, key, is_stale)
+    ubi_annual = totals["ubi_annual"]
+
     # --------------SECTION populates "Results of your reform:" ------------ #
 
     # Convert UBI and winners to string for title of chart
@@ -863,15 +1575,11 @@ def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
     ubi_line = "Monthly UBI: $" + ubi_string
 
     # populates 'Funds for UBI'
-    revenue_line = "Funds for UBI: $" + numerize.numerize(revenue, 1)
+    revenue_line = "Funds for UBI: $" + numerize.numerize(totals["revenue"], 1)
 
     # populates population and revenue for UBI if state selected from dropdown
-    if state_dropdown != "US":
-        # filter for selected state
-        state_spmu = target_spmu[target_spmu.state == state_dropdown]
-        # calculate population of state recieving UBI
-        state_ubi_population = (state_spmu.numper_ubi * state_spmu.spmwt).sum()
-
+    if key.state_dropdown != "US":
+        state_ubi_population = totals["state_ubi_population"]
         ubi_population_line = "UBI population: " + numerize.numerize(
             state_ubi_population, 1
         )
@@ -880,176 +1588,702 @@ def ubi(state_dropdown, level, agi_tax, benefits, taxes, include):
 
         revenue_line = (
             "Funds for UBI ("
-            + state_dropdown
+            + key.state_dropdown
             + "): $"
             + numerize.numerize(state_revenue, 1)
         )
 
     else:
-        ubi_population_line = "UBI population: " + numerize.numerize(ubi_population, 1)
+        ubi_population_line = "UBI population: " + numerize.numerize(
+            totals["ubi_population"], 1
+        )
+    return ubi_line, revenue_line, ubi_population_line
+
+
+def summary_outputs(key, is_stale=None):
+    """returns the "winners-output" and "resources-output" lines of a
+    scenario"""
+    outcomes = cached_stage(compute_outcomes, key, is_stale)
+    intervals = cached_stage(compute_intervals, key, is_stale)
+    percent_winners = outcomes["percent_winners"]
 
     winners_line = "Percent better off: " + str(percent_winners) + "%"
+    if key.preview:
+        winners_line = "Percent better off: ~{}% (preview, ±{:.1f})".format(
+            percent_winners, intervals["winners"][1] - percent_winners
+        )
+    elif intervals is not None:
+        import bootstrap
+
+        winners_line += " ({:.0%} CI: {:.1f}% to {:.1f}%)".format(
+            bootstrap.CONFIDENCE_LEVEL, *intervals["winners"]
+        )
     resources_line = "Average change in resources per person: $" + "{:,}".format(
-        int(change_pp)
+        int(outcomes["change_pp"])
     )
+    if key.preview:
+        resources_line = (
+            "Average change in resources per person: ~${:,} (preview, ±${:,})"
+        ).format(
+            int(outcomes["change_pp"]),
+            int(round(intervals["change_pp"][1] - outcomes["change_pp"])),
+        )
+    return winners_line, resources_line
 
-    # ---------- populate economic breakdown bar chart ------------- #
 
-    # Create x-axis labels for each chart
-    econ_fig_x_lab = ["Poverty rate", "Poverty gap", "Gini index"]
-    econ_fig_cols = [poverty_rate_change, poverty_gap_change, gini_change]
-    econ_fig = go.Figure(
-        [
-            go.Bar(
-                x=econ_fig_x_lab,
-                y=econ_fig_cols,
-                text=econ_fig_cols,
-                hovertemplate=[
-                    # poverty rates
-                    "Original poverty rate: "
-                    + original_poverty_rate_string
-                    + "<br><extra></extra>"
-                    "New poverty rate: " + poverty_rate_string,
-                    # poverty gap
-                    "Original poverty gap: $"
-                    + original_poverty_gap_billions
-                    + "B<br><extra></extra>"
-                    "New poverty gap: $" + poverty_gap_billions + "B",
-                    # gini
-                    "Original Gini index: <extra></extra>"
-                    + original_gini_string
-                    + "<br>New Gini index: "
-                    + gini_string,
-                ],
-                marker_color=BLUE,
-            )
+def bar_values(key, is_stale=None):
+    """returns the bars of the economic and poverty breakdown charts, which
+    share a y-axis range
+
+    Returns:
+        econ_fig_cols, econ_fig_intervals (or None), y_range, outcomes
+    """
+    outcomes = cached_stage(compute_outcomes, key, is_stale)
+    intervals = cached_stage(compute_intervals, key, is_stale)
+    econ_fig_cols = [
+        outcomes["poverty_rate_change"],
+        outcomes["poverty_gap_change"],
+        outcomes["gini_change"],
+    ]
+    econ_fig_intervals = None
+    if intervals is not None:
+        econ_fig_intervals = [
+            intervals[metric] for metric in ["poverty_rate", "poverty_gap", "gini"]
         ]
-    )
 
-    # Edit text and display the UBI amount and percent winners in title
-    econ_fig.update_layout(
-        uniformtext_minsize=10,
-        uniformtext_mode="hide",
-        plot_bgcolor="white",
-        title_text="Economic overview",
-        title_x=0.5,
-        hoverlabel_align="right",
-        font_family="Roboto",
-        title_font_size=20,
-        paper_bgcolor="white",
-        hoverlabel=dict(bgcolor="white", font_size=14, font_family="Roboto"),
-        yaxis_tickformat="%",
+    # set both y-axes to the same range, including any error bars
+    econ_fig_ends = econ_fig_cols
+    if econ_fig_intervals is not None:
+        econ_fig_ends = [end for interval in econ_fig_intervals for end in interval]
+    y_range = figures.shared_y_range(econ_fig_ends, outcomes["breakdown_changes"])
+    return econ_fig_cols, econ_fig_intervals, y_range, outcomes
+
+
+def econ_output(key, is_stale=None):
+    """returns the dash.Patch of the "econ-graph" figure of a scenario"""
+    # NOTE: only the changing properties are returned, as dash.Patch updates
+    # of the skeleton figures in figures.py
+    econ_fig_cols, econ_fig_intervals, y_range, outcomes = bar_values(key, is_stale)
+    return figures.bar_update(
+        econ_fig_cols, outcomes["econ_hovertemplate"], y_range, econ_fig_intervals
     )
-    econ_fig.update_traces(texttemplate="%{text:.1%f}", textposition="auto")
-
-    econ_fig.update_xaxes(
-        tickangle=45,
-        title_text="",
-        tickfont={"size": 14},
-        title_standoff=25,
-        title_font=dict(size=14, family="Roboto", color="black"),
+
+
+def breakdown_output(key, is_stale=None):
+    """returns the dash.Patch of the "breakdown-graph" figure of a scenario"""
+    _, _, y_range, outcomes = bar_values(key, is_stale)
+    return figures.bar_update(
+        outcomes["breakdown_changes"],
+        outcomes["breakdown_hovertemplate"],
+        y_range,
+        x=outcomes["breakdown_labels"],
     )
 
-    econ_fig.update_yaxes(
-        tickprefix="",
-        tickfont={"size": 14},
-        title_standoff=25,
-        title_font=dict(size=14, family="Roboto", color="black"),
+
+def decile_values(key, is_stale=None):
+    """returns the bars, line and title of the income decile chart
+
+    Returns:
+        decile_change, decile_winners, decile_title, see figures.decile_update()
+    """
+    results = cached_stage(compute_simulation, key, is_stale)
+    if key.state_dropdown == "US":
+        decile_title = "Change by income decile"
+    else:
+        decile_title = "Change by income decile within " + key.state_dropdown
+    return (
+        results["decile_change"].round(2).tolist(),
+        results["decile_winners"].round(1).tolist(),
+        decile_title,
     )
 
-    # ------------------ populate poverty breakdown charts ---------------- #
 
-    breakdown_fig_x_lab = [
-        "Child",
-        "Adult",
-        "Has disability",
-        "White",
-        "Black",
-        "Hispanic",
-    ]
+def decile_output(key, is_stale=None):
+    """returns the dash.Patch of the "decile-graph" figure of a scenario"""
+    return figures.decile_update(*decile_values(key, is_stale))
 
-    breakdown_fig_cols = [pov_breakdowns["changes"][demog] for demog in DEMOGS]
-    hovertemplate = [pov_breakdowns["strings"][demog] for demog in DEMOGS]
 
-    breakdown_fig = go.Figure(
+def comparison_values(key, is_stale=None):
+    """returns the results of a scenario shown in the compare mode
+
+    Returns:
+        dict of the columns of compare.METRICS and the breakdown_changes
+        and breakdown_labels of compute_outcomes()
+    """
+    totals = cached_stage(compute_funding, key, is_stale)
+    outcomes = cached_stage(compute_outcomes, key, is_stale)
+    revenue = totals["revenue"]
+    if key.state_dropdown != "US":
+        # the funds for UBI in the selected state, as in funding_outputs()
+        revenue = totals["ubi_annual"] * totals["state_ubi_population"]
+    values = {"monthly_ubi": totals["ubi_annual"] / 12, "revenue": revenue}
+    for name in ["percent_winners", "change_pp", "poverty_rate_change"] + [
+        "poverty_gap_change",
+        "gini_change",
+        "breakdown_changes",
+        "breakdown_labels",
+    ]:
+        values[name] = outcomes[name]
+    return values
+
+
+def comparison_outputs(key, pinned, is_stale=None):
+    """returns the outputs of the compare mode
+
+    Reform A, the pinned reform, is run for the state, survey year and
+    breakdown groups of reform B, the current inputs, so both share the
+    units and people selected (see units()) and the baseline.
+
+    Args:
+        key: Scenario of the current inputs
+        pinned: levers of the pinned reform, see pin(), or None
+
+    Returns:
+        style of "compare-results", "compare-description" children, dash.Patch
+        of the "compare-econ-graph" and "compare-breakdown-graph" figures and
+        "compare-table" children
+    """
+    if pinned is None:
+        return {"display": "none"}, None, dash.no_update, dash.no_update, None
+    import compare
+
+    key_a = scenario_key(
+        key.state_dropdown,
+        pinned["level"],
+        pinned["agi_tax"],
+        pinned["benefits"],
+        pinned["taxes"],
+        pinned["include"],
+        False,
+        key.year,
+        key.intersections,
+    )
+    a = comparison_values(key_a, is_stale)
+    b = comparison_values(key, is_stale)
+    econ = [
         [
-            go.Bar(
-                x=breakdown_fig_x_lab,
-                y=breakdown_fig_cols,
-                text=breakdown_fig_cols,
-                hovertemplate=hovertemplate,
-                marker_color=BLUE,
-            )
+            reform["poverty_rate_change"],
+            reform["poverty_gap_change"],
+            reform["gini_change"],
         ]
+        for reform in [a, b]
+    ]
+    y_range = figures.shared_y_range(
+        *econ, a["breakdown_changes"], b["breakdown_changes"]
+    )
+    current = dict(
+        level=key.level,
+        agi_tax=key.agi_tax,
+        benefits=list(key.benefits),
+        taxes=list(key.taxes),
+        include=list(key.include),
     )
+    description = [
+        html.Div("Reform A (pinned): " + compare.describe(pinned)),
+        html.Div("Reform B (current): " + compare.describe(current)),
+    ]
+    return (
+        {"display": "block"},
+        description,
+        figures.comparison_update(*econ, y_range),
+        figures.comparison_update(
+            a["breakdown_changes"],
+            b["breakdown_changes"],
+            y_range,
+            x=b["breakdown_labels"],
+        ),
+        compare.comparison_table(a, b),
+    )
+
+
+def year_table_output(key, is_stale=None):
+    """returns the "year-table" children of a scenario"""
+    return cached_stage(compute_year_table, key, is_stale)
+
 
-    breakdown_fig.update_layout(
-        uniformtext_minsize=10,
-        uniformtext_mode="hide",
-        plot_bgcolor="white",
-        title_text="Poverty rate breakdown",
-        title_x=0.5,
-        hoverlabel_align="right",
-        font_family="Roboto",
-        title_font_size=20,
-        paper_bgcolor="white",
-        hoverlabel=dict(bgcolor="white", font_size=14, font_family="Roboto"),
-        yaxis_tickformat="%",
+# output functions in the order of compute_outputs()
+def download_frames(key, by_state=False):
+    """yields the rows of the download of a scenario, see download.py, as
+    dataframes of at most DOWNLOAD_CHUNK_ROWS rows
+
+    Each chunk is computed once the previous one has been sent.
+
+    Args:
+        key: Scenario of the reform, see download_key()
+        by_state: True to add a row per state
+    """
+    import download
+
+    year = _survey_year(key)
+    outcomes = cached_stage(compute_outcomes, key)
+    rows = [
+        download.outcome_row(
+            "summary",
+            key.state_dropdown,
+            baseline(key.state_dropdown, year),
+            cached_stage(compute_simulation, key),
+        )
+    ]
+    for label, original_rate, new_rate in zip(
+        outcomes["breakdown_labels"],
+        outcomes["breakdown_original_rates"],
+        outcomes["breakdown_new_rates"],
+    ):
+        rows.append(
+            {
+                "section": "demographic",
+                "group": label,
+                "poverty_rate_original": original_rate,
+                "poverty_rate_new": new_rate,
+                "poverty_rate_change": new_rate / original_rate - 1,
+            }
+        )
+    yield pd.DataFrame(rows, columns=download.COLUMNS)
+    if not by_state:
+        return
+
+    if not data.CHUNKED_DATA_DIR:
+        # every state from one simulation of the US, see download.py
+        us = cached_stage(compute_simulation, key._replace(state_dropdown="US"))
+        state_rows = download.state_results(us, key.level, year)
+        for start in range(0, len(state_rows), DOWNLOAD_CHUNK_ROWS):
+            yield state_rows.iloc[start : start + DOWNLOAD_CHUNK_ROWS]
+        return
+
+    # the chunked engine keeps no column per unit, so each state is
+    # simulated on its own, streaming its partition from disk
+    rows = []
+    for state in states[1:]:
+        state_key = key._replace(state_dropdown=state)
+        rows.append(
+            download.outcome_row(
+                "state",
+                state,
+                baseline(state, year),
+                cached_stage(compute_simulation, state_key),
+            )
+        )
+        if len(rows) == DOWNLOAD_CHUNK_ROWS:
+            yield pd.DataFrame(rows, columns=download.COLUMNS)
+            rows = []
+    if rows:
+        yield pd.DataFrame(rows, columns=download.COLUMNS)
+
+
+# downloads streamed by this worker, see download_results()
+download_slots = threading.BoundedSemaphore(DOWNLOAD_CONCURRENCY)
+
+
+def download_key(args):
+    """returns the Scenario of the query string of a download, see
+    download_link(), or None if it is not a valid scenario"""
+    import compare
+
+    try:
+        year = args.get("year", "all")
+        if year not in ["all", "by_year"]:
+            year = int(year)
+        key = scenario_key(
+            args["state"],
+            args["level"],
+            int(args["agi_tax"]),
+            args.getlist("benefits"),
+            args.getlist("taxes"),
+            args.getlist("include"),
+            year=year,
+            intersections=args.getlist("intersections"),
+        )
+    except (KeyError, ValueError):
+        return None
+    valid = (
+        key.state_dropdown in states
+        and key.level in ["federal", "state"]
+        and 0 <= key.agi_tax <= 100
+        and set(key.benefits + key.taxes) <= set(compare.REPEAL_NAMES)
+        and set(key.include) <= set(data.INCLUDE_BITS)
+        and year in [option["value"] for option in year_options]
+        and set(key.intersections)
+        <= {option["value"] for option in INTERSECTION_OPTIONS}
     )
-    breakdown_fig.update_traces(texttemplate="%{text:.1%f}", textposition="auto")
-
-    breakdown_fig.update_xaxes(
-        tickangle=45,
-        title_text="",
-        tickfont=dict(size=14, family="Roboto"),
-        title_standoff=25,
-        title_font=dict(size=14, family="Roboto", color="black"),
+    return key if valid else None
+
+
+@server.route(app.config.routes_pathname_prefix + "download")
+def download_results():
+    """streams the results of the scenario of the query string as a CSV or
+    Parquet file, see download.py
+
+    The file is written a chunk at a time as the response is sent. Each
+    worker streams at most DOWNLOAD_CONCURRENCY downloads at once, and
+    answers 503 to more rather than holding a thread until one finishes.
+    """
+    import download
+
+    key = download_key(flask.request.args)
+    download_format = flask.request.args.get("format", "csv")
+    if key is None or download_format not in download.formats():
+        flask.abort(400)
+    if not download_slots.acquire(blocking=False):
+        return "too many downloads, try again shortly", 503, {"Retry-After": "5"}
+    by_state = flask.request.args.get("states") == "1"
+    # the file is sent after the request ends, from the data of the request
+    frames = data.pinned_iter(download_frames(key, by_state))
+    chunks = download.WRITERS[download_format](frames)
+    response = flask.Response(chunks, mimetype=download.MIMETYPES[download_format])
+    # release the slot once the response is sent or the client goes away
+    response.call_on_close(download_slots.release)
+    filename = "ubi-{}-{}-{}.{}".format(
+        key.state_dropdown.replace(" ", "-"), key.level, key.agi_tax, download_format
     )
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+OUTPUT_FUNCTIONS = [
+    funding_outputs,
+    summary_outputs,
+    econ_output,
+    breakdown_output,
+    decile_output,
+    year_table_output,
+]
+
+
+def cached_outputs(key, is_stale=None):
+    """returns every output of a scenario, see compute_outputs()"""
+    outputs = []
+    for output in OUTPUT_FUNCTIONS:
+        result = output(key, is_stale)
+        outputs.extend(result if isinstance(result, tuple) else [result])
+    return tuple(outputs)
+
+
+def compute_outputs(
+    state_dropdown,
+    level,
+    agi_tax,
+    benefits,
+    taxes,
+    include,
+    uncertainty=False,
+    year="all",
+    intersections=(),
+    preview=False,
+):
+    """this does everything from microsimulation to figure creation, the
+        outputs of every callback together. The callbacks each compute their
+        own outputs, sharing the cached stages above
+    Args:
+        state_dropdown:  takes input from callback input, component_id="state-dropdown"
+        level:  component_id="level"
+        agi_tax:  component_id="agi-slider"
+        benefits:  component_id="benefits-checklist"
+        taxes:  component_id="taxes-checklist"
+        include: component_id="include-checklist"
+        uncertainty: True to add bootstrap confidence intervals
+        year: component_id="year-dropdown", a survey year, "all" to pool
+            every year or "by_year" to also compare the years
+        intersections: component_id="intersection-dropdown", extra groups
+            of the poverty breakdown, each demographics joined by "+"
+        preview: True to estimate the results from the subsample of
+            subsample.py while the tax rate slider is dragged
 
-    breakdown_fig.update_yaxes(
-        tickprefix="",
-        tickfont=dict(size=14, family="Roboto"),
-        title_standoff=25,
-        title_font=dict(size=14, family="Roboto", color="black"),
+    Returns:
+        ubi_line: outputs to  "ubi-output"
+        revenue_line: outputs to "revenue-output"
+        ubi_population_line: outputs to "revenue-output"
+        winners_line: outputs to "winners-output"
+        resources_line: outputs to "resources-output"
+        econ_fig: dash.Patch of the "econ-graph" figure
+        breakdown_fig: dash.Patch of the "breakdown-graph" figure
+        decile_fig: dash.Patch of the "decile-graph" figure
+        year_table: outputs to "year-table"
+    """
+    return cached_outputs(
+        Scenario(
+            state_dropdown,
+            level,
+            agi_tax,
+            tuple(benefits),
+            tuple(taxes),
+            tuple(include),
+            uncertainty,
+            year,
+            tuple(intersections),
+            preview,
+        )
     )
 
-    # set both y-axes to the same range
-    full_econ_fig = econ_fig.full_figure_for_development(warn=False)
-    full_breakdown_fig = breakdown_fig.full_figure_for_development(warn=False)
-    # find the minimum of both y-axes
-    global_ymin = min(
-        min(full_econ_fig.layout.yaxis.range),
-        min(full_breakdown_fig.layout.yaxis.range),
+
+# the inputs of every output callback, passed on to request_key()
+SCENARIO_INPUTS = [
+    Input(component_id="state-dropdown", component_property="value"),
+    Input(component_id="level", component_property="value"),
+    Input(component_id="agi-rate", component_property="data"),
+    Input(component_id="benefits-checklist", component_property="value"),
+    Input(component_id="taxes-checklist", component_property="value"),
+    Input(component_id="include-checklist", component_property="value"),
+    Input(component_id="uncertainty-checklist", component_property="value"),
+    Input(component_id="year-dropdown", component_property="value"),
+    Input(component_id="intersection-dropdown", component_property="value"),
+    Input(component_id="agi-preview", component_property="data"),
+]
+
+
+def request_key(
+    state_dropdown,
+    level,
+    agi_tax,
+    benefits,
+    taxes,
+    include,
+    uncertainty,
+    year,
+    intersections,
+    preview,
+):
+    """returns the Scenario of the inputs of an output callback, in the
+    order of SCENARIO_INPUTS"""
+    key = scenario_key(
+        state_dropdown,
+        level,
+        agi_tax,
+        benefits,
+        taxes,
+        include,
+        uncertainty,
+        year,
+        intersections or [],
     )
-    global_ymax = max(
-        max(full_econ_fig.layout.yaxis.range),
-        max(full_breakdown_fig.layout.yaxis.range),
+    exact_simulation = (
+        "compute_simulation",
+        data.version(),
+        key._replace(**STAGE_DEFAULTS[compute_simulation]),
     )
+    if (
+        preview
+        and exact_simulation not in simulation_cache
+        and year != "by_year"
+        and not data.CHUNKED_DATA_DIR
+    ):
+        # estimate the results from a subsample while the slider is dragged,
+        # unless the exact results are already cached, see subsample.py
+        key = key._replace(preview=True)
+    return key
+
+
+# id of each page load, set by serve_layout(), so that requests superseded by
+# a newer one from the same page can be abandoned. Two tabs or embeds of the
+# app in one browser each have their own.
+PAGE_ID = State(component_id="page-id", component_property="data")
+
+
+def serve(output, values, *args):
+    """returns output(key, *args) for the values of SCENARIO_INPUTS and
+    PAGE_ID of an output callback
+
+    Each output of a page is tracked on its own, so a newer request for the
+    same output abandons an older one, see cache.LatestRequests.
+    """
+    *inputs, page = values
+    key = request_key(*inputs)
+    is_stale = latest_requests.start((page, output.__name__)) if page else None
+    import profiling
+
+    try:
+        if profiling.requested():
+            # see profiling.py for how requests are picked
+            return profiling.capture(key, output, is_stale, args)
+        return output(key, *args, is_stale=is_stale)
+    except Cancelled:
+        # a newer request from the same page replaces this one
+        raise PreventUpdate
+
+
+# the output callbacks are not called on page load, the layout already has
+# their outputs for the default inputs, see prerender()
+@app.callback(
+    Output(component_id="ubi-output", component_property="children"),
+    Output(component_id="revenue-output", component_property="children"),
+    Output(component_id="ubi-population-output", component_property="children"),
+    *SCENARIO_INPUTS,
+    PAGE_ID,
+    prevent_initial_call=True,
+)
+def ubi(*values):
+    """returns funding_outputs() for the inputs.
+    Dash does something automatically where it takes the input arguments
+    in the order given in the @app.callback decorator
+    """
+    inputs = values[:-1]
+    if not inputs[-1]:
+        # one json line per request, read by warmup.py to find popular
+        # scenarios, previews are only seen while the slider is dragged
+        scenario_log.info(json.dumps(request_key(*inputs)))
+    return serve(funding_outputs, values)
 
-    # update the yaxes of the figure to account for both ends of the ranges
-    econ_fig.update_yaxes(dict(range=[global_ymin, global_ymax], autorange=False))
-    breakdown_fig.update_yaxes(dict(range=[global_ymin, global_ymax], autorange=False))
 
-    # adjust margins to fit mobile better
-    for fig in [econ_fig, breakdown_fig]:
-        fig.update_layout(
-            margin=dict(l=20, r=20),
-        )
+@app.callback(
+    Output(component_id="winners-output", component_property="children"),
+    Output(component_id="resources-output", component_property="children"),
+    *SCENARIO_INPUTS,
+    PAGE_ID,
+    prevent_initial_call=True,
+)
+def summary(*values):
+    """returns summary_outputs() for the inputs"""
+    return serve(summary_outputs, values)
 
-    return (
-        ubi_line,
-        revenue_line,
-        ubi_population_line,
-        winners_line,
-        resources_line,
-        econ_fig,
-        breakdown_fig,
+
+@app.callback(
+    Output(component_id="econ-graph", component_property="figure"),
+    *SCENARIO_INPUTS,
+    PAGE_ID,
+    prevent_initial_call=True,
+)
+def econ(*values):
+    """returns econ_output() for the inputs"""
+    return serve(econ_output, values)
+
+
+@app.callback(
+    Output(component_id="breakdown-graph", component_property="figure"),
+    *SCENARIO_INPUTS,
+    PAGE_ID,
+    prevent_initial_call=True,
+)
+def breakdown(*values):
+    """returns breakdown_output() for the inputs"""
+    return serve(breakdown_output, values)
+
+
+@app.callback(
+    Output(component_id="decile-graph", component_property="figure"),
+    *SCENARIO_INPUTS,
+    PAGE_ID,
+    prevent_initial_call=True,
+)
+def deciles(*values):
+    """returns decile_output() for the inputs"""
+    return serve(decile_output, values)
+
+
+@app.callback(
+    Output(component_id="year-table", component_property="children"),
+    *SCENARIO_INPUTS,
+    PAGE_ID,
+    prevent_initial_call=True,
+)
+def year_table(*values):
+    """returns year_table_output() for the inputs"""
+    return serve(year_table_output, values)
+
+
+@app.callback(
+    Output("compare-pinned", "data"),
+    Input("compare-pin", "n_clicks"),
+    Input("compare-clear", "n_clicks"),
+    State("level", "value"),
+    State("agi-rate", "data"),
+    State("benefits-checklist", "value"),
+    State("taxes-checklist", "value"),
+    State("include-checklist", "value"),
+    prevent_initial_call=True,
+)
+def pin(pin_clicks, clear_clicks, level, agi_tax, benefits, taxes, include):
+    """stores the levers of the current reform as reform A of the compare
+    mode, or clears them"""
+    if dash.callback_context.triggered[0]["prop_id"] == "compare-clear.n_clicks":
+        return None
+    return dict(
+        level=level, agi_tax=agi_tax, benefits=benefits, taxes=taxes, include=include
+    )
+
+
+@app.callback(
+    Output(component_id="compare-results", component_property="style"),
+    Output(component_id="compare-description", component_property="children"),
+    Output(component_id="compare-econ-graph", component_property="figure"),
+    Output(component_id="compare-breakdown-graph", component_property="figure"),
+    Output(component_id="compare-table", component_property="children"),
+    Input(component_id="compare-pinned", component_property="data"),
+    *SCENARIO_INPUTS,
+    PAGE_ID,
+    prevent_initial_call=True,
+)
+def comparison(pinned, *values):
+    """returns comparison_outputs() for the inputs"""
+    return serve(comparison_outputs, values, pinned)
+
+
+@app.callback(
+    Output(component_id="download-link", component_property="href"),
+    Input(component_id="download-format", component_property="value"),
+    Input(component_id="download-options", component_property="value"),
+    *SCENARIO_INPUTS[:-1],
+    prevent_initial_call=True,
+)
+def download_link(
+    download_format,
+    options,
+    state_dropdown,
+    level,
+    agi_tax,
+    benefits,
+    taxes,
+    include,
+    uncertainty,
+    year,
+    intersections,
+):
+    """returns the url of the download route for the inputs, see
+    download_results()"""
+    key = scenario_key(
+        state_dropdown,
+        level,
+        agi_tax,
+        benefits,
+        taxes,
+        include,
+        year=year,
+        intersections=intersections or [],
     )
+    query = {
+        "state": key.state_dropdown,
+        "level": key.level,
+        "agi_tax": key.agi_tax,
+        "benefits": key.benefits,
+        "taxes": key.taxes,
+        "include": key.include,
+        "year": key.year,
+        "intersections": key.intersections,
+        "format": download_format,
+        "states": int("states" in options),
+    }
+    return app.get_relative_path("/download?" + urlencode(query, doseq=True))
+
+
+# pass slider values on to the ubi callback at a capped rate while dragging,
+# flagged as previews until the slider is released
+app.clientside_callback(
+    ClientsideFunction(namespace="ubi", function_name="throttle_slider"),
+    Output("agi-rate", "data"),
+    Output("agi-preview", "data"),
+    Input("agi-slider", "value"),
+    Input("agi-slider", "drag_value"),
+    State("agi-rate", "data"),
+    State("agi-preview", "data"),
+    # agi-rate starts at the slider's value
+    prevent_initial_call=True,
+)
 
 
+# the options in the layout are those of the default values, so the option
+# callbacks are not called on page load either
 @app.callback(
     Output("include-checklist", "options"),
     Input("include-checklist", "value"),
+    prevent_initial_call=True,
 )
 def update(checklist):
     """[summary]
@@ -1086,6 +2320,7 @@ def update(checklist):
 @app.callback(
     Output("benefits-checklist", "options"),
     Input("level", "value"),
+    prevent_initial_call=True,
 )
 def update(radio):
     # update checklist options for benefits-checklist widget if level is state
@@ -1137,6 +2372,7 @@ def update(radio):
 @app.callback(
     Output("taxes-checklist", "options"),
     Input("level", "value"),
+    prevent_initial_call=True,
 )
 def update(radio):
     """update radio buttons for taxs if state selected"""
@@ -1157,5 +2393,91 @@ def update(radio):
         ]
 
 
+# ---------------------------------------------------------------------------- #
+#                     SECTION pre-rendered initial page                        #
+# ---------------------------------------------------------------------------- #
+
+# the outputs of the default inputs embedded in the layout by prerender(), as
+# the output function and the (component id, property) of each of its outputs
+PRERENDERED_OUTPUTS = [
+    (
+        funding_outputs,
+        [
+            ("ubi-output", "children"),
+            ("revenue-output", "children"),
+            ("ubi-population-output", "children"),
+        ],
+    ),
+    (
+        summary_outputs,
+        [("winners-output", "children"), ("resources-output", "children")],
+    ),
+    (econ_output, [("econ-graph", "figure")]),
+    (breakdown_output, [("breakdown-graph", "figure")]),
+    (decile_output, [("decile-graph", "figure")]),
+    (year_table_output, [("year-table", "children")]),
+]
+
+_prerender_lock = threading.Lock()
+# (data version, layout with the outputs of that version), see prerender(),
+# the version is None without releases
+_prerendered = [object(), layout]
+
+
+def prerender():
+    """returns a copy of the layout with the outputs of the default inputs
+    embedded, so a page load shows them without calling any callback
+
+    The default inputs are the values of the inputs in the layout. The
+    outputs are computed once per version of the data, in wsgi.py before
+    gunicorn forks its workers and in use_dataset() for a new release.
+    """
+    with _prerender_lock:
+        version, prerendered = _prerendered
+        if version == data.version():
+            return prerendered
+        prerendered = copy.deepcopy(layout)
+        components = {
+            component.id: component
+            for component in prerendered._traverse()
+            if getattr(component, "id", None) is not None
+        }
+        inputs = [
+            getattr(components[i.component_id], i.component_property, None)
+            for i in SCENARIO_INPUTS
+        ]
+        key = request_key(*inputs)
+        values = {}
+        for output, targets in PRERENDERED_OUTPUTS:
+            results = output(key)
+            if len(targets) == 1:
+                results = [results]
+            values.update(zip(targets, results))
+        values["download-link", "href"] = download_link(
+            components["download-format"].value,
+            components["download-options"].value,
+            *inputs[:-1],
+        )
+        for (component_id, prop), value in values.items():
+            if isinstance(value, dash.Patch):
+                # an update of a skeleton figure, see figures.py
+                value = figures.patched(getattr(components[component_id], prop), value)
+            setattr(components[component_id], prop, value)
+        # swapped in whole, a page load never sees half of it
+        _prerendered[:] = [data.version(), prerendered]
+        return prerendered
+
+
+def serve_layout():
+    """returns the layout with the outputs of the default inputs for the
+    current data, see prerender(), and a new PAGE_ID"""
+    return html.Div([prerender(), dcc.Store(id="page-id", data=uuid.uuid4().hex)])
+
+
+# the callbacks are checked against the layout itself
+app.validation_layout = html.Div([layout, dcc.Store(id="page-id")])
+app.layout = serve_layout
+
+
 if __name__ == "__main__":
     app.run_server(debug=True, port=8000, host="127.0.0.1")
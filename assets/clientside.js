@@ -0,0 +1,39 @@
+// minimum time between two ubi callbacks while the tax rate slider is dragged
+const SLIDER_THROTTLE_MS = 250;
+
+let lastSliderUpdate = 0;
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    ubi: {
+        // passes agi-slider values on to the agi-rate store, which is the
+        // input of the ubi callback. While dragging, at most one value is
+        // passed every SLIDER_THROTTLE_MS; the value on release always is.
+        // agi-preview is true while dragging, so the ubi callback returns
+        // quick estimates, and false on release, which asks for the exact
+        // results even when the released value was already previewed.
+        throttle_slider: function (value, dragValue, current, preview) {
+            const noUpdate = window.dash_clientside.no_update;
+            const triggered = window.dash_clientside.callback_context.triggered;
+            const dragging =
+                triggered.length > 0 &&
+                triggered[0].prop_id === "agi-slider.drag_value";
+            const next = dragging ? dragValue : value;
+            const now = Date.now();
+
+            if (next === undefined || next === null) {
+                return [noUpdate, noUpdate];
+            }
+            if (!dragging) {
+                return [
+                    next === current ? noUpdate : next,
+                    preview ? false : noUpdate,
+                ];
+            }
+            if (next === current || now - lastSliderUpdate < SLIDER_THROTTLE_MS) {
+                return [noUpdate, noUpdate];
+            }
+            lastSliderUpdate = now;
+            return [next, preview ? noUpdate : true];
+        },
+    },
+});
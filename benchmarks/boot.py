@@ -0,0 +1,168 @@
+"""Measures cold start: import time, data load time and time-to-first-request.
+
+Each measurement runs in a fresh interpreter so nothing is already imported
+or cached. Run from the repo root:
+
+    python benchmarks/boot.py [--target 5] [--runs 3] [--importtime]
+        [--backend auto]
+
+Exits with status 1 if the median time-to-first-request (import + data load
++ first page load, which renders the results of the default inputs) exceeds
+the target, in seconds.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a component each output callback outputs to, see app.SCENARIO_INPUTS
+OUTPUT_IDS = [
+    "ubi-output",
+    "winners-output",
+    "econ-graph",
+    "breakdown-graph",
+    "decile-graph",
+    "year-table",
+]
+
+# time-to-first-request budget in seconds for a worker started from scratch
+TARGET_SECONDS = 5.0
+
+# default inputs of the output callbacks, in the order of their Inputs
+DEFAULT_INPUTS = {
+    "state-dropdown": "US",
+    "level": "federal",
+    "agi-rate": 0,
+    "benefits-checklist": [],
+    "taxes-checklist": [],
+    "include-checklist": ["adults", "children", "non_citizens"],
+    "uncertainty-checklist": [],
+    "year-dropdown": "all",
+    "intersection-dropdown": [],
+    "agi-preview": False,
+}
+
+
+def callback_payload(app, output_id, values):
+    """returns the body of a /_dash-update-component request
+
+    Args:
+        app: the dash.Dash instance
+        output_id: id of any component the callback outputs to
+        values: dict of {component_id: value} for the callback's inputs and
+            states, None for states missing from it
+    """
+    for output, spec in app.callback_map.items():
+        outputs = output.strip(".").split("...")
+        if any(o.split(".")[0] == output_id for o in outputs):
+            break
+    else:
+        raise KeyError(output_id)
+    outputs = [
+        {"id": o.rsplit(".", 1)[0], "property": o.rsplit(".", 1)[1]} for o in outputs
+    ]
+    return {
+        "output": output,
+        # a callback with a single output is sent it alone, not in a list
+        "outputs": outputs if len(outputs) > 1 else outputs[0],
+        "inputs": [dict(i, value=values[i["id"]]) for i in spec["inputs"]],
+        "changedPropIds": [],
+        "state": [dict(s, value=values.get(s["id"])) for s in spec["state"]],
+    }
+
+
+def _child():
+    """runs in a fresh interpreter and prints timings as json"""
+    timings = {}
+    start = time.perf_counter()
+    import app
+
+    timings["import_app"] = time.perf_counter() - start
+
+    t = time.perf_counter()
+    import data
+
+    data.microdata()
+    timings["load_data"] = time.perf_counter() - t
+
+    client = app.server.test_client()
+    url = app.app.config.requests_pathname_prefix + "_dash-layout"
+    # a request is a page load: the layout has the results of the default
+    # inputs embedded and the browser calls no callback, see app.prerender()
+    for name in ["first_request", "second_request"]:
+        t = time.perf_counter()
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+        timings[name] = time.perf_counter() - t
+
+    timings["time_to_first_request"] = (
+        timings["import_app"] + timings["load_data"] + timings["first_request"]
+    )
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", type=float, default=TARGET_SECONDS)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--importtime",
+        action="store_true",
+        help="also list the slowest imports of app.py (python -X importtime)",
+    )
+    parser.add_argument(
+        "--backend",
+        default=os.environ.get("KERNEL_BACKEND", "auto"),
+        help="KERNEL_BACKEND of the app: numpy, numba or auto, see kernels.py",
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child()
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child"],
+            cwd=REPO_DIR,
+            env=dict(os.environ, KERNEL_BACKEND=args.backend),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        runs.append(json.loads(out.splitlines()[-1]))
+
+    print("median of", args.runs, "cold starts (seconds), backend", args.backend)
+    for name in runs[0]:
+        print(f"  {name:<24}{statistics.median(r[name] for r in runs):8.3f}")
+
+    if args.importtime:
+        err = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import app"],
+            cwd=REPO_DIR,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stderr
+        rows = [line.split("|") for line in err.splitlines()[1:] if "|" in line]
+        rows.sort(key=lambda row: -int(row[1]))
+        print("slowest imports (cumulative ms):")
+        for row in rows[:15]:
+            print(f"  {int(row[1]) / 1000:8.1f}  {row[2].strip()}")
+
+    ttfr = statistics.median(r["time_to_first_request"] for r in runs)
+    if ttfr > args.target:
+        print(f"time to first request {ttfr:.2f}s exceeds target {args.target}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, REPO_DIR)
+    main()
@@ -0,0 +1,442 @@
+"""Replays realistic Dash callback traffic against a local gunicorn server.
+
+Starts `gunicorn wsgi:server` with the given workers and threads (or targets
+a running server with --url), then simulates --users browser sessions for
+--duration seconds. Each session repeats interactions drawn from --mix:
+
+    default: loads the page, whose layout has the results of the default
+        inputs embedded, see app.prerender()
+    drag: drags the tax rate slider, as previews, then releases it
+    state: picks another state
+    repeal: toggles a benefit or tax repeal
+    level: switches between a federal and a state reform
+    include: toggles a group in the include checklist
+
+Like the browser, each other interaction fires the output callbacks in
+parallel, plus the option callbacks (the three `update` callbacks) whose
+input changed. Page loads are reported as "layout". Run from the repo root:
+
+    python benchmarks/load.py [--workers 2] [--threads 4] [--users 8]
+        [--duration 30] [--mix default=1,drag=3,state=1,repeal=1]
+        [--backend auto]
+
+--backend sets the KERNEL_BACKEND of the server started, see kernels.py, so
+runs with the NumPy and numba reductions can be compared.
+
+Reports throughput, p50/p95/p99 latency per callback, the error rate and
+the peak memory of each gunicorn worker (RSS, and PSS, which splits the
+pages shared copy-on-write between the processes sharing them).
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import numpy as np
+
+from boot import DEFAULT_INPUTS, OUTPUT_IDS, REPO_DIR, callback_payload
+
+# ids the option callbacks output to, with the input that triggers each
+UPDATE_IDS = {
+    "include-checklist": "include-checklist",
+    "benefits-checklist": "level",
+    "taxes-checklist": "level",
+}
+
+# values of the checklists toggled by the repeal and include interactions
+REPEALS = {
+    "benefits-checklist": [
+        "ctc",
+        "incssi",
+        "spmsnap",
+        "eitcred",
+        "incunemp",
+        "spmheat",
+    ],
+    "taxes-checklist": ["fedtaxac", "fica"],
+}
+INCLUDE = ["adults", "children", "non_citizens"]
+
+DEFAULT_MIX = "default=1,drag=3,state=1,repeal=1,level=1,include=1"
+
+# preview requests sent while dragging, one per throttle interval of
+# assets/clientside.js
+DRAG_STEPS = 6
+SLIDER_THROTTLE_SECONDS = 0.25
+
+# seconds to wait for every worker to finish warming up
+READY_TIMEOUT = 300
+
+
+# ---------------------------------------------------------------------------- #
+#                       SECTION interactions                                   #
+# ---------------------------------------------------------------------------- #
+# each returns the steps of an interaction as (inputs, changed input ids),
+# updating the session's inputs in place. A page load changes None: the
+# browser fetches the layout and calls no callback
+
+
+def _default(inputs, rng, states):
+    inputs.clear()
+    inputs.update(DEFAULT_INPUTS)
+    return [(dict(inputs), None)]
+
+
+def _drag(inputs, rng, states):
+    start, stop = inputs["agi-rate"], rng.randint(0, 50)
+    steps = []
+    for rate in np.linspace(start, stop, DRAG_STEPS + 1)[1:-1].round().astype(int):
+        steps.append(
+            (dict(inputs, **{"agi-rate": int(rate), "agi-preview": True}), set())
+        )
+    inputs.update({"agi-rate": stop, "agi-preview": False})
+    return steps + [(dict(inputs), set())]
+
+
+def _state(inputs, rng, states):
+    inputs["state-dropdown"] = rng.choice(states)
+    return [(dict(inputs), set())]
+
+
+def _toggle(values, value):
+    return [v for v in values if v != value] if value in values else values + [value]
+
+
+def _repeal(inputs, rng, states):
+    component = rng.choice(list(REPEALS))
+    inputs[component] = _toggle(inputs[component], rng.choice(REPEALS[component]))
+    return [(dict(inputs), set())]
+
+
+def _level(inputs, rng, states):
+    inputs["level"] = "state" if inputs["level"] == "federal" else "federal"
+    return [(dict(inputs), {"level"})]
+
+
+def _include(inputs, rng, states):
+    include = _toggle(inputs["include-checklist"], rng.choice(INCLUDE))
+    if "adults" not in include and "children" not in include:
+        # the dashboard never excludes both adults and children
+        include = _toggle(inputs["include-checklist"], "non_citizens")
+    inputs["include-checklist"] = include
+    return [(dict(inputs), {"include-checklist"})]
+
+
+INTERACTIONS = {
+    "default": _default,
+    "drag": _drag,
+    "state": _state,
+    "repeal": _repeal,
+    "level": _level,
+    "include": _include,
+}
+
+
+# ---------------------------------------------------------------------------- #
+#                       SECTION server                                         #
+# ---------------------------------------------------------------------------- #
+
+
+def start_server(port, workers, threads, backend="auto"):
+    """starts gunicorn on port and waits until every worker is warm
+
+    Args:
+        backend: KERNEL_BACKEND of the workers, see kernels.py
+
+    Returns:
+        the gunicorn master process
+    """
+    process = subprocess.Popen(
+        [
+            "gunicorn",
+            "wsgi:server",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--workers",
+            str(workers),
+            "--threads",
+            str(threads),
+        ],
+        cwd=REPO_DIR,
+        env=dict(os.environ, KERNEL_BACKEND=backend),
+    )
+    url = f"http://127.0.0.1:{port}/ready"
+    deadline = time.monotonic() + READY_TIMEOUT
+    ready = 0
+    # requests are spread over the workers, so wait until many in a row
+    # find their worker ready
+    while ready < 4 * workers:
+        if process.poll() is not None:
+            sys.exit(f"gunicorn exited with status {process.returncode}")
+        if time.monotonic() > deadline:
+            process.terminate()
+            sys.exit("workers did not become ready in time")
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                ready = ready + 1 if response.status == 200 else 0
+        except (urllib.error.URLError, ConnectionError):
+            ready = 0
+            time.sleep(0.2)
+    return process
+
+
+def worker_pids(master_pid):
+    """returns the pids of the child processes of master_pid (Linux only)"""
+    path = f"/proc/{master_pid}/task/{master_pid}/children"
+    try:
+        with open(path) as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_mb(pid):
+    """returns the (RSS, PSS) of pid in megabytes, PSS is None if unknown"""
+    rss = pss = None
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Rss:"):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith("Pss:"):
+                    pss = int(line.split()[1]) / 1024
+    except OSError:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+    return rss, pss
+
+
+class MemorySampler(threading.Thread):
+    """records the peak memory of each worker of a gunicorn master"""
+
+    def __init__(self, master_pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for pid in worker_pids(self.master_pid):
+                try:
+                    rss, pss = memory_mb(pid)
+                except OSError:
+                    # the worker exited or was restarted
+                    continue
+                peak_rss, peak_pss = self.peaks.get(pid, (0, 0))
+                self.peaks[pid] = (max(peak_rss, rss), max(peak_pss, pss or 0))
+
+
+# ---------------------------------------------------------------------------- #
+#                       SECTION load generation                                #
+# ---------------------------------------------------------------------------- #
+
+
+class Session:
+    """one simulated browser session
+
+    Args:
+        url: base url of the app, ending in "/"
+        payloads: function returning the payload of an output id for inputs
+        pool: executor firing the callbacks of an interaction in parallel
+        records: list of (output id or "layout", seconds, ok) the requests
+            are added to
+    """
+
+    def __init__(self, url, payloads, pool, records, seed):
+        self.url = url + "_dash-update-component"
+        self.layout_url = url + "_dash-layout"
+        self.payloads = payloads
+        self.pool = pool
+        self.records = records
+        self.rng = random.Random(seed)
+        # the page id of app.serve_layout(), which the output callbacks of
+        # a page are superseded by
+        self.page = uuid.uuid4().hex
+        self.inputs = dict(DEFAULT_INPUTS)
+
+    def post(self, output_id, inputs):
+        values = dict(inputs, **{"page-id": self.page})
+        body = json.dumps(self.payloads(output_id, values)).encode()
+        request = urllib.request.Request(
+            self.url, data=body, headers={"Content-Type": "application/json"}
+        )
+        self.send(output_id, request)
+
+    def load_page(self):
+        self.page = uuid.uuid4().hex
+        self.send("layout", urllib.request.Request(self.layout_url))
+
+    def send(self, name, request):
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                response.read()
+                # 204 is PreventUpdate, e.g. a request superseded by a newer one
+                ok = response.status in (200, 204)
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            ok = False
+        self.records.append((name, time.perf_counter() - start, ok))
+
+    def run(self, mix, states, deadline):
+        names, weights = zip(*mix.items())
+        while time.monotonic() < deadline:
+            name = self.rng.choices(names, weights)[0]
+            steps = INTERACTIONS[name](self.inputs, self.rng, states)
+            for i, (inputs, changed) in enumerate(steps):
+                if changed is None:
+                    self.load_page()
+                    continue
+                output_ids = list(OUTPUT_IDS)
+                output_ids += [o for o, i_ in UPDATE_IDS.items() if i_ in changed]
+                futures = [
+                    self.pool.submit(self.post, output_id, inputs)
+                    for output_id in output_ids
+                ]
+                concurrent.futures.wait(futures)
+                if i < len(steps) - 1:
+                    time.sleep(SLIDER_THROTTLE_SECONDS)
+
+
+def parse_mix(text):
+    """returns {interaction: weight} of "name=weight,..." """
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        if name not in INTERACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown interaction {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def summarize(records, seconds, peaks):
+    """returns the report of a run as a dict"""
+    latencies = {}
+    for output_id, latency, _ in records:
+        latencies.setdefault(output_id, []).append(latency)
+    latencies["all"] = [latency for _, latency, _ in records]
+    errors = sum(not ok for _, _, ok in records)
+    return {
+        "requests": len(records),
+        "throughput": len(records) / seconds,
+        "error_rate": errors / max(len(records), 1),
+        "latency_ms": {
+            output_id: dict(
+                zip(
+                    ["p50", "p95", "p99"],
+                    (np.percentile(values, [50, 95, 99]) * 1000).round(1).tolist(),
+                )
+            )
+            for output_id, values in latencies.items()
+        },
+        "workers_mb": {
+            str(pid): {"rss": round(rss, 1), "pss": round(pss, 1)}
+            for pid, (rss, pss) in sorted(peaks.items())
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument(
+        "--url", help="base url of a running server instead of starting one"
+    )
+    parser.add_argument(
+        "--backend",
+        default=os.environ.get("KERNEL_BACKEND", "auto"),
+        help="KERNEL_BACKEND of the server started: numpy, numba or auto",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+
+    import app
+    import data
+
+    def payloads(output_id, inputs):
+        return callback_payload(app.app, output_id, inputs)
+
+    server = None
+    if args.url:
+        url = args.url.rstrip("/") + "/"
+    else:
+        server = start_server(args.port, args.workers, args.threads, args.backend)
+        url = f"http://127.0.0.1:{args.port}" + app.app.config.requests_pathname_prefix
+    sampler = None
+    if server is not None:
+        sampler = MemorySampler(server.pid)
+        sampler.start()
+
+    records = []
+    states = data.state_names()
+    pool = concurrent.futures.ThreadPoolExecutor(
+        args.users * (len(OUTPUT_IDS) + len(UPDATE_IDS))
+    )
+    sessions = [
+        Session(url, payloads, pool, records, seed) for seed in range(args.users)
+    ]
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=session.run, args=(args.mix, states, deadline))
+        for session in sessions
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+    finally:
+        pool.shutdown()
+        if sampler is not None:
+            sampler.stopped.set()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = summarize(records, elapsed, sampler.peaks if sampler else {})
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(
+        f"{args.users} users for {elapsed:.0f}s against "
+        + (
+            url
+            if args.url
+            else f"{args.workers} workers x {args.threads} threads, "
+            f"{args.backend} kernels"
+        )
+    )
+    print(
+        f"  {report['requests']} requests, {report['throughput']:.1f}/s, "
+        f"{report['error_rate']:.1%} errors"
+    )
+    print(f"  {'latency (ms)':<24}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for output_id, percentiles in report["latency_ms"].items():
+        print(f"  {output_id:<24}" + "".join(f"{v:9.1f}" for v in percentiles.values()))
+    if report["workers_mb"]:
+        print(f"  {'peak memory (MB)':<24}{'rss':>9}{'pss':>9}")
+        for pid, memory in report["workers_mb"].items():
+            print(f"  {'worker ' + pid:<24}{memory['rss']:9.1f}{memory['pss']:9.1f}")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, REPO_DIR)
+    main()
@@ -0,0 +1,112 @@
+"""Times the reductions of app.simulate() with each kernel backend.
+
+Runs a reform on every SPM unit, then times kernels.unit_totals(),
+kernels.person_totals() and kernels.gini() on its arrays with each backend,
+after an untimed call that compiles them, and checks that the backends
+agree. Run from the repo root:
+
+    python benchmarks/reductions.py [--repeat 20] [--backends numpy numba]
+
+numba is only listed when it is installed (`pip install numba`).
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from boot import REPO_DIR
+
+# the reform the arrays come from: a 10% flat tax funding a UBI for everyone
+SCENARIO = ("US", "federal", 10, [], [], ["adults", "children", "non_citizens"])
+
+
+def reduction_inputs():
+    """returns the arguments of each reduction for SCENARIO"""
+    import app
+    import data
+
+    results = app.simulate(*SCENARIO)
+    stage = app.pooled(app.units, "US", "federal", None, False)
+    target_spmu = results["target_spmu"]
+    new_resources = target_spmu.new_resources.to_numpy()
+    spmthresh = target_spmu.spmthresh.to_numpy()
+    spmtotres = target_spmu.spmtotres.to_numpy()
+    numper = target_spmu.numper.to_numpy()
+    asecwt = stage["asecwt"]
+    return {
+        "unit_totals": (
+            new_resources,
+            spmthresh,
+            spmtotres,
+            target_spmu.spmwt.to_numpy(),
+            numper,
+            target_spmu.person_weight.to_numpy(),
+            target_spmu.decile_us.to_numpy(),
+            data.N_DECILES,
+        ),
+        "person_totals": (
+            new_resources,
+            numper,
+            spmthresh,
+            spmtotres,
+            stage["person_rows"],
+            asecwt,
+            stage["demog_code"],
+            data.N_DEMOG_CODES,
+        ),
+        "gini": ((new_resources / numper)[stage["person_rows"]], asecwt),
+    }
+
+
+def _close(a, b):
+    if isinstance(a, dict):
+        return all(_close(a[key], b[key]) for key in a)
+    return np.allclose(a, b, rtol=1e-9)
+
+
+def main():
+    import kernels
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--backends", nargs="+", default=kernels.BACKENDS, choices=kernels.BACKENDS
+    )
+    args = parser.parse_args()
+
+    inputs = reduction_inputs()
+    results = {}
+    print(f"median of {args.repeat} calls (ms)")
+    print(f"  {'reduction':<16}" + "".join(f"{name:>10}" for name in args.backends))
+    timings = {name: {} for name in inputs}
+    for backend in args.backends:
+        kernels.set_backend(backend)
+        for name, arguments in inputs.items():
+            function = getattr(kernels, name)
+            results[backend, name] = function(*arguments)
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                function(*arguments)
+                times.append(time.perf_counter() - start)
+            timings[name][backend] = statistics.median(times) * 1000
+    for name, by_backend in timings.items():
+        print(
+            f"  {name:<16}"
+            + "".join(f"{by_backend[backend]:10.2f}" for backend in args.backends)
+        )
+
+    for name in inputs:
+        first = results[args.backends[0], name]
+        for backend in args.backends[1:]:
+            if not _close(first, results[backend, name]):
+                sys.exit(f"{name} differs between {args.backends[0]} and {backend}")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(REPO_DIR)
+    main()
@@ -0,0 +1,180 @@
+"""Bootstrap confidence intervals for the outcomes of a reform.
+
+SPM units are resampled with replacement within each state and survey year,
+the strata of subsample.py, so a single year selected keeps its number of
+units in every replicate. Rather than
+rerunning the simulation per replicate, every replicate is a row of a
+(replicates x units) matrix of resampling counts, applied to one set of
+per-unit outcome vectors:
+    - poverty rate, poverty gap and winners are matrix-vector products
+    - the Gini index sorts the units once, then takes cumulative sums of
+      every replicate's weights in that order
+
+Poverty status, winning and resources per person are the same for everyone
+in an SPM unit, so the person-level statistics of ubi() are computed from
+units weighted by the sum of their members' person weights.
+
+Replicates are processed in batches sized so their temporaries stay within
+BOOTSTRAP_MEMORY_MB, whatever the number of units.
+"""
+import os
+
+import numpy as np
+
+import data
+
+N_REPLICATES = int(os.environ.get("BOOTSTRAP_REPLICATES", 100))
+CONFIDENCE_LEVEL = 0.9
+SEED = 0
+BOOTSTRAP_MEMORY_MB = int(os.environ.get("BOOTSTRAP_MEMORY_MB", 64))
+
+# columns of the strata units are resampled within, recorded in the manifest
+# of a release so counts drawn with other strata are not reused
+STRATA = ["state", "year"]
+
+# (replicates x units) float64 arrays alive at once while computing a batch
+_ARRAYS_PER_BATCH = 6
+
+
+@data.per_version
+def replicate_counts():
+    """returns the (N_REPLICATES x spmu rows) uint8 matrix of how many times
+    each SPM unit is drawn in each replicate, resampling within STRATA
+
+    Memory-mapped from the release when releases.py precomputed it with the
+    same number of replicates and STRATA.
+    """
+    precomputed = data.mapped_array("replicate_counts")
+    if (
+        precomputed is not None
+        and len(precomputed) == N_REPLICATES
+        and (data.release_manifest() or {}).get("replicate_strata") == STRATA
+    ):
+        return precomputed
+    spmu = data.microdata().spmu
+    rng = np.random.default_rng(SEED)
+    counts = np.zeros((N_REPLICATES, len(spmu)), dtype=np.uint8)
+    for rows in spmu.groupby(STRATA, observed=True).indices.values():
+        n = len(rows)
+        counts[:, rows] = rng.multinomial(n, np.full(n, 1 / n), N_REPLICATES)
+    return counts
+
+
+def _batches(n_units):
+    """yields slices of replicates that fit in BOOTSTRAP_MEMORY_MB"""
+    size = BOOTSTRAP_MEMORY_MB * 2**20 // (_ARRAYS_PER_BATCH * 8 * max(n_units, 1))
+    size = max(int(size), 1)
+    for start in range(0, N_REPLICATES, size):
+        yield slice(start, start + size)
+
+
+def _gini(weights, sorted_x):
+    """returns the Gini index of each row of weights, over values sorted_x
+
+    Args:
+        weights: (replicates x units) weights, in the order of sorted_x
+        sorted_x: values of each unit, in ascending order
+    """
+    cumw = np.cumsum(weights, axis=1)
+    weights *= sorted_x
+    cumxw = np.cumsum(weights, axis=1)
+    area = (cumxw[:, 1:] * cumw[:, :-1]).sum(axis=1)
+    area -= (cumxw[:, :-1] * cumw[:, 1:]).sum(axis=1)
+    return area / (cumxw[:, -1] * cumw[:, -1])
+
+
+def replicate_stats(rows, resources):
+    """returns the poverty rate, poverty gap, Gini index and person weight
+    of SPM units with the given resources, in every replicate
+
+    Args:
+        rows: positions in spmu of the units to include
+        resources: resources of each of those units
+
+    Returns:
+        dict of arrays with one value per replicate
+    """
+    spmu = data.microdata().spmu
+    counts = replicate_counts()[:, rows]
+    person_w = data.unit_person_weights()[rows]
+    spmwt = spmu.spmwt.to_numpy()[rows]
+    thresh = spmu.spmthresh.to_numpy()[rows]
+    per_person = resources / spmu.numper.to_numpy()[rows]
+    order = np.argsort(per_person)
+
+    poor_w = person_w * (resources < thresh)
+    gap_w = spmwt * np.maximum(thresh - resources, 0)
+
+    stats = {
+        name: np.empty(N_REPLICATES)
+        for name in ["population", "poverty_rate", "poverty_gap", "gini"]
+    }
+    for batch in _batches(len(rows)):
+        weights = counts[batch].astype(np.float64)
+        population = weights @ person_w
+        stats["population"][batch] = population
+        stats["poverty_rate"][batch] = (weights @ poor_w) / population
+        stats["poverty_gap"][batch] = weights @ gap_w
+        stats["gini"][batch] = _gini(
+            weights[:, order] * person_w[order], per_person[order]
+        )
+    return stats
+
+
+def _state_rows(state, year=None):
+    spmu = data.microdata().spmu
+    if year is not None:
+        spmu = data.year_partition(year).spmu
+    if state != "US":
+        spmu = spmu[spmu.state == state]
+    return spmu.index.to_numpy()
+
+
+@data.per_version
+def baseline_stats(state, year=None):
+    """returns replicate_stats() before any reform for state (or "US"),
+    in one survey year or all of them
+    """
+    spmu = data.microdata().spmu
+    rows = _state_rows(state, year)
+    return replicate_stats(rows, spmu.spmtotres.to_numpy()[rows])
+
+
+def _interval(values):
+    tail = (1 - CONFIDENCE_LEVEL) / 2 * 100
+    return tuple(np.nanpercentile(values, [tail, 100 - tail]))
+
+
+def intervals(state, target_spmu, year=None):
+    """returns confidence intervals for the outcomes of a reform
+
+    Args:
+        state: state selected in the dropdown, or "US"
+        target_spmu: rows of spmu for state, with the reform's
+            new_resources column as computed in compute_outputs()
+        year: the survey year of target_spmu, None if all years are pooled
+
+    Returns:
+        dict of (low, high) tuples for the relative changes in
+        "poverty_rate", "poverty_gap" and "gini", and "winners", the
+        percent of people better off
+    """
+    rows = target_spmu.index.to_numpy()
+    new_resources = target_spmu.new_resources.to_numpy()
+    baseline = baseline_stats(state, year)
+    reform = replicate_stats(rows, new_resources)
+
+    results = {
+        metric: _interval((reform[metric] - baseline[metric]) / baseline[metric])
+        for metric in ["poverty_rate", "poverty_gap", "gini"]
+    }
+
+    winner_w = data.unit_person_weights()[rows] * (
+        new_resources > target_spmu.spmtotres.to_numpy()
+    )
+    winners = np.empty(N_REPLICATES)
+    counts = replicate_counts()[:, rows]
+    for batch in _batches(len(rows)):
+        winners[batch] = counts[batch].astype(np.float64) @ winner_w
+    results["winners"] = _interval(winners / reform["population"] * 100)
+    return results
@@ -0,0 +1,281 @@
+"""In-memory result cache shared by the threads of a worker.
+
+Concurrent requests for the same key are coalesced: the first one computes
+the result and the others wait for it. A computation is abandoned at its next
+checkpoint() once every request waiting for it has been superseded by a newer
+request from the same session, see LatestRequests.
+"""
+import collections
+import contextlib
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    """raised when every request waiting for a result has been superseded"""
+
+
+def checkpoint():
+    """raises Cancelled if nobody still wants the result being computed
+
+    Call between expensive steps of a computation run by ResultCache.get();
+    does nothing when called from anywhere else.
+    """
+    call = getattr(_local, "call", None)
+    if call is not None and call.cancelled():
+        raise Cancelled()
+
+
+def current_is_stale():
+    """returns the cancelled() check of the computation ResultCache.get() is
+    running in this thread, or None outside of one
+
+    Passed as is_stale to a ResultCache.get() nested in a computation, the
+    nested computation is abandoned along with the outer one.
+    """
+    call = getattr(_local, "call", None)
+    return call.cancelled if call is not None else None
+
+
+@contextlib.contextmanager
+def uncached():
+    """makes every ResultCache.get() in the block compute its result afresh,
+    e.g. to profile a whole computation
+
+    Results are neither read from nor stored in the caches, only reused
+    within the block, so a stage is computed once however many others
+    need it.
+    """
+    _local.uncached = {}
+    try:
+        yield
+    finally:
+        _local.uncached = None
+
+
+# the arrays of data shared by every result, by id, see share()
+_shared = weakref.WeakValueDictionary()
+
+
+def _owner(array):
+    """returns the array whose memory array is a view of, or array itself"""
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+
+def _frame_arrays(frame):
+    """yields the arrays holding the columns and index of a dataframe or
+    series"""
+    columns = frame.items() if isinstance(frame, pd.DataFrame) else [(None, frame)]
+    for _, column in columns:
+        values = column.array
+        if isinstance(values, pd.Categorical):
+            yield values.codes
+        else:
+            yield np.asarray(values)
+    if not isinstance(frame.index, pd.RangeIndex):
+        yield frame.index.to_numpy()
+
+
+def share(*objects):
+    """marks the arrays of objects as owned outside of any result, so
+    nbytes() does not count them, e.g. the microdata results are views of
+
+    objects are arrays or dataframes, or dicts, lists and tuples of them.
+    """
+    for array in _arrays(objects):
+        owner = _owner(array)
+        _shared[id(owner)] = owner
+
+
+def _arrays(result):
+    if isinstance(result, np.ndarray):
+        yield result
+    elif isinstance(result, (pd.DataFrame, pd.Series)):
+        yield from _frame_arrays(result)
+    elif isinstance(result, dict):
+        for value in result.values():
+            yield from _arrays(value)
+    elif isinstance(result, (list, tuple)):
+        for value in result:
+            yield from _arrays(value)
+
+
+def nbytes(result):
+    """returns the memory held by the arrays and dataframes in result, which
+    may be nested in dicts, lists and tuples
+
+    Only memory result owns is counted: each array once however many
+    dataframes and views share it, and neither memory-mapped files nor the
+    arrays of share(), such as the microdata that shallow copies reference.
+    """
+    owners = {}
+    for array in _arrays(result):
+        owner = _owner(array)
+        if id(owner) not in _shared and not isinstance(owner, np.memmap):
+            owners[id(owner)] = owner
+    return sum(owner.nbytes for owner in owners.values())
+
+
+def _never_stale():
+    return False
+
+
+class _Call:
+    """one in-flight computation and the requests waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # one is_stale() callable per waiting request
+        self.waiters = []
+
+    def cancelled(self):
+        return all(is_stale() for is_stale in list(self.waiters))
+
+
+class ResultCache:
+    """Thread-safe LRU cache of the results of compute(*key)
+
+    Args:
+        maxsize: number of results to keep, least recently used are dropped
+        maxbytes: optional bound on the nbytes() of the results kept, least
+            recently used are dropped until they fit (the newest is kept)
+    """
+
+    def __init__(self, maxsize, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._results = collections.OrderedDict()
+        # nbytes() of each result, only tracked when maxbytes is set
+        self._sizes = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._results
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def discard(self, predicate):
+        """drops the results whose key predicate(key) is True for"""
+        with self._lock:
+            for key in [key for key in self._results if predicate(key)]:
+                del self._results[key]
+                self.nbytes -= self._sizes.pop(key, 0)
+
+    def get(self, key, compute, is_stale=None):
+        """returns compute(*key), computing it at most once at a time per key
+
+        Args:
+            key: tuple of hashable arguments of compute
+            compute: function to call on a cache miss
+            is_stale: optional function returning True once the caller no
+                longer needs the result, see LatestRequests.start()
+
+        Raises:
+            Cancelled: if the caller became stale before the result was ready
+        """
+        fresh = getattr(_local, "uncached", None)
+        if fresh is not None:
+            if (self, key) not in fresh:
+                fresh[self, key] = compute(*key)
+            return fresh[self, key]
+        is_stale = is_stale or _never_stale
+        while True:
+            with self._lock:
+                if key in self._results:
+                    self.hits += 1
+                    self._results.move_to_end(key)
+                    return self._results[key]
+                if is_stale():
+                    raise Cancelled()
+                call = self._in_flight.get(key)
+                leader = call is None
+                if leader:
+                    self.misses += 1
+                    call = self._in_flight[key] = _Call()
+                call.waiters.append(is_stale)
+
+            if leader:
+                self._run(key, compute, call)
+            else:
+                call.done.wait()
+
+            if isinstance(call.error, Cancelled) and not is_stale():
+                # abandoned by everyone else after this request joined, retry
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def _run(self, key, compute, call):
+        # computations can nest, see current_is_stale()
+        outer = getattr(_local, "call", None)
+        _local.call = call
+        try:
+            call.result = compute(*key)
+        except Exception as error:
+            call.error = error
+        finally:
+            _local.call = outer
+            with self._lock:
+                del self._in_flight[key]
+                if call.error is None:
+                    self._results[key] = call.result
+                    if self.maxbytes is not None:
+                        self._sizes[key] = nbytes(call.result)
+                        self.nbytes += self._sizes[key]
+                    while len(self._results) > self.maxsize or (
+                        self.nbytes > (self.maxbytes or 0) and len(self._results) > 1
+                    ):
+                        oldest, _ = self._results.popitem(last=False)
+                        self.nbytes -= self._sizes.pop(oldest, 0)
+            call.done.set()
+
+
+class LatestRequests:
+    """Tracks the newest request of each session
+
+    Args:
+        maxsize: number of sessions to remember, older ones are forgotten
+            and their requests are then never considered stale
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._latest = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, session):
+        """records a new request from session
+
+        Returns:
+            function returning True once a newer request from the same
+            session has started
+        """
+        with self._lock:
+            number = self._latest.pop(session, 0) + 1
+            self._latest[session] = number
+            if len(self._latest) > self.maxsize:
+                self._latest.popitem(last=False)
+
+        return lambda: self._latest.get(session, number) != number
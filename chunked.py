@@ -0,0 +1,362 @@
+"""Out-of-core simulation, for microdata too large to hold in every worker.
+
+`python chunked.py OUT_DIR` converts person.csv.gz and spmu.csv.gz into one
+directory per state of raw column files. With CHUNKED_DATA_DIR=OUT_DIR the
+app memory-maps these files instead of loading data.microdata(), and
+simulate() reads CHUNK_ROWS SPM units at a time, so memory use is bounded
+whatever the size of the files.
+
+Poverty status, winning and resources per person are the same for everyone
+in an SPM unit, so each unit stores the sum of its members' weights
+(person_weight) for the person-level statistics. Persons are only kept for
+the poverty breakdown, as their demog_code and weight, sorted by unit so the
+persons of a chunk of units are a slice.
+
+simulate() makes two passes over the units:
+    1. revenue and UBI population, which set the UBI amount
+    2. sums for poverty, poverty gap, total resources and winners, and a
+       weighted histogram of resources per person for the Gini index
+
+The histogram has GINI_BINS bins evenly spaced in asinh(resources per
+person), so they are narrow for typical resources and wide only in the
+tails. Bins are ordered, so pairs of persons in different bins contribute
+exactly to the Gini index and only pairs within a bin are lost: the result
+is a lower bound, at most gini_error below the exact index.
+"""
+import functools
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+import data
+import reform
+
+# directory written by `python chunked.py`, unset to hold the data in memory,
+# read in data.py so app.py checks it without importing this module
+CHUNKED_DATA_DIR = data.CHUNKED_DATA_DIR
+# SPM units read into memory at a time
+CHUNK_ROWS = int(os.environ.get("CHUNK_ROWS", 2**18))
+GINI_BINS = 2**16
+# resources per person below which bins are evenly spaced in dollars
+GINI_BIN_SCALE = 1000.0
+
+# spmu columns kept for each unit, plus the sum of its person weights
+UNIT_COLUMNS = dict(
+    {col: dtype for col, dtype in data.SPMU_COLUMNS.items() if dtype != "category"},
+    person_weight="float64",
+)
+# columns of each person, sorted by unit, the row of their unit in the state
+PERSON_COLUMNS = {"unit": "int64", "demog_code": "uint8", "asecwt": "float64"}
+
+MANIFEST = "manifest.json"
+
+
+# ---------------------------------------------------------------------------- #
+#                       SECTION write partitions                               #
+# ---------------------------------------------------------------------------- #
+
+
+def _append(directory, df, dtypes):
+    """appends the columns of df to raw column files in directory"""
+    os.makedirs(directory, exist_ok=True)
+    for col, dtype in dtypes.items():
+        with open(os.path.join(directory, col + ".bin"), "ab") as f:
+            np.asarray(df[col], dtype=dtype).tofile(f)
+
+
+def _read_columns(directory, dtypes):
+    return {
+        col: np.fromfile(os.path.join(directory, col + ".bin"), dtype=dtype)
+        for col, dtype in dtypes.items()
+    }
+
+
+def write_partitions(out_dir, chunk_rows=CHUNK_ROWS):
+    """converts the csv files in data.DATA_DIR into partitions in out_dir
+
+    The csv files are read chunk_rows at a time. Persons are matched to
+    their SPM unit one state at a time, so memory use is bounded by the
+    size of the largest state.
+    """
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    spmu_dtypes = dict(data.SPMU_COLUMNS, state="str")
+    unit_dtypes = dict(UNIT_COLUMNS)
+    del unit_dtypes["person_weight"]
+    years = set()
+    states = set()
+    for chunk in pd.read_csv(
+        data._path("spmu.csv.gz"),
+        usecols=list(spmu_dtypes),
+        dtype=spmu_dtypes,
+        chunksize=chunk_rows,
+    ):
+        years.update(chunk.year.unique().tolist())
+        for state, rows in chunk.groupby("state"):
+            states.add(state)
+            _append(os.path.join(out_dir, state), rows, unit_dtypes)
+
+    # persons of each state with the key of their unit, matched below
+    person_dtypes = dict(data.PERSON_COLUMNS, state="str")
+    key_dtypes = {
+        "spmfamunit": "int64",
+        "year": "int16",
+        "demog_code": "uint8",
+        "asecwt": "float64",
+    }
+    for chunk in pd.read_csv(
+        data._path("person.csv.gz"),
+        usecols=lambda col: col in person_dtypes,
+        dtype=person_dtypes,
+        chunksize=chunk_rows,
+    ):
+        chunk["demog_code"] = data.demog_codes(chunk)
+        for state, rows in chunk.groupby("state"):
+            _append(os.path.join(out_dir, state, "person_keys"), rows, key_dtypes)
+
+    sizes = {}
+    for state in sorted(states):
+        directory = os.path.join(out_dir, state)
+        persons = _read_columns(os.path.join(directory, "person_keys"), key_dtypes)
+        units = _read_columns(directory, {"spmfamunit": "int64", "year": "int16"})
+        keys = pd.MultiIndex.from_arrays([units["spmfamunit"], units["year"]])
+        unit = keys.get_indexer(
+            pd.MultiIndex.from_arrays([persons["spmfamunit"], persons["year"]])
+        )
+        order = np.argsort(unit, kind="stable")
+        order = order[unit[order] >= 0]
+        _append(
+            os.path.join(directory, "persons"),
+            {
+                "unit": unit[order],
+                "demog_code": persons["demog_code"][order],
+                "asecwt": persons["asecwt"][order],
+            },
+            PERSON_COLUMNS,
+        )
+        person_weight = np.bincount(unit[order], persons["asecwt"][order], len(keys))
+        _append(
+            directory, {"person_weight": person_weight}, {"person_weight": "float64"}
+        )
+        shutil.rmtree(os.path.join(directory, "person_keys"))
+        sizes[state] = len(keys)
+
+    with open(os.path.join(out_dir, MANIFEST), "w") as f:
+        json.dump({"rows": sizes, "years": sorted(int(y) for y in years)}, f)
+
+
+# ---------------------------------------------------------------------------- #
+#                       SECTION simulate                                       #
+# ---------------------------------------------------------------------------- #
+
+
+def _memmap(directory, dtypes):
+    """returns {column: read-only memory-mapped array} of raw column files"""
+    return {
+        col: np.memmap(os.path.join(directory, col + ".bin"), dtype=dtype, mode="r")
+        for col, dtype in dtypes.items()
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def partitions():
+    """returns {state: (units, persons)}, each a dict of memory-mapped
+    columns, and the survey years of the files in CHUNKED_DATA_DIR
+    """
+    with open(os.path.join(CHUNKED_DATA_DIR, MANIFEST)) as f:
+        manifest = json.load(f)
+    columns = {
+        state: (
+            _memmap(os.path.join(CHUNKED_DATA_DIR, state), UNIT_COLUMNS),
+            _memmap(os.path.join(CHUNKED_DATA_DIR, state, "persons"), PERSON_COLUMNS),
+        )
+        for state, rows in manifest["rows"].items()
+        # np.memmap can not map empty files
+        if rows
+    }
+    return columns, manifest["years"]
+
+
+def _chunks(states, year, with_persons=False):
+    """yields dicts of in-memory column arrays, CHUNK_ROWS units at a time
+
+    Args:
+        states: states whose partitions to read
+        year: only read units of this survey year, with weights scaled to
+            annual totals, or None for all years
+        with_persons: also yield the persons of the units, whose "unit"
+            column is then a row of the chunk
+    """
+    columns, years = partitions()
+    for state in states:
+        if state not in columns:
+            continue
+        units, persons = columns[state]
+        n = len(units["spmwt"])
+        for start in range(0, n, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, n)
+            chunk = {col: values[start:stop] for col, values in units.items()}
+            if with_persons:
+                # persons are sorted by unit, so those of the chunk are a slice
+                first, last = np.searchsorted(persons["unit"], [start, stop])
+                chunk_persons = {
+                    col: values[first:last] for col, values in persons.items()
+                }
+                chunk_persons["unit"] = chunk_persons["unit"] - start
+            if year is not None:
+                rows = chunk["year"] == year
+                chunk = {col: values[rows] for col, values in chunk.items()}
+                for col in ["spmwt", "person_weight"]:
+                    chunk[col] = chunk[col] * len(years)
+                if with_persons:
+                    keep = rows[chunk_persons["unit"]]
+                    chunk_persons = {
+                        col: values[keep] for col, values in chunk_persons.items()
+                    }
+                    # rows of the units that are kept
+                    chunk_persons["unit"] = (np.cumsum(rows) - 1)[chunk_persons["unit"]]
+                    chunk_persons["asecwt"] = chunk_persons["asecwt"] * len(years)
+            if with_persons:
+                yield chunk, chunk_persons
+            else:
+                yield chunk
+
+
+def _gini_bin(per_person, low, high):
+    """returns the Gini histogram bin of each value, see GINI_BINS"""
+    scaled = np.arcsinh(per_person / GINI_BIN_SCALE)
+    bins = (scaled - low) / (high - low) * GINI_BINS
+    return np.clip(bins.astype(np.int64), 0, GINI_BINS - 1)
+
+
+def _histogram_gini(weights, weighted_values, low, high):
+    """returns the Gini index of a histogram and the most it is below the
+    exact index, see the module docstring
+    """
+    cumw = np.cumsum(weights)
+    cumxw = np.cumsum(weighted_values)
+    denominator = cumxw[-1] * cumw[-1]
+    gini = np.sum(cumxw[1:] * cumw[:-1] - cumxw[:-1] * cumw[1:]) / denominator
+    edges = GINI_BIN_SCALE * np.sinh(np.linspace(low, high, GINI_BINS + 1))
+    error = np.sum(weights**2 * np.diff(edges)) / 2 / denominator
+    return gini, error
+
+
+def simulate(state, level, agi_tax, benefits, taxes, include, year=None):
+    """runs a reform over the partitions in CHUNKED_DATA_DIR
+
+    Args:
+        state: state selected in the dropdown, or "US"
+        level, agi_tax, benefits, taxes, include: see app.compute_outputs()
+        year: a single survey year, or None to pool every year
+
+    Returns:
+        dict of the reform's totals: revenue, ubi_annual, ubi_population,
+        state_ubi_population, total_resources, poverty_gap, total_poor
+        (person weight in poverty), gini and its gini_error, total_winners
+        (person weight better off), poor_by_code and population_by_code,
+        the person weights in poverty and in total of each
+        data.N_DEMOG_CODES demog_code, and decile_change and decile_winners, the
+        average change in resources per person and percent better off by
+        baseline income decile
+    """
+    all_states = list(partitions()[0])
+    target_states = all_states if state == "US" else [state]
+    funding_states = all_states if level == "federal" else target_states
+    spec = reform.from_inputs(level, agi_tax, benefits, taxes, include)
+    resource_terms = reform.resource_terms(spec)
+    pre_ubi_plan = reform.compile_plan(resource_terms, base="spmtotres")
+    numper_ubi_plan = reform.compile_plan(reform.eligibility_terms(include))
+
+    # pass 1: revenue and UBI population, and the range of resources
+    revenue = ubi_population = state_ubi_population = 0.0
+    low, high = np.inf, -np.inf
+    for funding_state in funding_states:
+        for chunk in _chunks([funding_state], year):
+            resources = reform.evaluate(pre_ubi_plan, chunk)
+            numper_ubi = reform.evaluate(numper_ubi_plan, chunk)
+            revenue += np.sum(chunk["spmwt"] * (chunk["spmtotres"] - resources))
+            unit_ubi_population = np.sum(chunk["spmwt"] * numper_ubi)
+            ubi_population += unit_ubi_population
+            if funding_state in target_states:
+                state_ubi_population += unit_ubi_population
+                per_person = resources / chunk["numper"]
+                if len(per_person):
+                    low = min(low, per_person.min())
+                    high = max(high, per_person.max())
+    ubi_annual = revenue / ubi_population
+
+    # everyone's UBI is between 0 and ubi_annual per person
+    low = np.arcsinh((low + min(ubi_annual, 0)) / GINI_BIN_SCALE)
+    high = np.arcsinh((high + max(ubi_annual, 0)) / GINI_BIN_SCALE)
+    high = max(high, np.nextafter(low, np.inf))
+
+    # pass 2: sums over the target population, with resources after the UBI
+    # in one fused expression
+    plan = reform.compile_plan(
+        resource_terms, base="spmtotres", scaled=reform.eligibility_terms(include)
+    )
+    totals = dict.fromkeys(
+        ["total_resources", "poverty_gap", "total_poor", "total_winners"], 0.0
+    )
+    poor_by_code = np.zeros(data.N_DEMOG_CODES)
+    population_by_code = np.zeros(data.N_DEMOG_CODES)
+    gini_weights = np.zeros(GINI_BINS)
+    gini_weighted_values = np.zeros(GINI_BINS)
+    decile_column = "decile_us" if state == "US" else "decile_state"
+    decile_population = np.zeros(data.N_DECILES)
+    decile_change = np.zeros(data.N_DECILES)
+    decile_winners = np.zeros(data.N_DECILES)
+    for chunk, persons in _chunks(target_states, year, with_persons=True):
+        resources = reform.evaluate(plan, chunk, scale=ubi_annual)
+        person_weight = chunk["person_weight"]
+        poor = resources < chunk["spmthresh"]
+        totals["total_resources"] += np.sum(resources * chunk["spmwt"])
+        totals["poverty_gap"] += np.sum(
+            chunk["spmwt"] * np.maximum(chunk["spmthresh"] - resources, 0)
+        )
+        totals["total_poor"] += np.sum(person_weight * poor)
+        winner = resources > chunk["spmtotres"]
+        totals["total_winners"] += np.sum(person_weight * winner)
+        codes = persons["demog_code"]
+        poor_by_code += np.bincount(
+            codes, persons["asecwt"] * poor[persons["unit"]], data.N_DEMOG_CODES
+        )
+        population_by_code += np.bincount(codes, persons["asecwt"], data.N_DEMOG_CODES)
+
+        per_person = resources / chunk["numper"]
+        deciles = chunk[decile_column]
+        decile_population += np.bincount(deciles, person_weight, data.N_DECILES)
+        decile_change += np.bincount(
+            deciles,
+            person_weight * (per_person - chunk["spmtotres"] / chunk["numper"]),
+            data.N_DECILES,
+        )
+        decile_winners += np.bincount(deciles, person_weight * winner, data.N_DECILES)
+
+        bins = _gini_bin(per_person, low, high)
+        gini_weights += np.bincount(bins, person_weight, GINI_BINS)
+        gini_weighted_values += np.bincount(bins, person_weight * per_person, GINI_BINS)
+
+    gini, gini_error = _histogram_gini(gini_weights, gini_weighted_values, low, high)
+    return dict(
+        totals,
+        revenue=revenue,
+        ubi_annual=ubi_annual,
+        ubi_population=ubi_population,
+        state_ubi_population=state_ubi_population,
+        gini=gini,
+        gini_error=gini_error,
+        poor_by_code=poor_by_code,
+        population_by_code=population_by_code,
+        decile_change=decile_change / decile_population,
+        decile_winners=decile_winners / decile_population * 100,
+    )
+
+
+if __name__ == "__main__":
+    write_partitions(sys.argv[1])
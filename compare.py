@@ -0,0 +1,96 @@
+"""Two reforms side by side, for the compare mode of the dashboard.
+
+A reform is pinned with its levers (level, tax rate, repeals and include
+checklist) and compared with the current inputs, for the state and survey
+year currently selected, so both reforms are measured on the same people
+against the same baseline.
+"""
+import dash_bootstrap_components as dbc
+import pandas as pd
+from numerize import numerize
+
+# names of the levers in the dashboard, for describe()
+REPEAL_NAMES = {
+    "fedtaxac": "income taxes",
+    "fica": "employee payroll taxes",
+    "ctc": "Child Tax Credit",
+    "incssi": "SSI",
+    "spmsnap": "SNAP",
+    "eitcred": "EITC",
+    "incunemp": "unemployment benefits",
+    "spmheat": "LIHEAP",
+}
+INCLUDE_NAMES = {
+    "adults": "adults",
+    "children": "children",
+    "non_citizens": "non-citizens",
+}
+
+
+def describe(levers):
+    """returns a one line description of a reform's levers
+
+    Args:
+        levers: dict of level, agi_tax, benefits, taxes and include
+    """
+    repeals = levers["taxes"] + levers["benefits"]
+    if levers["level"] == "state":
+        # see app.scenario_key()
+        repeals = [tax for tax in levers["taxes"] if tax == "fedtaxac"]
+    return "{} {}% tax on AGI{}, UBI for {}".format(
+        levers["level"].capitalize(),
+        levers["agi_tax"],
+        "".join(", repeal " + REPEAL_NAMES[repeal] for repeal in repeals),
+        " and ".join(INCLUDE_NAMES[group] for group in levers["include"]) or "nobody",
+    )
+
+
+def _signed_dollars(value):
+    return ("+$" if value >= 0 else "-$") + "{:,.0f}".format(abs(value))
+
+
+def _signed_billions(value):
+    return ("+$" if value >= 0 else "-$") + numerize.numerize(abs(value), 1)
+
+
+# label, column, format of the values, format of the difference
+METRICS = [
+    ("Monthly UBI", "monthly_ubi", "${:,.0f}".format, _signed_dollars),
+    (
+        "Funds for UBI",
+        "revenue",
+        lambda value: "$" + numerize.numerize(value, 1),
+        _signed_billions,
+    ),
+    ("Better off", "percent_winners", "{:.1f}%".format, "{:+.1f} pp".format),
+    (
+        "Change in resources per person",
+        "change_pp",
+        _signed_dollars,
+        _signed_dollars,
+    ),
+    ("Poverty rate", "poverty_rate_change", "{:+.1%}".format, "{:+.1%}".format),
+    ("Poverty gap", "poverty_gap_change", "{:+.1%}".format, "{:+.1%}".format),
+    ("Gini index", "gini_change", "{:+.1%}".format, "{:+.1%}".format),
+]
+
+
+def comparison_table(a, b):
+    """returns the delta table of two reforms
+
+    Args:
+        a, b: dicts of the results of reform A and reform B, with the
+            columns of METRICS
+
+    Returns:
+        dbc.Table of the metrics of each reform and of B minus A
+    """
+    table = pd.DataFrame(
+        {
+            "": [label for label, _, _, _ in METRICS],
+            "Reform A": [fmt(a[column]) for _, column, fmt, _ in METRICS],
+            "Reform B": [fmt(b[column]) for _, column, fmt, _ in METRICS],
+            "B − A": [delta(b[column] - a[column]) for _, column, _, delta in METRICS],
+        }
+    )
+    return dbc.Table.from_dataframe(table, bordered=False, hover=True, size="sm")
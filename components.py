@@ -1,12 +1,4 @@
-import pandas as pd
-import numpy as np
-import plotly.graph_objects as go
-import plotly.express as px
-import dash
-import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-import dash_bootstrap_components as dbc
 
 DARK_BLUE = "#1565C0"
 
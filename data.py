@@ -0,0 +1,631 @@
+"""Loads the pre-processed data files written by pre-processing.py.
+
+The microdata (person.npz, spmu.csv.gz) is only read on first use, so
+importing the app stays cheap. In production wsgi.py calls microdata() in the
+gunicorn master before workers are forked, so every worker shares the parsed
+arrays copy-on-write instead of parsing its own copy.
+
+The app reads persons from a slim serving store, see person_store(), while
+person.csv.gz keeps every column for offline analysis.
+
+spmu is sorted by survey year and persons by their unit, so the rows of one
+year are a contiguous slice of the shared arrays, see year_partition().
+
+With DATA_RELEASES set, the files are read from the current release written
+by releases.py instead of DATA_DIR. A release stores the microdata as
+memory-mapped .npy columns, so every worker maps the same pages, and a new
+release is switched to between requests without restarting, see
+warmup.watch_releases(). Each request reads the Dataset that was current
+when it started until it finishes, see pin(), and everything derived from
+the data is cached per Dataset, see per_version().
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import cache
+import reform
+
+# directory holding the .csv.gz files, defaults to the repo root
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+# directory of the versioned releases written by releases.py, if any
+DATA_RELEASES = os.environ.get("DATA_RELEASES")
+# directory of the partitions of chunked.py, streamed instead of holding the
+# microdata in memory, if any
+CHUNKED_DATA_DIR = os.environ.get("CHUNKED_DATA_DIR")
+# file of DATA_RELEASES naming the current release, and of each release
+# listing its columns
+CURRENT = "CURRENT"
+RELEASE_MANIFEST = "manifest.json"
+
+# the columns of person.csv.gz the serving store is built from
+PERSON_COLUMNS = {
+    "spmfamunit": "int64",
+    "year": "int16",
+    "spmthresh": "float64",
+    "spmtotres": "float64",
+    "asecwt": "float64",
+    "state": "category",
+    "child": "bool",
+    "adult": "bool",
+    "pwd": "bool",
+    "white": "bool",
+    "black": "bool",
+    "hispanic": "bool",
+}
+# the serving store of persons, see person_store()
+PERSON_STORE_COLUMNS = {"unit": "int32", "asecwt": "float64", "demog_code": "uint8"}
+SPMU_COLUMNS = {
+    "spmfamunit": "int64",
+    "year": "int16",
+    "state": "category",
+    "spmthresh": "float64",
+    "spmtotres": "float64",
+    "spmwt": "float64",
+    "spmheat": "float64",
+    "spmsnap": "float64",
+    "adjginc": "float64",
+    "fica": "float64",
+    "fedtaxac": "float64",
+    "stataxac": "float64",
+    "ctc": "float64",
+    "incssi": "float64",
+    "incunemp": "float64",
+    "eitcred": "float64",
+    "numper": "int64",
+    "child": "int64",
+    "adult": "int64",
+    "non_citizen": "int64",
+    "non_citizen_child": "int64",
+    "non_citizen_adult": "int64",
+    # baseline income decile of each unit, see income_deciles()
+    "decile_us": "int8",
+    "decile_state": "int8",
+}
+
+# spmu columns whose weighted totals by state and year are pre-computed, see
+# weighted_totals(): every repealable tax and benefit, the AGI taxed by the
+# flat tax (positive_adjginc at the federal level) and the people counted in
+# the UBI population
+WEIGHTED_TOTAL_COLUMNS = [
+    "fedtaxac",
+    "fica",
+    "stataxac",
+    "ctc",
+    "eitcred",
+    "incssi",
+    "spmsnap",
+    "incunemp",
+    "spmheat",
+    "adjginc",
+    "positive_adjginc",
+    "numper",
+    "child",
+    "adult",
+    "non_citizen",
+    "non_citizen_child",
+    "non_citizen_adult",
+]
+
+N_DECILES = 10
+
+# bit of each person flag in demog_code, so any intersection of flags is a
+# set of codes, see demog_codes()
+DEMOG_BITS = {"child": 1, "adult": 2, "pwd": 4, "white": 8, "black": 16, "hispanic": 32}
+N_DEMOG_CODES = 2 ** len(DEMOG_BITS)
+
+# bit of each include-checklist value in include_code()
+INCLUDE_BITS = {"adults": 1, "children": 2, "non_citizens": 4}
+
+Microdata = namedtuple("Microdata", ["person", "spmu"])
+BaselineStats = namedtuple("BaselineStats", ["all_state_stats", "demog_stats"])
+
+
+class Dataset:
+    """the data files of one directory, and everything derived from them
+
+    Args:
+        directory: DATA_DIR, or a release in DATA_RELEASES
+        version: name of the data, the release name or None for DATA_DIR
+    """
+
+    def __init__(self, directory, version=None):
+        self.directory = directory
+        self.version = version
+        self._values = {}
+        # a lock per value, so each is computed once and others meanwhile
+        self._locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def cached(self, function, args):
+        """returns function(*args), computed once for this dataset"""
+        key = (function, args)
+        with self._lock:
+            lock = self._locks[key]
+        with lock:
+            if key not in self._values:
+                self._values[key] = function(*args)
+        return self._values[key]
+
+
+def release(version):
+    """returns the Dataset of a release in DATA_RELEASES"""
+    return Dataset(os.path.join(DATA_RELEASES, version), version)
+
+
+def current_release():
+    """returns the name of the current release in DATA_RELEASES"""
+    with open(os.path.join(DATA_RELEASES, CURRENT)) as f:
+        return f.read().strip()
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_current = None
+
+
+def current():
+    """returns the Dataset new requests read"""
+    global _current
+    with _lock:
+        if _current is None:
+            if DATA_RELEASES:
+                _current = release(current_release())
+            else:
+                _current = Dataset(DATA_DIR)
+    return _current
+
+
+def activate(dataset):
+    """makes dataset the one new requests read, requests already running
+    keep reading theirs"""
+    global _current
+    with _lock:
+        _current = dataset
+
+
+def dataset():
+    """returns the Dataset pinned to this thread, or the current one"""
+    pinned = getattr(_local, "dataset", None)
+    return pinned if pinned is not None else current()
+
+
+def version():
+    """returns the version of dataset(), part of the cache keys of results"""
+    return dataset().version
+
+
+def pin(target=None):
+    """makes this thread read target, by default the Dataset it reads now,
+    until unpin(), e.g. for the whole of a request"""
+    _local.dataset = target or dataset()
+
+
+def unpin():
+    _local.dataset = None
+
+
+@contextlib.contextmanager
+def pinned(target=None):
+    """reads target, by default the Dataset read now, in the block"""
+    outer = getattr(_local, "dataset", None)
+    pin(target)
+    try:
+        yield
+    finally:
+        _local.dataset = outer
+
+
+def pinned_iter(iterable):
+    """yields from iterable reading the Dataset this thread reads now, e.g.
+    for a response streamed after its request has ended"""
+    target = dataset()
+    iterator = iter(iterable)
+    while True:
+        with pinned(target):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def per_version(function):
+    """like functools.cache, but cached in dataset(), so a value derived
+    from the data is dropped along with it and never outlives a switch"""
+
+    @functools.wraps(function)
+    def wrapper(*args):
+        return dataset().cached(function, args)
+
+    return wrapper
+
+
+def _path(filename):
+    return dataset().path(filename)
+
+
+def _read(filename, columns):
+    df = pd.read_csv(_path(filename), usecols=lambda col: col in columns, dtype=columns)
+    # pre-processing.py writes rows in year order, sort older files here
+    if not df.year.is_monotonic_increasing:
+        df = df.sort_values("year", kind="stable")
+    return df.reset_index(drop=True)
+
+
+def release_manifest():
+    """returns the manifest of the current release, None outside of one"""
+    if not os.path.exists(_path(RELEASE_MANIFEST)):
+        return None
+    with open(_path(RELEASE_MANIFEST)) as f:
+        return json.load(f)
+
+
+def _mapped(table, columns, categories):
+    """returns the columns of a table of a release, memory-mapped read-only"""
+    frame = {}
+    for col in columns:
+        values = np.load(_path(os.path.join(table, col + ".npy")), mmap_mode="r")
+        if col in categories:
+            values = pd.Categorical.from_codes(values, categories[col])
+        frame[col] = values
+    # without copying, so the rows stay in the shared pages
+    return pd.DataFrame(frame, copy=False)
+
+
+def mapped_array(name):
+    """returns an array precomputed by releases.py, or None"""
+    path = _path(name + ".npy")
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+@per_version
+def microdata():
+    """returns the person and spmu tables, reading them on first call"""
+    manifest = release_manifest()
+    if manifest is not None:
+        categories = manifest["categories"]
+        return _shared_microdata(
+            person=_mapped("person", PERSON_STORE_COLUMNS, categories),
+            spmu=_mapped("spmu", SPMU_COLUMNS, categories),
+        )
+    spmu = _read("spmu.csv.gz", SPMU_COLUMNS)
+    if os.path.exists(_path("person.npz")):
+        with np.load(_path("person.npz")) as store:
+            person = pd.DataFrame({col: store[col] for col in PERSON_STORE_COLUMNS})
+    else:
+        # files written before pre-processing.py added the store
+        person = person_store(_read("person.csv.gz", PERSON_COLUMNS), spmu)
+    if "decile_us" not in spmu:
+        spmu = spmu.join(income_deciles(spmu, _unit_weights(person, spmu)))
+    return _shared_microdata(person=person, spmu=spmu)
+
+
+def _shared_microdata(person, spmu):
+    """returns the Microdata of person and spmu, whose arrays the stages of
+    app.py reference without owning, see cache.nbytes()"""
+    tables = Microdata(person=person, spmu=spmu)
+    cache.share(tables)
+    return tables
+
+
+def demog_codes(person):
+    """returns the DEMOG_BITS flags of each person packed into a uint8"""
+    codes = np.zeros(len(person), dtype=np.uint8)
+    for demog, bit in DEMOG_BITS.items():
+        codes |= person[demog].to_numpy().astype(np.uint8) * np.uint8(bit)
+    return codes
+
+
+def demog_mask(demogs):
+    """returns the bits of demog_code a person in every group of demogs has"""
+    return sum(DEMOG_BITS[demog] for demog in demogs)
+
+
+def intersection_total(by_code, demogs):
+    """returns the sum over people in every group of demogs
+
+    Args:
+        by_code: array of N_DEMOG_CODES totals, one per demog_code, e.g.
+            np.bincount(codes, weights, N_DEMOG_CODES)
+        demogs: list of DEMOG_BITS groups, e.g. ["black", "child"]
+    """
+    mask = demog_mask(demogs)
+    return by_code[(np.arange(N_DEMOG_CODES) & mask) == mask].sum()
+
+
+def person_store(person, spmu):
+    """returns the columns of person the app needs, in compact form
+
+    Args:
+        person: person table with PERSON_COLUMNS
+        spmu: spmu table in the order the app reads it
+
+    Returns:
+        dataframe with PERSON_STORE_COLUMNS, sorted by unit: the row of the
+        person's SPM unit in spmu, their weight and their DEMOG_BITS flags
+        packed into one integer. Called by pre-processing.py, which writes
+        it to person.npz.
+    """
+    keys = pd.MultiIndex.from_arrays([spmu.spmfamunit, spmu.year])
+    unit = keys.get_indexer(pd.MultiIndex.from_arrays([person.spmfamunit, person.year]))
+    order = np.argsort(unit, kind="stable")
+    # persons without a unit are never part of the results
+    order = order[unit[order] >= 0]
+    return pd.DataFrame(
+        {
+            "unit": unit[order],
+            "asecwt": person.asecwt.to_numpy()[order],
+            "demog_code": demog_codes(person)[order],
+        }
+    ).astype(PERSON_STORE_COLUMNS)
+
+
+def _unit_weights(person, spmu):
+    """returns the sum of person weights (asecwt) in each row of spmu"""
+    return np.bincount(person.unit, person.asecwt, len(spmu))
+
+
+def _deciles(values, weights):
+    """returns the weighted decile, 0 to N_DECILES - 1, of each value"""
+    order = np.argsort(values, kind="stable")
+    sorted_w = weights[order]
+    # share of the total weight below the middle of each observation
+    share = (np.cumsum(sorted_w) - sorted_w / 2) / sorted_w.sum()
+    deciles = np.empty(len(values), dtype=np.int8)
+    deciles[order] = np.minimum(share * N_DECILES, N_DECILES - 1).astype(np.int8)
+    return deciles
+
+
+def income_deciles(spmu, person_weights):
+    """returns the baseline decile of resources per person of each row of
+    spmu, among all people (decile_us) and within its state (decile_state)
+
+    Deciles split people, so units are weighted by person_weights, the sum
+    of their members' weights. Called by pre-processing.py, which writes the
+    deciles to spmu.csv.gz.
+    """
+    per_person = (spmu.spmtotres / spmu.numper).to_numpy()
+    weights = np.asarray(person_weights)
+    deciles = pd.DataFrame(
+        {"decile_us": _deciles(per_person, weights), "decile_state": np.int8(0)},
+        index=spmu.index,
+    )
+    for rows in spmu.groupby("state", observed=True).indices.values():
+        deciles.iloc[rows, 1] = _deciles(per_person[rows], weights[rows])
+    return deciles
+
+
+def _year_slice(df, year):
+    years = df.year.to_numpy()
+    start = np.searchsorted(years, year, side="left")
+    stop = np.searchsorted(years, year, side="right")
+    return df.iloc[start:stop]
+
+
+def _unit_slice(person, units):
+    """returns the persons of a slice of spmu rows"""
+    start, stop = np.searchsorted(person.unit.to_numpy(), [units[0], units[-1] + 1])
+    return person.iloc[start:stop]
+
+
+def year_partition(year):
+    """returns the person and spmu rows of a single survey year
+
+    These are slices of the shared tables, not copies, and keep their row
+    labels, which are positions in the full tables. Weights are still those
+    of the pooled data, multiply them by pooled_years() for annual totals.
+    """
+    person, spmu = microdata()
+    spmu = _year_slice(spmu, year)
+    return Microdata(person=_unit_slice(person, spmu.index), spmu=spmu)
+
+
+def pooled_years():
+    """returns the number of survey years the weights are divided between"""
+    return microdata().spmu.year.nunique()
+
+
+@per_version
+def unit_person_weights():
+    """returns the sum of person weights (asecwt) in each row of spmu"""
+    precomputed = mapped_array("unit_person_weights")
+    if precomputed is not None:
+        return precomputed
+    return _unit_weights(*microdata())
+
+
+def include_code(include):
+    """returns the row of eligible_counts() for the include-checklist value"""
+    return sum(INCLUDE_BITS[group] for group in include)
+
+
+@per_version
+def eligible_counts():
+    """returns the number of people recieving UBI in each row of spmu, for
+    every combination of groups in the include-checklist
+
+    Returns:
+        (combinations x spmu rows) array, so the counts of one combination
+        are contiguous, of the smallest unsigned dtype that holds numper
+    """
+    precomputed = mapped_array("eligible_counts")
+    if precomputed is not None:
+        return precomputed
+    spmu = microdata().spmu
+    counts = np.empty(
+        (2 ** len(INCLUDE_BITS), len(spmu)), dtype=np.min_scalar_type(spmu.numper.max())
+    )
+    for code in range(len(counts)):
+        include = [group for group, bit in INCLUDE_BITS.items() if code & bit]
+        counts[code] = reform.numper_ubi(spmu, include)
+    return counts
+
+
+@per_version
+def baseline_stats():
+    """returns the pre-computed baseline statistics by state, including US"""
+    return BaselineStats(
+        # baseline poverty gap, gini and total resources by state & us
+        all_state_stats=pd.read_csv(_path("all_state_stats.csv.gz"), index_col=0),
+        # baseline white/black/child etc. poverty rates & population
+        demog_stats=pd.read_csv(_path("demog_stats.csv.gz")),
+    )
+
+
+def state_names():
+    """returns "US" followed by every state in alphabetical order
+
+    Read from the small baseline stats file so that building the layout
+    does not require the microdata.
+    """
+    states_no_us = baseline_stats().all_state_stats.index.drop("US").tolist()
+    states_no_us.sort()
+    return ["US"] + states_no_us
+
+
+@per_version
+def year_stats():
+    """returns the baseline statistics of each survey year by state
+
+    Same as baseline_stats(), with a year column, and weighted as annual
+    totals for that year.
+    """
+    return BaselineStats(
+        all_state_stats=pd.read_csv(
+            _path("all_state_stats_by_year.csv.gz"), index_col=0
+        ),
+        demog_stats=pd.read_csv(_path("demog_stats_by_year.csv.gz")),
+    )
+
+
+def years():
+    """returns the survey years that can be analysed on their own, if any
+
+    Empty when the per-year baseline statistics have not been generated.
+    """
+    if not os.path.exists(_path("all_state_stats_by_year.csv.gz")):
+        return []
+    return sorted(year_stats().all_state_stats.year.unique().tolist())
+
+
+def weighted_total_cube(spmu):
+    """returns the weighted totals of WEIGHTED_TOTAL_COLUMNS in spmu
+
+    Args:
+        spmu: spmu table with pooled weights
+
+    Returns:
+        dataframe indexed by state and year
+    """
+    values = spmu[[col for col in WEIGHTED_TOTAL_COLUMNS if col in spmu]]
+    values = values.assign(positive_adjginc=np.maximum(spmu.adjginc, 0))
+    values = values[WEIGHTED_TOTAL_COLUMNS].mul(spmu.spmwt, axis=0)
+    return values.groupby([spmu.state, spmu.year], observed=True).sum()
+
+
+@per_version
+def weighted_totals():
+    """returns weighted_total_cube() of the microdata
+
+    Read from weighted_totals.csv.gz, written by pre-processing.py, or
+    computed from the microdata if that file has not been generated.
+    """
+    if os.path.exists(_path("weighted_totals.csv.gz")):
+        return pd.read_csv(_path("weighted_totals.csv.gz"), index_col=[0, 1])
+    return weighted_total_cube(microdata().spmu)
+
+
+@per_version
+def weighted_total(state, year=None):
+    """returns the weighted total of each of WEIGHTED_TOTAL_COLUMNS
+
+    Args:
+        state: a state, or "US"
+        year: a survey year, for annual totals of that year, or None for
+            all years pooled
+
+    Returns:
+        series indexed by column
+    """
+    cube = weighted_totals()
+    if state == "US":
+        by_year = cube.groupby(level="year").sum()
+    else:
+        by_year = cube.loc[state]
+    if year is None:
+        return by_year.sum()
+    # scale the pooled weights back up to annual totals for the year
+    return by_year.loc[year] * cube.index.get_level_values("year").nunique()
+
+
+def demog_code_cube(person, spmu):
+    """returns the baseline population and people in poverty of each
+    demog_code, by state and year, with pooled weights
+
+    Args:
+        person: person_store() of spmu
+
+    Returns:
+        dataframe indexed by state, year and demog_code, with columns pop
+        and poor
+    """
+    units = spmu.iloc[person.unit]
+    poor = (units.spmtotres < units.spmthresh).to_numpy()
+    values = pd.DataFrame({"pop": person.asecwt, "poor": person.asecwt * poor})
+    cube = values.groupby(
+        [units.state.to_numpy(), units.year.to_numpy(), person.demog_code],
+        observed=True,
+    ).sum()
+    cube.index.names = ["state", "year", "demog_code"]
+    # every code of every state and year, so lookups are plain arrays
+    full = pd.MultiIndex.from_product(
+        [cube.index.levels[0], cube.index.levels[1], range(N_DEMOG_CODES)],
+        names=cube.index.names,
+    )
+    return cube.reindex(full, fill_value=0)
+
+
+@per_version
+def demog_code_stats():
+    """returns demog_code_cube() of the microdata
+
+    Read from demog_code_stats.csv.gz, written by pre-processing.py, or
+    computed from the microdata if that file has not been generated.
+    """
+    if os.path.exists(_path("demog_code_stats.csv.gz")):
+        return pd.read_csv(_path("demog_code_stats.csv.gz"), index_col=[0, 1, 2])
+    return demog_code_cube(*microdata())
+
+
+@per_version
+def baseline_by_code(state, year=None):
+    """returns the baseline population and people in poverty by demog_code
+
+    Args:
+        state: a state, or "US"
+        year: a survey year, or None for all years pooled
+
+    Returns:
+        (population, poor), arrays of N_DEMOG_CODES pooled person weights,
+        so their ratios are poverty rates
+    """
+    cube = demog_code_stats()
+    if state != "US":
+        cube = cube.loc[[state]]
+    if year is not None:
+        cube = cube[cube.index.get_level_values("year") == year]
+    by_code = cube.groupby(level="demog_code").sum()
+    return by_code["pop"].to_numpy(), by_code["poor"].to_numpy()
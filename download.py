@@ -0,0 +1,215 @@
+"""Downloadable results of a reform, as CSV or Parquet.
+
+The "Download results" button of the dashboard links to the download route of
+app.py, which streams the rows of a scenario in chunks as they are computed,
+so a large download never holds the whole file in memory:
+    a summary row of the state selected in the dropdown
+    a row per group of the poverty breakdown, with its poverty rates
+    optionally a row per state, for every state at once
+
+The state rows are computed like years.py does for survey years: from one
+simulation over every SPM unit, with np.bincount and metrics.grouped_gini
+over the state of each unit. Each state funds its own UBI from its own
+revenue in a state-level reform and shares the US UBI in a federal one.
+
+Every row has the columns of COLUMNS, empty where they do not apply. Parquet
+needs pyarrow (`pip install pyarrow`), CSV is always available.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+import data
+from metrics import grouped_gini
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, downloads are then CSV only
+    pa = None
+
+# section is "summary", "demographic" or "state", and group the state or
+# demographic group of the row. revenue is raised from the units of the row's
+# state, or of every unit funding the reform in the summary row
+COLUMNS = [
+    "section",
+    "group",
+    "population",
+    "monthly_ubi",
+    "revenue",
+    "poverty_rate_original",
+    "poverty_rate_new",
+    "poverty_rate_change",
+    "poverty_gap_change",
+    "gini_change",
+    "change_pp",
+    "percent_winners",
+]
+
+MIMETYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def formats():
+    """returns the download formats available"""
+    return ["csv", "parquet"] if pa is not None else ["csv"]
+
+
+def outcome_row(section, group, original, results):
+    """returns a row of the changes a reform makes to the baseline
+
+    Args:
+        section, group: see COLUMNS
+        original: baseline statistics of the row, see app.baseline()
+        results: totals of the reform over the row's population, see
+            app.simulate()
+    """
+    population = original["population"]
+    poverty_rate = results["total_poor"] / population
+    return {
+        "section": section,
+        "group": group,
+        "population": population,
+        "monthly_ubi": results["ubi_annual"] / 12,
+        "revenue": results["revenue"],
+        "poverty_rate_original": original["poverty_rate"],
+        "poverty_rate_new": poverty_rate,
+        "poverty_rate_change": poverty_rate / original["poverty_rate"] - 1,
+        "poverty_gap_change": results["poverty_gap"] / original["poverty_gap"] - 1,
+        "gini_change": results["gini"] / original["gini"] - 1,
+        "change_pp": (results["total_resources"] - original["total_resources"])
+        / population,
+        "percent_winners": results["total_winners"] / population * 100,
+    }
+
+
+def state_results(results, level, year=None):
+    """returns the results of a reform in each state
+
+    Args:
+        results: app.simulate() of the reform with "US" selected, whose
+            "spmu" has every unit and the new_resources, total_ubi,
+            numper_ubi and person_weight columns
+        level: "federal" or "state", the reform level
+        year: a survey year, None if all years are pooled
+
+    Returns:
+        dataframe of rows of outcome_row(), one per state in alphabetical
+        order
+    """
+    funding_spmu = results["spmu"]
+    state_codes = funding_spmu.state.cat.codes.to_numpy()
+    states = funding_spmu.state.cat.categories
+    n_states = len(states)
+
+    spmwt = funding_spmu.spmwt.to_numpy()
+    numper_ubi = funding_spmu.numper_ubi.to_numpy()
+    spmtotres = funding_spmu.spmtotres.to_numpy()
+    new_resources = funding_spmu.new_resources.to_numpy()
+    pre_ubi_resources = new_resources - funding_spmu.total_ubi.to_numpy()
+    # revenue per unit is what the repeals and new taxes took from it
+    revenue = np.bincount(
+        state_codes, spmwt * (spmtotres - pre_ubi_resources), n_states
+    )
+    if level == "state":
+        # each state funds its own UBI
+        ubi_population = np.bincount(state_codes, spmwt * numper_ubi, n_states)
+        ubi_annual = revenue / ubi_population
+        new_resources = pre_ubi_resources + ubi_annual[state_codes] * numper_ubi
+    else:
+        ubi_annual = np.full(n_states, results["ubi_annual"])
+
+    thresh = funding_spmu.spmthresh.to_numpy()
+    numper = funding_spmu.numper.to_numpy()
+    person_w = funding_spmu.person_weight.to_numpy()
+    state_totals = {
+        "ubi_annual": ubi_annual,
+        "revenue": revenue,
+        "total_resources": np.bincount(state_codes, spmwt * new_resources, n_states),
+        "total_poor": np.bincount(
+            state_codes, person_w * (new_resources < thresh), n_states
+        ),
+        "poverty_gap": np.bincount(
+            state_codes, spmwt * np.maximum(thresh - new_resources, 0), n_states
+        ),
+        "gini": grouped_gini(new_resources / numper, person_w, state_codes, n_states),
+        "total_winners": np.bincount(
+            state_codes, person_w * (new_resources > spmtotres), n_states
+        ),
+    }
+
+    # baseline statistics of each state, pre-computed by pre-processing.py
+    if year is None:
+        all_state_stats, demog_stats = data.baseline_stats()
+    else:
+        all_state_stats, demog_stats = data.year_stats()
+        all_state_stats = all_state_stats[all_state_stats.year == year]
+        demog_stats = demog_stats[demog_stats.year == year]
+    person_stats = demog_stats[demog_stats.demog == "person"].pivot(
+        index="state", columns="metric", values="value"
+    )
+    original = {
+        "population": person_stats["pop"].reindex(states).to_numpy(),
+        "poverty_rate": person_stats.pov_rate.reindex(states).to_numpy(),
+        **{
+            column: all_state_stats[column].reindex(states).to_numpy()
+            for column in ["total_resources", "poverty_gap", "gini"]
+        },
+    }
+    return pd.DataFrame(
+        outcome_row("state", states.to_numpy(), original, state_totals),
+        columns=COLUMNS,
+    ).sort_values("group", ignore_index=True)
+
+
+class _Buffer(io.RawIOBase):
+    """a write-only file handing over what was written since the last read"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.parts.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def read_written(self):
+        written = b"".join(self.parts)
+        self.parts = []
+        return written
+
+
+def csv_chunks(frames):
+    """yields the bytes of a CSV file of the rows of frames, a chunk per frame"""
+    header = True
+    for frame in frames:
+        yield frame.to_csv(index=False, header=header).encode()
+        header = False
+
+
+def parquet_chunks(frames):
+    """yields the bytes of a Parquet file of the rows of frames, a row group
+    per frame"""
+    schema = pa.schema(
+        [(column, pa.string()) for column in COLUMNS[:2]]
+        + [(column, pa.float64()) for column in COLUMNS[2:]]
+    )
+    buffer = _Buffer()
+    with pq.ParquetWriter(buffer, schema) as writer:
+        for frame in frames:
+            writer.write_table(
+                pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+            )
+            yield buffer.read_written()
+    # the footer is written on closing
+    yield buffer.read_written()
+
+
+WRITERS = {"csv": csv_chunks, "parquet": parquet_chunks}
@@ -0,0 +1,284 @@
+"""Static export of every scenario's outputs, to serve without Python.
+
+`python export.py OUT_DIR [--processes N] [--states US Alabama ...]` runs
+every valid combination of the dashboard's levers through app.py and writes
+compact JSON shards a static file host can serve, for example during
+traffic spikes of the embedded calculator. static/loader.js, copied into
+OUT_DIR, fetches the shard of the selected inputs and renders the figures.
+
+OUT_DIR is laid out as:
+    index.json: the levers, the skeleton figures of figures.py and the hash
+        of every shard
+    loader.js: see static/loader.js
+    LEVEL/STATE/REPEALS.json: one shard per state, level and set of repealed
+        taxes and benefits ("none" if nothing is repealed, else the sorted
+        repeals joined by "+")
+
+A shard holds the outputs of every include-checklist value and tax rate
+for its repeals, so moving the slider or ticking an include box never
+fetches another file. The outputs of a scenario are a list of:
+    the ubi, revenue, ubi population, winners and resources lines
+    the economic overview bars, the poverty breakdown bars and their shared
+    y-axis range
+    the income decile bars and line
+The year comparison, confidence intervals and breakdown intersections are
+left to the live app, so each scenario is the default view of its levers.
+
+The export is incremental: each shard's hash covers its levers, the data
+files and the code that computes the outputs, and a shard whose hash is
+unchanged in index.json is not computed again.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+
+from plotly.utils import PlotlyJSONEncoder
+
+import app
+import data
+import figures
+
+INDEX = "index.json"
+LOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "loader.js")
+
+# bump when the layout of a shard changes, so every shard is written again
+FORMAT_VERSION = 1
+
+# modules on the path from the levers to the outputs, whose code changes
+# the shards: the layout's options, the stages and caches of app.py, the
+# reform, its reductions (both kernel backends) and the chunked engine
+CODE_FILES = [
+    "app.py",
+    "cache.py",
+    "chunked.py",
+    "components.py",
+    "data.py",
+    "figures.py",
+    "kernels.py",
+    "metrics.py",
+    "reform.py",
+]
+
+# files in DATA_DIR the outputs are computed from, see data.py
+DATA_FILES = [
+    "spmu.csv.gz",
+    "person.npz",
+    "person.csv.gz",
+    "all_state_stats.csv.gz",
+    "demog_stats.csv.gz",
+    "weighted_totals.csv.gz",
+    "demog_code_stats.csv.gz",
+]
+
+
+def _file_hash(hasher, path):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            hasher.update(block)
+
+
+def source_hash():
+    """returns the hash of the data files and the code computing outputs"""
+    hasher = hashlib.sha256(str(FORMAT_VERSION).encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for filename in CODE_FILES:
+        _file_hash(hasher, os.path.join(here, filename))
+    # a release of DATA_RELEASES is named after its data
+    hasher.update(str(data.version()).encode())
+    for filename in DATA_FILES:
+        path = data._path(filename)
+        if os.path.exists(path):
+            hasher.update(filename.encode())
+            _file_hash(hasher, path)
+    return hasher.hexdigest()
+
+
+def _options(component_id):
+    """returns the values of a checklist or radio component of the layout"""
+    for component in app.layout._traverse():
+        if getattr(component, "id", None) == component_id:
+            return [option["value"] for option in component.options]
+    raise KeyError(component_id)
+
+
+def levers():
+    """returns the values each lever can take
+
+    Read from the layout, so they follow the dashboard. Combinations the
+    dashboard does not allow are left out: excluding both adults and
+    children, and at the state level any benefit or tax but income taxes,
+    see app.scenario_key().
+
+    Returns:
+        dict of states, levels, agi_tax, include and repeals, a dict of the
+        sets of repeals of each level as (benefits, taxes) tuples
+    """
+    slider = next(
+        component
+        for component in app.layout._traverse()
+        if getattr(component, "id", None) == "agi-slider"
+    )
+
+    def subsets(values):
+        return [
+            tuple(subset)
+            for n in range(len(values) + 1)
+            for subset in itertools.combinations(values, n)
+        ]
+
+    taxes = subsets(_options("taxes-checklist"))
+    return {
+        "states": data.state_names(),
+        "levels": _options("level"),
+        "agi_tax": list(range(slider.min, slider.max + 1, slider.step)),
+        "include": [
+            include
+            for include in subsets(_options("include-checklist"))
+            if "adults" in include or "children" in include
+        ],
+        "repeals": {
+            "federal": list(
+                itertools.product(subsets(_options("benefits-checklist")), taxes)
+            ),
+            "state": [((), tax) for tax in taxes if set(tax) <= {"fedtaxac"}],
+        },
+    }
+
+
+def shard_path(level, state, benefits, taxes):
+    """returns the path of a shard relative to OUT_DIR"""
+    repeals = "+".join(sorted(benefits + taxes)) or "none"
+    return "/".join([level, state, repeals + ".json"])
+
+
+def scenario_outputs(key):
+    """returns the outputs of a scenario as stored in a shard"""
+    lines = list(app.funding_outputs(key)) + list(app.summary_outputs(key))
+    econ, _, y_range, outcomes = app.bar_values(key)
+    decile_change, decile_winners, _ = app.decile_values(key)
+    return [
+        lines,
+        [float(value) for value in econ],
+        [float(value) for value in outcomes["breakdown_changes"]],
+        [round(float(end), 4) for end in y_range],
+        decile_change,
+        decile_winners,
+    ]
+
+
+def write_shard(out_dir, level, state, benefits, taxes, include_values, agi_taxes):
+    """computes and writes one shard, see the module docstring"""
+    outputs = []
+    for include in include_values:
+        for agi_tax in agi_taxes:
+            key = app.scenario_key(state, level, agi_tax, benefits, taxes, include)
+            outputs.append(scenario_outputs(key))
+    _, _, decile_title = app.decile_values(key)
+    shard = {
+        "state": state,
+        "level": level,
+        "benefits": list(benefits),
+        "taxes": list(taxes),
+        "decile_title": decile_title,
+        # the outputs of include_values[i] and agi_taxes[j] are at
+        # i * len(agi_taxes) + j
+        "outputs": outputs,
+    }
+    path = os.path.join(out_dir, shard_path(level, state, benefits, taxes))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(shard, f, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+
+
+def _write_shard(args):
+    write_shard(*args)
+    return args
+
+
+def export(out_dir, states=None, processes=None):
+    """writes the shards whose hash changed and index.json to out_dir
+
+    Args:
+        out_dir: directory to write, created if needed
+        states: optional list of states to export, all by default
+        processes: number of worker processes, os.cpu_count() by default
+
+    Returns:
+        number of shards written
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    index_path = os.path.join(out_dir, INDEX)
+    previous = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            previous = json.load(f)["shards"]
+
+    values = levers()
+    include_values = values["include"]
+    agi_taxes = values["agi_tax"]
+    sources = source_hash()
+    shards = {}
+    todo = []
+    for state in states or values["states"]:
+        for level in values["levels"]:
+            for benefits, taxes in values["repeals"][level]:
+                path = shard_path(level, state, benefits, taxes)
+                shards[path] = hashlib.sha256(
+                    json.dumps(
+                        [sources, level, state, benefits, taxes]
+                        + [include_values, agi_taxes]
+                    ).encode()
+                ).hexdigest()
+                if previous.get(path) != shards[path] or not os.path.exists(
+                    os.path.join(out_dir, path)
+                ):
+                    todo.append(
+                        (out_dir, level, state, benefits, taxes)
+                        + (include_values, agi_taxes)
+                    )
+
+    # load the microdata before forking, so workers share it copy-on-write
+    data.microdata()
+    data.weighted_totals()
+    data.eligible_counts()
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        for done, _ in enumerate(pool.imap_unordered(_write_shard, todo), 1):
+            if done % 100 == 0 or done == len(todo):
+                print(f"{done}/{len(todo)} shards written", flush=True)
+
+    # shards of states not exported this time are kept
+    shards = {**previous, **shards}
+    index = {
+        "format_version": FORMAT_VERSION,
+        "levers": {
+            "states": values["states"],
+            "levels": values["levels"],
+            "agi_tax": agi_taxes,
+            "include": include_values,
+        },
+        "figures": {
+            "econ": figures.ECON_FIGURE,
+            "breakdown": figures.BREAKDOWN_FIGURE,
+            "decile": figures.DECILE_FIGURE,
+        },
+        "shards": shards,
+    }
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, cls=PlotlyJSONEncoder, separators=(",", ":"))
+    os.replace(index_path + ".tmp", index_path)
+    shutil.copyfile(LOADER, os.path.join(out_dir, "loader.js"))
+    return len(todo)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--states", nargs="+", default=None)
+    args = parser.parse_args()
+    export(args.out_dir, args.states, args.processes)
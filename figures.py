@@ -0,0 +1,301 @@
+"""The economic overview and poverty breakdown bar charts.
+
+Only the bar heights, labels, hover text and y-axis range depend on the
+reform, so each figure is built (and validated by plotly) once, at import,
+as a skeleton that goes into the layout. Callbacks return a dash.Patch of
+just the changing properties, so Dash sends that diff instead of the full
+figure.
+"""
+import copy
+
+import plotly.graph_objects as go
+from dash import Patch
+
+# Colors
+BLUE = "#1976D2"
+GRAY = "#616161"
+
+ECON_LABELS = ["Poverty rate", "Poverty gap", "Gini index"]
+BREAKDOWN_LABELS = [
+    "Child",
+    "Adult",
+    "Has disability",
+    "White",
+    "Black",
+    "Hispanic",
+]
+# words for the groups of an intersection, see intersection_label()
+RACE_LABELS = {"white": "White", "black": "Black", "hispanic": "Hispanic"}
+AGE_LABELS = {"child": "children", "adult": "adults"}
+DECILE_LABELS = [str(decile) for decile in range(1, 11)]
+
+# fraction of the axis plotly leaves between the longest bar and the edge
+AUTORANGE_PADDING = 0.05
+
+
+def _skeleton(title_text, x_labels, tickfont):
+    """returns a bar chart figure dict with placeholder values"""
+    fig = go.Figure(
+        [
+            go.Bar(
+                x=x_labels,
+                y=[0] * len(x_labels),
+                text=[0] * len(x_labels),
+                marker_color=BLUE,
+            )
+        ]
+    )
+
+    fig.update_layout(
+        uniformtext_minsize=10,
+        uniformtext_mode="hide",
+        plot_bgcolor="white",
+        title_text=title_text,
+        title_x=0.5,
+        hoverlabel_align="right",
+        font_family="Roboto",
+        title_font_size=20,
+        paper_bgcolor="white",
+        hoverlabel=dict(bgcolor="white", font_size=14, font_family="Roboto"),
+        yaxis_tickformat="%",
+        # adjust margins to fit mobile better
+        margin=dict(l=20, r=20),
+    )
+    fig.update_traces(texttemplate="%{text:.1%f}", textposition="auto")
+
+    fig.update_xaxes(
+        tickangle=45,
+        title_text="",
+        tickfont=tickfont,
+        title_standoff=25,
+        title_font=dict(size=14, family="Roboto", color="black"),
+    )
+
+    fig.update_yaxes(
+        tickprefix="",
+        tickfont=tickfont,
+        title_standoff=25,
+        title_font=dict(size=14, family="Roboto", color="black"),
+        # both charts share a range set by each update, see shared_y_range()
+        range=[-1, 1],
+        autorange=False,
+    )
+    return fig.to_dict()
+
+
+ECON_FIGURE = _skeleton("Economic overview", ECON_LABELS, {"size": 14})
+BREAKDOWN_FIGURE = _skeleton(
+    "Poverty rate breakdown", BREAKDOWN_LABELS, dict(size=14, family="Roboto")
+)
+
+
+def _comparison_skeleton(title_text, x_labels, tickfont):
+    """returns a bar chart figure dict with a group of two bars per label,
+    one for each reform of the compare mode"""
+    fig = go.Figure(_skeleton(title_text, x_labels, tickfont))
+    fig.data[0].name = "Reform A"
+    fig.add_bar(
+        x=x_labels,
+        y=[0] * len(x_labels),
+        text=[0] * len(x_labels),
+        name="Reform B",
+        marker_color=GRAY,
+        texttemplate="%{text:.1%f}",
+        textposition="auto",
+    )
+    fig.update_layout(
+        barmode="group",
+        legend=dict(orientation="h", x=0.5, xanchor="center", y=-0.35),
+    )
+    return fig.to_dict()
+
+
+COMPARE_ECON_FIGURE = _comparison_skeleton(
+    "Economic overview", ECON_LABELS, {"size": 14}
+)
+COMPARE_BREAKDOWN_FIGURE = _comparison_skeleton(
+    "Poverty rate breakdown", BREAKDOWN_LABELS, dict(size=14, family="Roboto")
+)
+
+
+def _decile_skeleton():
+    """returns the income decile chart: bars of the average change in
+    resources and a line of the percent better off, on a second y-axis
+    """
+    fig = go.Figure(
+        [
+            go.Bar(
+                x=DECILE_LABELS,
+                y=[0] * len(DECILE_LABELS),
+                name="Average change in resources per person",
+                marker_color=BLUE,
+                hovertemplate="Average change: $%{y:,.0f}<extra></extra>",
+            ),
+            go.Scatter(
+                x=DECILE_LABELS,
+                y=[0] * len(DECILE_LABELS),
+                name="Percent better off",
+                yaxis="y2",
+                mode="lines+markers",
+                marker_color=GRAY,
+                hovertemplate="Percent better off: %{y:.1f}%<extra></extra>",
+            ),
+        ]
+    )
+
+    fig.update_layout(
+        plot_bgcolor="white",
+        title_text="Change by income decile",
+        title_x=0.5,
+        font_family="Roboto",
+        title_font_size=20,
+        paper_bgcolor="white",
+        hovermode="x unified",
+        hoverlabel=dict(bgcolor="white", font_size=14, font_family="Roboto"),
+        legend=dict(orientation="h", x=0.5, xanchor="center", y=-0.25),
+        # adjust margins to fit mobile better
+        margin=dict(l=20, r=20),
+        xaxis=dict(
+            title_text="Decile of resources per person before the reform",
+            tickfont=dict(size=14, family="Roboto"),
+        ),
+        yaxis=dict(tickprefix="$", tickformat=",.0f", zeroline=True),
+        yaxis2=dict(
+            overlaying="y",
+            side="right",
+            range=[0, 100],
+            ticksuffix="%",
+            showgrid=False,
+        ),
+    )
+    return fig.to_dict()
+
+
+DECILE_FIGURE = _decile_skeleton()
+
+
+def intersection_label(demogs):
+    """returns a name for the people in every group of demogs
+
+    e.g. ["hispanic", "adult", "pwd"] is "Hispanic adults with disabilities"
+    """
+    words = [RACE_LABELS[demog] for demog in demogs if demog in RACE_LABELS]
+    words += [AGE_LABELS[demog] for demog in demogs if demog in AGE_LABELS] or [
+        "people"
+    ]
+    label = " ".join(words)
+    if "pwd" in demogs:
+        label += " with disabilities"
+    return label[0].upper() + label[1:]
+
+
+def _autorange(values):
+    """returns the y-axis range plotly picks automatically for bars of values
+
+    Bars start at zero, so zero is always in range, and the end of each bar
+    furthest from zero gets AUTORANGE_PADDING of the axis as padding.
+    """
+    low = min(min(values), 0)
+    high = max(max(values), 0)
+    if low == high:
+        return [low - 1, high + 1]
+    padded_ends = int(low < 0) + int(high > 0)
+    length = (high - low) / (1 - AUTORANGE_PADDING * padded_ends)
+    if low < 0:
+        low -= AUTORANGE_PADDING * length
+    if high > 0:
+        high += AUTORANGE_PADDING * length
+    return [low, high]
+
+
+def shared_y_range(*bar_values):
+    """returns one y-axis range that fits every chart's bars
+
+    Args:
+        bar_values: the y values of each chart
+    """
+    ranges = [_autorange(values) for values in bar_values]
+    return [min(r[0] for r in ranges), max(r[1] for r in ranges)]
+
+
+def bar_update(y, hovertemplate, y_range, intervals=None, x=None):
+    """returns a dash.Patch setting the bars of a skeleton figure
+
+    Args:
+        y: bar heights, also shown as the bar labels
+        hovertemplate: list of hover strings, one per bar
+        y_range: [min, max] of the y-axis
+        intervals: optional (low, high) confidence interval of each bar,
+            shown as error bars
+        x: optional bar labels, when they differ from the skeleton's
+    """
+    patch = Patch()
+    if x is not None:
+        patch["data"][0]["x"] = x
+    patch["data"][0]["y"] = y
+    patch["data"][0]["text"] = y
+    patch["data"][0]["hovertemplate"] = hovertemplate
+    patch["layout"]["yaxis"]["range"] = y_range
+    if intervals is None:
+        patch["data"][0]["error_y"] = dict(visible=False)
+    else:
+        patch["data"][0]["error_y"] = dict(
+            type="data",
+            symmetric=False,
+            array=[high - value for value, (low, high) in zip(y, intervals)],
+            arrayminus=[value - low for value, (low, high) in zip(y, intervals)],
+            color="black",
+            visible=True,
+        )
+    return patch
+
+
+def comparison_update(a, b, y_range, x=None):
+    """returns a dash.Patch setting the bars of a comparison skeleton
+
+    Args:
+        a, b: bar heights of reform A and reform B, also shown as labels
+        y_range: [min, max] of the y-axis
+        x: optional bar labels, when they differ from the skeleton's
+    """
+    patch = Patch()
+    for trace, y in enumerate([a, b]):
+        if x is not None:
+            patch["data"][trace]["x"] = x
+        patch["data"][trace]["y"] = y
+        patch["data"][trace]["text"] = y
+    patch["layout"]["yaxis"]["range"] = y_range
+    return patch
+
+
+def decile_update(change, winners, title_text):
+    """returns a dash.Patch setting the income decile chart
+
+    Args:
+        change: average change in resources per person of each decile
+        winners: percent better off in each decile
+        title_text: chart title, naming the deciles used
+    """
+    patch = Patch()
+    patch["data"][0]["y"] = change
+    patch["data"][1]["y"] = winners
+    patch["layout"]["title"]["text"] = title_text
+    return patch
+
+
+def patched(figure, patch):
+    """returns a copy of a skeleton figure with the assignments of a
+    dash.Patch applied, e.g. to put a scenario's figure in the layout
+
+    Args:
+        figure: figure dict, one of the skeletons above
+        patch: dash.Patch returned by one of the update functions above
+    """
+    figure = copy.deepcopy(figure)
+    for operation in patch.to_plotly_json()["operations"]:
+        *path, last = operation["location"]
+        target = figure
+        for key in path:
+            target = target[key] if isinstance(key, int) else target.setdefault(key, {})
+        target[last] = operation["params"]["value"]
+    return figure
@@ -0,0 +1,19 @@
+# gunicorn settings, read automatically when gunicorn starts from this directory
+import os
+
+# import wsgi.py (and parse the microdata) once in the master, before forking
+preload_app = True
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+
+
+def post_worker_init(worker):
+    # runs in each worker before it accepts requests, see warmup.py. wsgi.py
+    # kept the master on the NumPy kernels, see kernels.py
+    import kernels
+    import warmup
+
+    kernels.set_backend(kernels.KERNEL_BACKEND)
+    warmup.start()
@@ -0,0 +1,322 @@
+"""Fused loops for the reductions of app.simulate().
+
+Once reform.py has computed the new resources of each SPM unit, simulate()
+reduces them to totals over units (total resources, poverty gap and the
+decile charts) and over persons (people in poverty, winners, the poverty
+breakdown by demog_code and the resources per person of the Gini index).
+With the NumPy backend each of these is one or more passes over the arrays,
+with temporaries in between. With numba (`pip install numba`) each function
+below is compiled into one loop over the arrays, split into chunks that run
+in parallel on every core. The Gini index sorts with NumPy, then accumulates
+in one compiled sequential loop, since its cumulative sums depend on every
+earlier person.
+
+KERNEL_BACKEND selects the backend: "numpy", "numba", or "auto" (the
+default), numba when it is available. Both give the same results up to the
+order floating-point sums are taken in. The compiled loops are cached in
+__pycache__, so only the first start after a change pays for compiling them,
+and warmup.py runs them before a worker serves requests.
+
+numba is only available with its TBB threading layer (`pip install tbb`).
+Its other layers are not safe here: the workqueue layer aborts the process
+when the threads of a gunicorn worker run the loops at the same time, and
+OpenMP threads started in the gunicorn master do not survive the fork into
+the workers. wsgi.py also keeps the master on the NumPy backend, and
+gunicorn.conf.py sets KERNEL_BACKEND in each worker after the fork, so the
+first parallel call, which starts TBB's threads, is made from the worker's
+main thread by warmup.start().
+"""
+import importlib
+import os
+
+import numpy as np
+
+import metrics
+
+try:
+    import numba
+except ImportError:  # optional, the reductions are then NumPy passes
+    numba = None
+
+
+def _tbb_loads():
+    """returns whether numba's TBB threading layer loads, with the same checks
+    numba makes before it picks a layer"""
+    try:
+        from numba.np.ufunc.parallel import _check_tbb_version_compatible
+
+        _check_tbb_version_compatible()
+        importlib.import_module("numba.np.ufunc.tbbpool")
+    except ImportError:
+        return False
+    return True
+
+
+if numba is not None:
+    # the only layer that is both thread and fork safe, see above
+    numba.config.THREADING_LAYER = "safe"
+    if not _tbb_loads():
+        # the reductions are then NumPy passes, as without numba
+        numba = None
+
+BACKENDS = ["numpy", "numba"] if numba is not None else ["numpy"]
+KERNEL_BACKEND = os.environ.get("KERNEL_BACKEND", "auto")
+
+UNIT_TOTALS = [
+    "total_resources",
+    "poverty_gap",
+    "decile_population",
+    "decile_change",
+    "decile_winners",
+]
+PERSON_TOTALS = [
+    "total_poor",
+    "total_winners",
+    "population_by_code",
+    "poor_by_code",
+    "resources_per_person",
+]
+
+
+# ---------------------------------------------------------------------------- #
+#                       SECTION NumPy backend                                  #
+# ---------------------------------------------------------------------------- #
+
+
+def _unit_totals_numpy(
+    new_resources, spmthresh, spmtotres, spmwt, numper, person_w, deciles, n_deciles
+):
+    poverty_gap = np.where(new_resources < spmthresh, spmthresh - new_resources, 0)
+    change_per_person = (new_resources - spmtotres) / numper
+    return (
+        (new_resources * spmwt).sum(),
+        (poverty_gap * spmwt).sum(),
+        np.bincount(deciles, person_w, n_deciles),
+        np.bincount(deciles, person_w * change_per_person, n_deciles),
+        np.bincount(deciles, person_w * (new_resources > spmtotres), n_deciles),
+    )
+
+
+def _person_totals_numpy(
+    new_resources, numper, spmthresh, spmtotres, person_rows, asecwt, codes, n_codes
+):
+    person_new_resources = new_resources[person_rows]
+    poor = person_new_resources < spmthresh[person_rows]
+    winner = person_new_resources > spmtotres[person_rows]
+    return (
+        (poor * asecwt).sum(),
+        (winner * asecwt).sum(),
+        np.bincount(codes, asecwt, n_codes),
+        np.bincount(codes, asecwt * poor, n_codes),
+        (new_resources / numper)[person_rows],
+    )
+
+
+# ---------------------------------------------------------------------------- #
+#                       SECTION numba backend                                  #
+# ---------------------------------------------------------------------------- #
+# each chunk of the parallel loops sums into its own row of the totals, so
+# threads never write to the same element
+
+
+def _chunks(n):
+    """returns the bounds of the chunks a loop over n elements is split into"""
+    n_chunks = max(min(numba.get_num_threads(), n), 1)
+    return np.linspace(0, n, n_chunks + 1).astype(np.int64)
+
+
+def _unit_loop(
+    bounds,
+    new_resources,
+    spmthresh,
+    spmtotres,
+    spmwt,
+    numper,
+    person_w,
+    deciles,
+    n_deciles,
+):
+    n_chunks = len(bounds) - 1
+    scalars = np.zeros((n_chunks, 2))
+    by_decile = np.zeros((n_chunks, 3, n_deciles))
+    for chunk in numba.prange(n_chunks):
+        for i in range(bounds[chunk], bounds[chunk + 1]):
+            resources = new_resources[i]
+            scalars[chunk, 0] += resources * spmwt[i]
+            if resources < spmthresh[i]:
+                scalars[chunk, 1] += (spmthresh[i] - resources) * spmwt[i]
+            decile = deciles[i]
+            by_decile[chunk, 0, decile] += person_w[i]
+            by_decile[chunk, 1, decile] += (
+                person_w[i] * (resources - spmtotres[i]) / numper[i]
+            )
+            if resources > spmtotres[i]:
+                by_decile[chunk, 2, decile] += person_w[i]
+    scalars = scalars.sum(axis=0)
+    by_decile = by_decile.sum(axis=0)
+    return scalars[0], scalars[1], by_decile[0], by_decile[1], by_decile[2]
+
+
+def _person_loop(
+    bounds,
+    new_resources,
+    numper,
+    spmthresh,
+    spmtotres,
+    person_rows,
+    asecwt,
+    codes,
+    n_codes,
+):
+    n_chunks = len(bounds) - 1
+    scalars = np.zeros((n_chunks, 2))
+    by_code = np.zeros((n_chunks, 2, n_codes))
+    resources_per_person = np.empty(len(person_rows))
+    for chunk in numba.prange(n_chunks):
+        for i in range(bounds[chunk], bounds[chunk + 1]):
+            row = person_rows[i]
+            resources = new_resources[row]
+            weight = asecwt[i]
+            code = codes[i]
+            by_code[chunk, 0, code] += weight
+            if resources < spmthresh[row]:
+                scalars[chunk, 0] += weight
+                by_code[chunk, 1, code] += weight
+            if resources > spmtotres[row]:
+                scalars[chunk, 1] += weight
+            resources_per_person[i] = resources / numper[row]
+    scalars = scalars.sum(axis=0)
+    by_code = by_code.sum(axis=0)
+    return scalars[0], scalars[1], by_code[0], by_code[1], resources_per_person
+
+
+def _unit_totals_numba(new_resources, *args):
+    return _unit_loop(_chunks(len(new_resources)), new_resources, *args)
+
+
+def _person_totals_numba(
+    new_resources, numper, spmthresh, spmtotres, person_rows, *args
+):
+    return _person_loop(
+        _chunks(len(person_rows)),
+        new_resources,
+        numper,
+        spmthresh,
+        spmtotres,
+        person_rows,
+        *args,
+    )
+
+
+def _sorted_gini(values, weights, order):
+    # the same trapezoidal Lorenz curve as metrics.gini(), whose terms do not
+    # depend on the order of ties
+    cumw = 0.0
+    cumxw = 0.0
+    area = 0.0
+    for i in order:
+        next_cumw = cumw + weights[i]
+        next_cumxw = cumxw + values[i] * weights[i]
+        area += next_cumxw * cumw - cumxw * next_cumw
+        cumw = next_cumw
+        cumxw = next_cumxw
+    return area / (cumxw * cumw)
+
+
+def _gini_numba(values, weights):
+    # NumPy's sort is faster than numba's, the loop after it is compiled
+    return _sorted_gini(values, weights, np.argsort(values))
+
+
+_IMPLEMENTATIONS = {
+    "numpy": (_unit_totals_numpy, _person_totals_numpy, metrics.gini),
+}
+if numba is not None:
+    _IMPLEMENTATIONS["numba"] = (
+        _unit_totals_numba,
+        _person_totals_numba,
+        _gini_numba,
+    )
+    # the loops are compiled on first call, the chunks are set outside them so
+    # the compiled code does not depend on the number of threads and can be
+    # cached
+    _unit_loop = numba.njit(parallel=True, cache=True)(_unit_loop)
+    _person_loop = numba.njit(parallel=True, cache=True)(_person_loop)
+    _sorted_gini = numba.njit(cache=True)(_sorted_gini)
+
+
+def set_backend(name):
+    """makes the functions below run on backend name, one of BACKENDS or
+    "auto"
+
+    Raises:
+        ValueError: if the backend is unknown or not installed
+    """
+    global backend, _unit_totals, _person_totals, _gini
+    if name == "auto":
+        name = BACKENDS[-1]
+    if name not in _IMPLEMENTATIONS:
+        raise ValueError(
+            f"kernel backend {name!r} is not available, pick one of {BACKENDS}"
+        )
+    backend = name
+    _unit_totals, _person_totals, _gini = _IMPLEMENTATIONS[name]
+
+
+set_backend(KERNEL_BACKEND)
+
+
+def _contiguous(arrays):
+    return [np.ascontiguousarray(array) for array in arrays]
+
+
+def unit_totals(
+    new_resources, spmthresh, spmtotres, spmwt, numper, person_w, deciles, n_deciles
+):
+    """returns the totals of a reform over SPM units
+
+    Args:
+        new_resources: resources of each unit after the reform
+        spmthresh, spmtotres, spmwt, numper: the spmu columns
+        person_w: sum of the person weights of each unit
+        deciles: baseline income decile of each unit, 0 to n_deciles - 1
+
+    Returns:
+        dict of UNIT_TOTALS: the weighted total of new resources, the
+        poverty gap, and by decile the person weights, the total change in
+        resources per person and the person weights of units better off
+    """
+    arrays = _contiguous(
+        [new_resources, spmthresh, spmtotres, spmwt, numper, person_w, deciles]
+    )
+    return dict(zip(UNIT_TOTALS, _unit_totals(*arrays, n_deciles)))
+
+
+def person_totals(
+    new_resources, numper, spmthresh, spmtotres, person_rows, asecwt, codes, n_codes
+):
+    """returns the totals of a reform over persons
+
+    Args:
+        new_resources, numper, spmthresh, spmtotres: columns of the units
+        person_rows: row of each person's unit in those columns
+        asecwt, codes: weight and demog_code of each person
+        n_codes: number of demog_codes
+
+    Returns:
+        dict of PERSON_TOTALS: the person weights of people in poverty and
+        better off, the person weights and those in poverty by demog_code,
+        and each person's new resources per person of their unit
+    """
+    arrays = _contiguous(
+        [new_resources, numper, spmthresh, spmtotres, person_rows, asecwt, codes]
+    )
+    return dict(zip(PERSON_TOTALS, _person_totals(*arrays, n_codes)))
+
+
+def gini(values, weights):
+    """returns the weighted Gini index of values, see metrics.gini()"""
+    values, weights = _contiguous(
+        [np.asarray(values, dtype="float"), np.asarray(weights, dtype="float")]
+    )
+    return _gini(values, weights)
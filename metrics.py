@@ -0,0 +1,82 @@
+"""Weighted summary statistics used by the simulation.
+
+These give the same results as the microdf functions of the same name, but
+take arrays (or Series) instead of a dataframe and column names, so neither
+serving requests nor pre-processing.py imports microdf and its plotting
+dependencies.
+"""
+import numpy as np
+
+
+def weighted_sum(values, weights):
+    """returns the sum of values multiplied by their weights"""
+    return (values * weights).sum()
+
+
+def weighted_mean(values, weights):
+    """returns the weighted average of values"""
+    return weighted_sum(values, weights) / weights.sum()
+
+
+def gini(values, weights, presorted=False):
+    """returns the weighted Gini index of values
+
+    Uses the same trapezoidal approximation of the Lorenz curve as microdf.
+    presorted=True skips sorting values that are already in increasing order.
+    """
+    x = np.asarray(values, dtype="float")
+    w = np.asarray(weights, dtype="float")
+    if presorted:
+        sorted_x, sorted_w = x, w
+    else:
+        sorted_indices = np.argsort(x)
+        sorted_x = x[sorted_indices]
+        sorted_w = w[sorted_indices]
+    cumw = np.cumsum(sorted_w)
+    cumxw = np.cumsum(sorted_x * sorted_w)
+    return np.sum(cumxw[1:] * cumw[:-1] - cumxw[:-1] * cumw[1:]) / (
+        cumxw[-1] * cumw[-1]
+    )
+
+
+def grouped_gini(values, weights, groups, n_groups, presorted=False):
+    """returns the weighted Gini index of values within each group
+
+    Sorts once by group then value, and takes the cumulative sums of gini()
+    restarted at the start of each group.
+
+    Args:
+        values, weights: arrays with one element per observation
+        groups: integer group code of each observation, 0 to n_groups - 1
+        n_groups: number of groups
+        presorted: True if values are already in increasing order, so only
+            a stable sort by group is needed
+
+    Returns:
+        array of n_groups Gini indices
+    """
+    x = np.asarray(values, dtype="float")
+    w = np.asarray(weights, dtype="float")
+    groups = np.asarray(groups)
+    if presorted:
+        order = np.argsort(groups, kind="stable")
+    else:
+        order = np.lexsort((x, groups))
+    x, w, groups = x[order], w[order], groups[order]
+
+    # cumulative sums since the start of each group
+    starts = np.searchsorted(groups, np.arange(n_groups))
+    sizes = np.diff(np.append(starts, len(groups)))
+    cumw = np.cumsum(w)
+    cumxw = np.cumsum(x * w)
+    before_w = np.where(starts > 0, cumw[starts - 1], 0)
+    before_xw = np.where(starts > 0, cumxw[starts - 1], 0)
+    cumw -= np.repeat(before_w, sizes)
+    cumxw -= np.repeat(before_xw, sizes)
+
+    # pairs of consecutive observations in the same group
+    same_group = groups[1:] == groups[:-1]
+    terms = cumxw[1:] * cumw[:-1] - cumxw[:-1] * cumw[1:]
+    area = np.bincount(groups[1:][same_group], terms[same_group], n_groups)
+    ends = starts + sizes - 1
+    return area / (cumxw[ends] * cumw[ends])
@@ -1,83 +1,42 @@
 # if kernel crashes, make sure pywin32 and pipywin32 are installed.
 # Followed instructions here: https://github.com/jupyter/notebook/issues/4909
 # import win32api
+"""Pre-processes IPUMS CPS ASEC extracts into the files the app reads.
+
+`python pre-processing.py [EXTRACT ...]` (cps_00041.csv.gz by default)
+processes each survey year of the extracts on its own into
+PARTITION_DIR/YEAR/, with annual weights:
+    spmu.csv.gz, person.csv.gz: the year's SPM units and persons
+    person.npz: the year's slim person store, see data.person_store(), with
+        units numbered within the year
+    demog_sums.csv.gz: the weighted population and people in poverty of each
+        demographic, by state and for the US
+    state_sums.csv.gz: the weighted poverty gap, total resources, state tax
+        and AGI, by state and for the US
+    gini_points.npz: the resources per person of every person in increasing
+        order, with their weight and state, for the Gini index
+
+A year already partitioned is skipped, unless --rebuild is passed, so a new
+ASEC release only processes its own extract. The pooled files in the current
+directory are then recombined from the partitions of all N years, with the
+weights of each year divided by N: sums are added up and divided by N, rates
+are ratios of the added sums, and the Gini index is computed over the merged
+sorted resources of every year. The *_by_year.csv.gz files are the
+statistics of each year on its own.
+"""
+import argparse
+import os
+import shutil
 
 import pandas as pd
 import numpy as np
-import microdf as mdf
-import os
 import us
 
-# Import data from Ipums
-person = pd.read_csv("cps_00041.csv.gz")
-# lower column names
-person.columns = person.columns.str.lower()
-# Divide by three for three years of data.
-person[["asecwt", "spmwt"]] /= 3
-
-# Create booleans for demographics
-person["adult"] = person.age >= 18
-person["child"] = person.age < 18
-
-# create mutually exclusive white non-hisp/black non-hisp/hispanic groups
-person["hispanic"] = person.hispan.between(1, 699)
-person["black"] = (person.race == 200) & (~person.hispanic)
-person["white"] = (person.race == 100) & (~person.hispanic)
-# check to make sure persons are double counted
-assert person[["black", "hispanic", "white"]].sum(axis=1).max() == 1
-
-
-person["pwd"] = person.diffany == 2
-person["non_citizen"] = person.citizen == 5
-person["non_citizen_child"] = (person.citizen == 5) & person.child
-person["non_citizen_adult"] = (person.citizen == 5) & person.adult
-
-# Remove NIUs
-person["adjginc"].replace({99999999: 0}, inplace=True)
-person["fedtaxac"].replace({99999999: 0}, inplace=True)
-person["taxinc"].replace({9999999: 0}, inplace=True)
-person["stataxac"].replace({9999999: 0}, inplace=True)
-person["incss"].replace({999999: 0}, inplace=True)
-person["incunemp"].replace({999999: 0}, inplace=True)
-person["incssi"].replace({999999: 0}, inplace=True)
-person["ctccrd"].replace({999999: 0}, inplace=True)
-person["incunemp"].replace({99999: 0}, inplace=True)
-person["actccrd"].replace({99999: 0}, inplace=True)
-person["fica"].replace({99999: 0}, inplace=True)
-person["eitcred"].replace({9999: 0}, inplace=True)
-
-# Change fip codes to state names
-person["state"] = (
-    person["statefip"].astype(str)
-    # pad leading zero or wrong number of states
-    .apply("{:0>2}".format)
-    # lookup full state name from fips code
-    .apply(lambda x: us.states.lookup(x))
-    # change us package formatting to string
-    .astype(str)
-)
-
-# drop original statefip column from dataframe
-person.drop(columns=["statefip"], inplace=True)
-
-# Aggregate deductible and refundable child tax credits
-person["ctc"] = person.ctccrd + person.actccrd
-
-# Calculate the number of people per smp unit
-person["person"] = 1
-spm = person.groupby(["spmfamunit", "year"])[["person"]].sum()
-spm.columns = ["numper"]
-person = person.merge(spm, left_on=["spmfamunit", "year"], right_index=True)
-
-person["weighted_state_tax"] = person.asecwt * person.stataxac
-person["weighted_agi"] = person.asecwt * person.adjginc
-
-# Calculate the total taxable income and total people in each state
-state_groups_taxinc = person.groupby(["state"])[
-    ["weighted_state_tax", "weighted_agi"]
-].sum()
-state_groups_taxinc.columns = ["state_tax_revenue", "state_taxable_income"]
-person = person.merge(state_groups_taxinc, left_on=["state"], right_index=True)
+import data
+from metrics import gini, grouped_gini
+
+# one directory of annual files per survey year
+PARTITION_DIR = "survey_years"
 
 # Create dataframe with aggregated spm unit data
 PERSON_COLUMNS = [
@@ -105,20 +64,13 @@ SPMU_COLUMNS = [
     "spmwt",
     "year",
     "state",
-    "state_tax_revenue",
-    "state_taxable_income",
 ]
-
-spmu = person.groupby(SPMU_COLUMNS, observed=False)[PERSON_COLUMNS].sum().reset_index()
-spmu[["fica", "fedtaxac", "stataxac"]] *= -1
-spmu.rename(columns={"person": "numper"}, inplace=True)
-
-# write pre-processed dfs to csv files
-person.to_csv("person.csv.gz", compression="gzip")
-spmu.to_csv("spmu.csv.gz", compression="gzip")
-
-# create boolean column for individual's poverty status, 1=poor
-person["poor"] = person.spmthresh > person.spmtotres
+# columns of the pooled state totals of state taxes and AGI, which depend on
+# every year, so are added when the partitions are combined
+STATE_TAX_COLUMNS = {
+    "weighted_state_tax": "state_tax_revenue",
+    "weighted_agi": "state_taxable_income",
+}
 
 # create a column for all selected demographic variables
 # that will be used to calculate poverty rates
@@ -130,100 +82,370 @@ DEMOG_COLS = [
     "white",
     "hispanic",
     "pwd",
+    "non_citizen",
+    "non_citizen_adult",
+    "non_citizen_child",
 ]
 
-poor_pop = person[person.poor]
-
-# calculate weighted sum of people living in poverty
-mdf.weighted_sum(poor_pop, DEMOG_COLS, "asecwt")
-# calculate poverty RATE for each DEMOGRAPHIC in US
-pov_rate_us = mdf.weighted_sum(poor_pop, DEMOG_COLS, "asecwt") / mdf.weighted_sum(
-    person, DEMOG_COLS, w="asecwt"
-)
-# add name to series
-pov_rate_us.name = "US"
-# calculate poverty RATE for each group by state
-pov_rates = mdf.weighted_sum(
-    poor_pop, DEMOG_COLS, "asecwt", groupby="state"
-) / mdf.weighted_sum(person, DEMOG_COLS, w="asecwt", groupby="state")
-
-# append US statistics as additional 'state'
-pov_df = pov_rates.append(pov_rate_us)
-
-# melt df from wide to long format
-pov_df = pov_df.melt(ignore_index=False, var_name="demog")
-# insert column indicating metric in question
-pov_df.insert(loc=1, column="metric", value="pov_rate")
-
-
-##
-# calculate POPULATION for each DEMOGRAPHIC in US
-pop_us = mdf.weighted_sum(person, DEMOG_COLS, w="asecwt")
-# add name to series
-pop_us.name = "US"
-# calculate POPULATION for each group by state
-pop_states = mdf.weighted_sum(person, DEMOG_COLS, w="asecwt", groupby="state")
-# append US statistics as additional 'state'
-pop_df = pop_states.append(pop_us)
-# melt df from wide to long format
-pop_df = pop_df.melt(ignore_index=False, var_name="demog")
-pop_df.insert(loc=1, column="metric", value="pop")
-
-# concat poverty and population dfs
-demog_stats = pd.concat([pov_df, pop_df])
-# write to csv file
-demog_stats.to_csv("demog_stats.csv.gz", compression="gzip")
-
-# Caluclate original gini
-person["spm_resources_per_person"] = person.spmtotres / person.numper
-# Caluclate original gini for US
-gini_us = pd.Series(mdf.gini(df=person, col="spm_resources_per_person", w="asecwt"))
-# add name to series
-gini_us.index = ["US"]
-
-
-# calculate gini for each group by state
-gini_states = mdf.gini(
-    df=person, col="spm_resources_per_person", w="asecwt", groupby="state"
-)
-
-# append US statistics as additional 'state'
-gini_ser = gini_states.append(gini_us)
-gini_ser.name = "gini"
-
-# Calculate the original poverty gap
-spmu["poverty_gap"] = np.where(
-    spmu.spmtotres < spmu.spmthresh,
-    spmu.spmthresh - spmu.spmtotres,
-    0,
-)
-poverty_gap_us = pd.Series(mdf.weighted_sum(spmu, "poverty_gap", w="spmwt"))
-# add name to series
-poverty_gap_us.index = ["US"]
-# calculate gini for each group by state
-poverty_gap_states = mdf.weighted_sum(spmu, "poverty_gap", w="spmwt", groupby="state")
-# append US statistics as additional 'state'
-poverty_gap_ser = poverty_gap_states.append(poverty_gap_us)
-poverty_gap_ser.name = "poverty_gap"
-
-# calculate the sum total of everyone's resources in US
-total_resources_us = pd.Series(mdf.weighted_sum(spmu, "spmtotres", w="spmwt"))
-# add name to series
-total_resources_us.index = ["US"]
-# calculate gini for each group by state
-total_resources_state = mdf.weighted_sum(
-    df=spmu, col="spmtotres", w="spmwt", groupby="state"
-)
-# append US statistics as additional 'state'
-total_resources_state = total_resources_state.append(total_resources_us)
-total_resources_state.name = "total_resources"
-
-# merge "total_resources","gini","poverty gap" into 1 df
-all_state_stats = (
-    poverty_gap_ser.to_frame()
-    .join(total_resources_state.to_frame())
-    .join(gini_ser.to_frame())
-)
-
-
-all_state_stats.to_csv("all_state_stats.csv.gz", compression="gzip")
+
+def read_extract(path):
+    """returns the persons of an IPUMS extract with the columns derived from
+    the raw variables, weighted as annual totals of their year"""
+    # Import data from Ipums
+    person = pd.read_csv(path)
+    # lower column names
+    person.columns = person.columns.str.lower()
+
+    # Create booleans for demographics
+    person["adult"] = person.age >= 18
+    person["child"] = person.age < 18
+
+    # create mutually exclusive white non-hisp/black non-hisp/hispanic groups
+    person["hispanic"] = person.hispan.between(1, 699)
+    person["black"] = (person.race == 200) & (~person.hispanic)
+    person["white"] = (person.race == 100) & (~person.hispanic)
+    # check to make sure persons are double counted
+    assert person[["black", "hispanic", "white"]].sum(axis=1).max() == 1
+
+    person["pwd"] = person.diffany == 2
+    person["non_citizen"] = person.citizen == 5
+    person["non_citizen_child"] = (person.citizen == 5) & person.child
+    person["non_citizen_adult"] = (person.citizen == 5) & person.adult
+
+    # Remove NIUs
+    person["adjginc"].replace({99999999: 0}, inplace=True)
+    person["fedtaxac"].replace({99999999: 0}, inplace=True)
+    person["taxinc"].replace({9999999: 0}, inplace=True)
+    person["stataxac"].replace({9999999: 0}, inplace=True)
+    person["incss"].replace({999999: 0}, inplace=True)
+    person["incunemp"].replace({999999: 0}, inplace=True)
+    person["incssi"].replace({999999: 0}, inplace=True)
+    person["ctccrd"].replace({999999: 0}, inplace=True)
+    person["incunemp"].replace({99999: 0}, inplace=True)
+    person["actccrd"].replace({99999: 0}, inplace=True)
+    person["fica"].replace({99999: 0}, inplace=True)
+    person["eitcred"].replace({9999: 0}, inplace=True)
+
+    # Change fip codes to state names
+    person["state"] = (
+        person["statefip"].astype(str)
+        # pad leading zero or wrong number of states
+        .apply("{:0>2}".format)
+        # lookup full state name from fips code
+        .apply(lambda x: us.states.lookup(x))
+        # change us package formatting to string
+        .astype(str)
+    )
+
+    # drop original statefip column from dataframe
+    person.drop(columns=["statefip"], inplace=True)
+
+    # Aggregate deductible and refundable child tax credits
+    person["ctc"] = person.ctccrd + person.actccrd
+
+    # Calculate the number of people per smp unit
+    person["person"] = 1
+    spm = person.groupby(["spmfamunit", "year"])[["person"]].sum()
+    spm.columns = ["numper"]
+    person = person.merge(spm, left_on=["spmfamunit", "year"], right_index=True)
+
+    person["weighted_state_tax"] = person.asecwt * person.stataxac
+    person["weighted_agi"] = person.asecwt * person.adjginc
+
+    # create boolean column for individual's poverty status, 1=poor
+    person["poor"] = person.spmthresh > person.spmtotres
+    person["spm_resources_per_person"] = person.spmtotres / person.numper
+    return person
+
+
+def _with_us(by_state, us_total):
+    """returns totals by state followed by the US total"""
+    return pd.concat([by_state, us_total.to_frame("US").T])
+
+
+def demog_sums(person):
+    """returns the weighted population (pop) and people in poverty (poor) of
+    each demographic, by state and for the US, in long format"""
+    pop = person[DEMOG_COLS].multiply(person.asecwt, axis=0)
+    poor = pop.multiply(person.poor, axis=0)
+    sums = []
+    for metric, values in [("pop", pop), ("poor", poor)]:
+        by_state = _with_us(values.groupby(person.state).sum(), values.sum())
+        sums.append(
+            by_state.melt(ignore_index=False, var_name="demog", value_name=metric)
+        )
+    # both melted in the same order, demographic by demographic
+    sums = sums[0].assign(poor=sums[1].poor.to_numpy())
+    return sums.rename_axis("state").reset_index()
+
+
+def state_sums(person, spmu):
+    """returns the weighted poverty gap, total resources, state tax and AGI
+    of each state and the US"""
+    poverty_gap = spmu.spmwt * np.maximum(spmu.spmthresh - spmu.spmtotres, 0)
+    unit_sums = pd.DataFrame(
+        {
+            "poverty_gap": poverty_gap,
+            "total_resources": spmu.spmwt * spmu.spmtotres,
+        }
+    )
+    unit_sums = _with_us(unit_sums.groupby(spmu.state).sum(), unit_sums.sum())
+    person_sums = person[list(STATE_TAX_COLUMNS)]
+    person_sums = _with_us(person_sums.groupby(person.state).sum(), person_sums.sum())
+    return unit_sums.join(person_sums)
+
+
+def get_demog_stats(sums, n_years=1):
+    """returns the poverty rate and population of each demographic, by state
+    and for the US, in long format
+
+    Args:
+        sums: demog_sums(), added up over n_years years
+        n_years: number of years the weights are divided between
+    """
+    sums = sums.set_index("state")
+    pov_df = sums[["demog"]].assign(metric="pov_rate", value=sums.poor / sums["pop"])
+    pop_df = sums[["demog"]].assign(metric="pop", value=sums["pop"] / n_years)
+    # concat poverty and population dfs
+    return pd.concat([pov_df, pop_df])
+
+
+def get_all_state_stats(sums, points, n_years=1):
+    """returns the poverty gap, total resources and gini index of each
+    state and the US
+
+    Args:
+        sums: state_sums(), added up over n_years years
+        points: dict of the gini_points() of every year merged, in increasing
+            order of resources per person
+        n_years: number of years the weights are divided between
+    """
+    codes, states = pd.factorize(points["state"], sort=True)
+    gini_ser = pd.Series(
+        grouped_gini(
+            points["resources"], points["weight"], codes, len(states), presorted=True
+        ),
+        index=states,
+    )
+    gini_ser["US"] = gini(points["resources"], points["weight"], presorted=True)
+    stats = sums[["poverty_gap", "total_resources"]] / n_years
+    stats["gini"] = gini_ser
+    return stats.rename_axis(None)
+
+
+def gini_points(person):
+    """returns the resources per person, weight and state of every person,
+    in increasing order of resources"""
+    order = np.argsort(person.spm_resources_per_person.to_numpy(), kind="stable")
+    return {
+        "resources": person.spm_resources_per_person.to_numpy()[order],
+        "weight": person.asecwt.to_numpy()[order],
+        "state": person.state.to_numpy().astype(str)[order],
+    }
+
+
+def merge_points(partitions):
+    """returns the gini_points() of several years merged in increasing order
+
+    Each year is already sorted, so the stable sort of their concatenation
+    merges the sorted runs.
+    """
+    points = {
+        column: np.concatenate([points[column] for points in partitions])
+        for column in ["resources", "weight", "state"]
+    }
+    order = np.argsort(points["resources"], kind="stable")
+    return {column: values[order] for column, values in points.items()}
+
+
+def partition_path(year, filename=None):
+    """returns the directory of a year in PARTITION_DIR, or a file in it"""
+    directory = os.path.join(PARTITION_DIR, str(year))
+    return directory if filename is None else os.path.join(directory, filename)
+
+
+def write_partition(person, year):
+    """writes the files of one survey year to PARTITION_DIR/YEAR/"""
+    spmu = (
+        person.groupby(SPMU_COLUMNS, observed=False)[PERSON_COLUMNS].sum().reset_index()
+    )
+    spmu[["fica", "fedtaxac", "stataxac"]] *= -1
+    spmu.rename(columns={"person": "numper"}, inplace=True)
+
+    # written to a temporary directory first, so a partition is complete
+    # once its directory exists
+    directory = partition_path(year)
+    tmp = directory + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    person_store = data.person_store(person, spmu)
+    np.savez(
+        os.path.join(tmp, "person.npz"),
+        **{col: person_store[col].to_numpy() for col in person_store},
+    )
+    np.savez(os.path.join(tmp, "gini_points.npz"), **gini_points(person))
+    demog_sums(person).to_csv(
+        os.path.join(tmp, "demog_sums.csv.gz"), index=False, compression="gzip"
+    )
+    state_sums(person, spmu).to_csv(
+        os.path.join(tmp, "state_sums.csv.gz"), compression="gzip"
+    )
+    person.to_csv(os.path.join(tmp, "person.csv.gz"), compression="gzip")
+    spmu.to_csv(os.path.join(tmp, "spmu.csv.gz"), compression="gzip")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+
+
+def partitioned_years():
+    """returns the survey years in PARTITION_DIR"""
+    if not os.path.isdir(PARTITION_DIR):
+        return []
+    return sorted(
+        int(name)
+        for name in os.listdir(PARTITION_DIR)
+        if name.isdigit() and os.path.isdir(partition_path(name))
+    )
+
+
+def _add_state_taxes(spmu, state_taxes):
+    """returns spmu with the pooled state tax totals of each unit's state
+    after its state column"""
+    position = spmu.columns.get_loc("state") + 1
+    for offset, column in enumerate(STATE_TAX_COLUMNS.values()):
+        spmu.insert(position + offset, column, spmu.state.map(state_taxes[column]))
+    return spmu
+
+
+def combine(years):
+    """writes the pooled files of the app from the partitions of years"""
+    n_years = len(years)
+    sums = {
+        year: pd.read_csv(partition_path(year, "state_sums.csv.gz"), index_col=0)
+        for year in years
+    }
+    # state tax revenue and taxable income of each state, with pooled weights
+    state_taxes = (
+        sum(sums.values())[list(STATE_TAX_COLUMNS)].rename(columns=STATE_TAX_COLUMNS)
+        / n_years
+    )
+
+    # the units of every year, in year order so the app can slice out a
+    # single year without filtering
+    spmu = []
+    person_store = []
+    for year in years:
+        year_spmu = pd.read_csv(partition_path(year, "spmu.csv.gz"), index_col=0)
+        year_spmu["spmwt"] /= n_years
+        with np.load(partition_path(year, "person.npz")) as store:
+            year_store = pd.DataFrame({col: store[col] for col in store.files})
+        year_store["unit"] += sum(len(units) for units in spmu)
+        year_store["asecwt"] /= n_years
+        spmu.append(_add_state_taxes(year_spmu, state_taxes))
+        person_store.append(year_store)
+    spmu = pd.concat(spmu, ignore_index=True)
+    person_store = pd.concat(person_store, ignore_index=True).astype(
+        data.PERSON_STORE_COLUMNS
+    )
+
+    # the slim person table the app serves from: the row of each person's unit
+    # in spmu, their weight and their demographic flags packed into one code
+    np.savez(
+        "person.npz", **{col: person_store[col].to_numpy() for col in person_store}
+    )
+
+    # baseline poverty of each demographic code, so the app can break poverty
+    # down by any intersection of the flags
+    data.demog_code_cube(person_store, spmu).to_csv(
+        "demog_code_stats.csv.gz", compression="gzip"
+    )
+
+    # baseline income decile of each unit, nationally and within its state
+    unit_weights = np.bincount(person_store.unit, person_store.asecwt, len(spmu))
+    spmu = spmu.join(data.income_deciles(spmu, unit_weights))
+    spmu.to_csv("spmu.csv.gz", compression="gzip")
+
+    # weighted totals of the repealable taxes and benefits and of the people
+    # eligible for UBI, by state and year, so the app looks up revenue and UBI
+    # population instead of summing over every SPM unit
+    data.weighted_total_cube(spmu).to_csv("weighted_totals.csv.gz", compression="gzip")
+
+    # the full person table is kept for offline analysis, copied a chunk at
+    # a time with pooled weights
+    if os.path.exists("person.csv.gz"):
+        os.remove("person.csv.gz")
+    header = True
+    for year in years:
+        for chunk in pd.read_csv(
+            partition_path(year, "person.csv.gz"), index_col=0, chunksize=100_000
+        ):
+            chunk[["asecwt", "spmwt"]] /= n_years
+            chunk[list(STATE_TAX_COLUMNS)] /= n_years
+            chunk = chunk.drop(columns=["poor", "spm_resources_per_person"])
+            chunk.join(state_taxes, on="state").to_csv(
+                "person.csv.gz", mode="a", header=header, compression="gzip"
+            )
+            header = False
+
+    # pooled baseline statistics, from the sums of every year
+    demog = [pd.read_csv(partition_path(year, "demog_sums.csv.gz")) for year in years]
+    pooled_demog = (
+        pd.concat(demog)
+        .groupby(["state", "demog"], sort=False)[["pop", "poor"]]
+        .sum()
+        .reset_index()
+    )
+    # import baseline white/black/child etc. poverty rates & population
+    get_demog_stats(pooled_demog, n_years).to_csv(
+        "demog_stats.csv.gz", compression="gzip"
+    )
+    points = {}
+    for year in years:
+        with np.load(partition_path(year, "gini_points.npz")) as year_points:
+            points[year] = {column: year_points[column] for column in year_points}
+    all_state_stats = get_all_state_stats(
+        sum(sums.values()), merge_points(points.values()), n_years
+    )
+    all_state_stats.to_csv("all_state_stats.csv.gz", compression="gzip")
+
+    # the same statistics for each year on its own, weighted as annual
+    # totals, so the app can analyse one year at a time
+    demog_stats_by_year = []
+    all_state_stats_by_year = []
+    for year, year_demog in zip(years, demog):
+        year_demog_stats = get_demog_stats(year_demog)
+        year_demog_stats.insert(loc=0, column="year", value=year)
+        demog_stats_by_year.append(year_demog_stats)
+
+        year_all_state_stats = get_all_state_stats(sums[year], points[year])
+        year_all_state_stats.insert(loc=0, column="year", value=year)
+        all_state_stats_by_year.append(year_all_state_stats)
+
+    pd.concat(demog_stats_by_year).to_csv(
+        "demog_stats_by_year.csv.gz", compression="gzip"
+    )
+    pd.concat(all_state_stats_by_year).to_csv(
+        "all_state_stats_by_year.csv.gz", compression="gzip"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("extracts", nargs="*", default=["cps_00041.csv.gz"])
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="process every year of the extracts, even if already partitioned",
+    )
+    args = parser.parse_args()
+
+    done = set(partitioned_years())
+    for extract in args.extracts:
+        person = read_extract(extract)
+        for year, year_person in person.groupby("year"):
+            if year in done and not args.rebuild:
+                print(f"{year}: already partitioned, skipped")
+                continue
+            write_partition(year_person, year)
+            done.add(year)
+            print(f"{year}: partitioned")
+    combine(sorted(done))
@@ -0,0 +1,154 @@
+"""On-demand CPU and allocation profiles of single requests.
+
+With PROFILE_DIR set, an output callback request is profiled when it has a
+PROFILE_HEADER header equal to PROFILE_TOKEN, or at random with probability
+PROFILE_SAMPLE_RATE. The callback then runs without the result caches, so
+the profile covers the whole computation, under cProfile and tracemalloc,
+and a capture directory is written to PROFILE_DIR with:
+    profile.pstats: the CPU profile, read with `python -m pstats` or snakeviz
+    allocations.txt: the peak traced memory and the lines holding the most
+        memory when the callback returned
+    spec.json: the scenario, the callback and its timings
+
+A worker profiles one request at a time, others run as usual meanwhile.
+cProfile only sees the profiled thread, but tracemalloc traces every
+thread, so allocations of concurrent requests can show up in the report.
+
+The captures are listed and downloaded from the routes wsgi.py adds, see
+authorized().
+"""
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+
+import flask
+
+import cache
+
+# directory the captures are written to, profiling is off when unset
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+# secret of the profile trigger header and of the routes listing captures
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_HEADER = "X-Profile"
+# fraction of requests profiled without a trigger
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+# lines listed in allocations.txt
+TOP_ALLOCATIONS = 25
+# frames kept for each traced allocation
+TRACEMALLOC_FRAMES = 10
+
+CAPTURE_FILES = ["profile.pstats", "allocations.txt", "spec.json"]
+
+_lock = threading.Lock()
+
+
+def requested():
+    """returns True if the current request should be profiled"""
+    if not PROFILE_DIR:
+        return False
+    if PROFILE_TOKEN and flask.request.headers.get(PROFILE_HEADER) == PROFILE_TOKEN:
+        return True
+    return random.random() < PROFILE_SAMPLE_RATE
+
+
+def authorized():
+    """returns True if the current request may read the captures
+
+    The token is passed in the PROFILE_HEADER header or the token query
+    parameter, and the routes are disabled when PROFILE_TOKEN is unset.
+    """
+    token = flask.request.headers.get(PROFILE_HEADER) or flask.request.args.get("token")
+    return bool(PROFILE_TOKEN) and token == PROFILE_TOKEN
+
+
+def capture(key, output, is_stale=None, args=()):
+    """returns output(key, *args, is_stale=is_stale), profiled into a new
+    capture directory
+
+    Runs output unprofiled if this worker is already profiling a request.
+
+    Args:
+        key: app.Scenario of the request
+        output: one of the output functions of app.py
+        is_stale: see cache.ResultCache.get()
+        args: other arguments of output
+    """
+    if not _lock.acquire(blocking=False):
+        return output(key, *args, is_stale=is_stale)
+    try:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        error = None
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            with cache.uncached():
+                result = profile.runcall(output, key, *args, is_stale=is_stale)
+        except Exception as exc:
+            error = exc
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+
+        directory = os.path.join(
+            PROFILE_DIR,
+            "{}-{}-{}-{}".format(
+                time.strftime("%Y%m%dT%H%M%S"),
+                os.getpid(),
+                output.__name__,
+                uuid.uuid4().hex[:6],
+            ),
+        )
+        os.makedirs(directory)
+        profile.dump_stats(os.path.join(directory, "profile.pstats"))
+        with open(os.path.join(directory, "allocations.txt"), "w") as f:
+            f.write(f"peak traced memory: {peak / 2**20:.1f} MB\n")
+            f.write(f"top {TOP_ALLOCATIONS} lines by memory held at return:\n")
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                f.write(f"{stat}\n")
+        with open(os.path.join(directory, "spec.json"), "w") as f:
+            json.dump(
+                {
+                    "scenario": key._asdict(),
+                    "callback": output.__name__,
+                    "args": args,
+                    "wall_seconds": wall,
+                    "cpu_seconds": cpu,
+                    "peak_traced_mb": peak / 2**20,
+                    "error": None if error is None else repr(error),
+                    "pid": os.getpid(),
+                },
+                f,
+                indent=2,
+            )
+    finally:
+        _lock.release()
+    if error is not None:
+        raise error
+    return result
+
+
+def captures():
+    """returns the capture directories in PROFILE_DIR, newest first, with
+    their spec.json"""
+    if not PROFILE_DIR or not os.path.isdir(PROFILE_DIR):
+        return []
+    listing = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        try:
+            with open(os.path.join(PROFILE_DIR, name, "spec.json")) as f:
+                spec = json.load(f)
+        except (OSError, ValueError):
+            # still being written, or not a capture
+            continue
+        listing.append({"name": name, "files": CAPTURE_FILES, "spec": spec})
+    return listing
@@ -0,0 +1,241 @@
+"""Rules of a reform, as linear combinations of the spmu columns.
+
+A Spec describes the levers of a reform: the level, the flat tax on AGI, the
+taxes and benefits repealed and the groups receiving UBI. resource_terms()
+(repeal_terms() plus tax_terms()) and eligibility_terms() turn it into terms,
+a dict of {column: coefficient}, and compile_plan() fuses terms into one
+expression that evaluate() computes for every unit in a single pass, with
+numexpr if it is installed or with in-place ufuncs otherwise. A new lever
+adds terms to that expression rather than another pass over the data.
+
+Terms are evaluated on columns by name, from a dataframe, a dict of arrays or
+a series of weighted totals (see data.weighted_total()), since the weighted
+total of a linear combination is the same combination of weighted totals.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:  # optional, plans are then evaluated with numpy ufuncs
+    numexpr = None
+
+# columns that are the positive part of another column, so the flat tax can
+# be a term without storing the column for every unit
+POSITIVE_PART_COLUMNS = {"positive_adjginc": "adjginc"}
+
+# tax credits are part of income taxes, so are not repealed twice
+INCOME_TAX_CREDITS = ["ctc", "eitcred"]
+
+Spec = namedtuple("Spec", ["level", "agi_tax", "repeals", "include"])
+Spec.__doc__ = """levers of a reform
+
+Args:
+    level: component_id="level"
+    agi_tax: component_id="agi-slider"
+    repeals: tuple of repealed taxes and benefits, only "fedtaxac" (the state
+        income tax, stataxac) at the state level
+    include: tuple of groups receiving UBI, component_id="include-checklist"
+"""
+
+# a base column plus terms and scaled terms as (column, coefficient) pairs,
+# and the numexpr expression of them, whose coefficients (c0, c1, ... and d0,
+# d1, ...) and scale are passed in at evaluation, see compile_plan()
+Plan = namedtuple("Plan", ["base", "terms", "scaled", "expression"])
+
+
+def from_inputs(level, agi_tax, benefits, taxes, include):
+    """returns the Spec of the dashboard's inputs, see app.compute_outputs()"""
+    repeals = taxes + benefits if level == "federal" else taxes
+    return Spec(level, agi_tax, tuple(repeals), tuple(include))
+
+
+def combine(terms, other, scale=1):
+    """returns terms plus scale times other, without terms that cancel out"""
+    result = dict(terms)
+    for column, coefficient in other.items():
+        result[column] = result.get(column, 0) + scale * coefficient
+    return {column: c for column, c in result.items() if c != 0}
+
+
+def repeal_terms(spec):
+    """returns the change in each unit's resources from the repeals"""
+    terms = {}
+    if spec.level == "state":
+        # the income tax repealed at the state level is the state income tax
+        if "fedtaxac" in spec.repeals:
+            terms["stataxac"] = -1
+        return terms
+
+    for tax_benefit in spec.repeals:
+        terms[tax_benefit] = -1
+    if "fedtaxac" in spec.repeals:
+        for credit in INCOME_TAX_CREDITS:
+            if credit in spec.repeals:
+                terms[credit] = 0
+    return combine(terms, {})
+
+
+def tax_terms(spec):
+    """returns the change in each unit's resources from the flat tax on AGI"""
+    tax_rate = spec.agi_tax / 100
+    if spec.level == "state":
+        return combine({}, {"adjginc": -tax_rate})
+    # the flat tax only applies to positive AGI
+    return combine({}, {"positive_adjginc": -tax_rate})
+
+
+def resource_terms(spec):
+    """returns the change in each unit's resources from repeals and new taxes
+
+    The change is before UBI, which is what the repeals and new taxes fund.
+    """
+    return combine(repeal_terms(spec), tax_terms(spec))
+
+
+def eligibility_terms(include):
+    """returns the number of people in each unit receiving UBI
+
+    Args:
+        include: component_id="include-checklist"
+    """
+    terms = {"numper": 1}
+    if "children" not in include:
+        terms["child"] = -1
+    if "non_citizens" not in include:
+        terms["non_citizen"] = -1
+    if ("children" not in include) and ("non_citizens" not in include):
+        # non-citizen children were subtracted twice
+        terms["non_citizen_child"] = 1
+    if "adults" not in include:
+        terms["adult"] = -1
+    if ("adults" not in include) and ("non_citizens" not in include):
+        terms["non_citizen_adult"] = 1
+    return terms
+
+
+def _expression(terms, prefix):
+    """returns the numexpr expression of terms with coefficients prefix0, ..."""
+    parts = []
+    for i, column in enumerate(terms):
+        if column in POSITIVE_PART_COLUMNS:
+            source = POSITIVE_PART_COLUMNS[column]
+            column = f"where({source} > 0, {source}, 0.0)"
+        parts.append(f"{prefix}{i} * {column}")
+    return " + ".join(parts)
+
+
+def compile_plan(terms, base=None, scaled=None):
+    """returns the Plan computing base + terms + scale * scaled
+
+    The expression only depends on the columns, so numexpr reuses it for
+    every agi_tax and UBI amount. Scaled terms are summed before they are
+    multiplied by the scale passed to evaluate(), so counts of people stay
+    exact, and a unit whose count is zero keeps exactly its other terms.
+
+    Args:
+        terms: dict of {column: coefficient}
+        base: column the terms are added to, or None to start from zero
+        scaled: dict of {column: coefficient}, or None
+    """
+    parts = [base] if base else []
+    if terms:
+        parts.append(_expression(terms, "c"))
+    if scaled:
+        parts.append(f"scale * ({_expression(scaled, 'd')})")
+    return Plan(
+        base,
+        tuple(terms.items()),
+        tuple((scaled or {}).items()),
+        " + ".join(parts) or "0.0",
+    )
+
+
+def total(terms, totals):
+    """returns the sum of coefficient * total of each column of terms
+
+    Args:
+        terms: dict of {column: coefficient}
+        totals: weighted totals, see data.weighted_total()
+    """
+    return sum(coefficient * totals[column] for column, coefficient in terms.items())
+
+
+def _accumulate(result, terms, columns, scratch):
+    """adds coefficient * column of each of terms to result in place"""
+    for column, coefficient in terms:
+        if column in POSITIVE_PART_COLUMNS:
+            source = np.asarray(columns[POSITIVE_PART_COLUMNS[column]])
+            values = np.maximum(source, 0, out=scratch)
+        else:
+            values = np.asarray(columns[column])
+        if coefficient == 1:
+            np.add(result, values, out=result)
+        elif coefficient == -1:
+            np.subtract(result, values, out=result)
+        else:
+            np.multiply(values, coefficient, out=scratch)
+            np.add(result, scratch, out=result)
+
+
+def evaluate(plan, columns, scale=1):
+    """returns the plan's value for every unit as a float array
+
+    Args:
+        plan: see compile_plan()
+        columns: dataframe or dict of arrays with a row per unit
+        scale: multiplies the plan's scaled terms
+    """
+    names = [plan.base] if plan.base else []
+    names += [
+        POSITIVE_PART_COLUMNS.get(column, column)
+        for column, _ in plan.terms + plan.scaled
+    ]
+    if numexpr is not None:
+        local_dict = {name: np.asarray(columns[name]) for name in names}
+        local_dict.update({f"c{i}": c for i, (_, c) in enumerate(plan.terms)})
+        local_dict.update({f"d{i}": c for i, (_, c) in enumerate(plan.scaled)})
+        local_dict["scale"] = scale
+        return numexpr.evaluate(plan.expression, local_dict=local_dict)
+
+    # in-place ufuncs, with at most two arrays besides the result however
+    # many terms there are
+    n = len(columns[names[0]]) if names else 0
+    if plan.base:
+        result = np.array(columns[plan.base], dtype="float")
+    else:
+        result = np.zeros(n)
+    scratch = np.empty(n)
+    _accumulate(result, plan.terms, columns, scratch)
+    if plan.scaled:
+        scaled = np.zeros(n)
+        _accumulate(scaled, plan.scaled, columns, scratch)
+        np.multiply(scaled, scale, out=scaled)
+        np.add(result, scaled, out=result)
+    return result
+
+
+def numper_ubi(columns, include):
+    """returns the number of people recieving UBI
+
+    Args:
+        columns: numper, child, adult, non_citizen, non_citizen_child and
+            non_citizen_adult, per unit or weighted totals
+        include: component_id="include-checklist"
+    """
+    terms = eligibility_terms(include)
+    if np.ndim(columns["numper"]) == 0:
+        return total(terms, columns)
+    return evaluate(compile_plan(terms), columns)
+
+
+def revenue(totals, spec):
+    """returns the revenue raised by a reform's repeals and flat tax on AGI
+
+    Args:
+        totals: weighted totals of the funding population, see
+            data.weighted_total()
+        spec: see Spec
+    """
+    return -total(resource_terms(spec), totals)
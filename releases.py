@@ -0,0 +1,185 @@
+"""Versioned releases of the data, switched to by running workers.
+
+`python releases.py publish` converts the files pre-processing.py wrote to
+DATA_DIR into a new release in DATA_RELEASES, and makes it the current one.
+A release is a directory of:
+    spmu/ and person/: a .npy file per column of data.SPMU_COLUMNS and
+        data.PERSON_STORE_COLUMNS, category columns as their codes
+    unit_person_weights.npy, eligible_counts.npy and replicate_counts.npy:
+        the arrays each worker would otherwise compute, see data.py and
+        bootstrap.py
+    the baseline statistics files of STATS_FILES
+    manifest.json: the categories of the category columns, the strata of
+        replicate_counts.npy, and where and when the release was made
+Workers memory-map the .npy files read-only, so every worker shares the pages
+of a release in the page cache instead of parsing its own copy.
+
+A release is written to a temporary directory and renamed into place, then
+the CURRENT file naming the current release is replaced, so workers never
+see half a release. Each worker reads CURRENT every RELEASE_POLL_SECONDS and
+switches to a new release between requests, see warmup.watch_releases().
+`python releases.py current VERSION` points CURRENT at an older release, to
+roll back.
+
+`python releases.py prune` deletes all but the newest releases, and never the
+current one. Workers keep the files of a deleted release they have mapped,
+but nothing checks whether a release is still being read: files a worker
+has not opened yet are gone, so only prune once every worker has switched
+away from the releases it deletes.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import bootstrap
+import data
+
+# baseline statistics read by data.py, copied into each release when
+# pre-processing.py wrote them
+STATS_FILES = [
+    "all_state_stats.csv.gz",
+    "demog_stats.csv.gz",
+    "all_state_stats_by_year.csv.gz",
+    "demog_stats_by_year.csv.gz",
+]
+# releases kept by prune(), the current one included
+KEEP_RELEASES = 2
+
+
+def _save_table(directory, frame, columns, categories):
+    os.makedirs(directory)
+    for col, dtype in columns.items():
+        values = frame[col]
+        if dtype == "category":
+            categories[col] = values.cat.categories.tolist()
+            values = values.cat.codes
+        np.save(os.path.join(directory, col + ".npy"), values.to_numpy())
+
+
+def publish(version=None, source=None):
+    """writes a release of the data files in source and makes it current
+
+    Args:
+        version: name of the release, the current time by default
+        source: directory of the files of pre-processing.py, DATA_DIR by
+            default
+
+    Returns:
+        the name of the release
+    """
+    version = version or time.strftime("%Y%m%dT%H%M%S")
+    source = os.path.abspath(source or data.DATA_DIR)
+    os.makedirs(data.DATA_RELEASES, exist_ok=True)
+    tmp_dir = os.path.join(data.DATA_RELEASES, f".{version}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    categories = {}
+    with data.pinned(data.Dataset(source)):
+        person, spmu = data.microdata()
+        _save_table(
+            os.path.join(tmp_dir, "person"),
+            person,
+            data.PERSON_STORE_COLUMNS,
+            categories,
+        )
+        _save_table(os.path.join(tmp_dir, "spmu"), spmu, data.SPMU_COLUMNS, categories)
+        for name, array in [
+            ("unit_person_weights", data.unit_person_weights()),
+            ("eligible_counts", data.eligible_counts()),
+            ("replicate_counts", bootstrap.replicate_counts()),
+        ]:
+            np.save(os.path.join(tmp_dir, name + ".npy"), array)
+        for filename in STATS_FILES:
+            if os.path.exists(os.path.join(source, filename)):
+                shutil.copy(os.path.join(source, filename), tmp_dir)
+        # computed from the microdata if pre-processing.py did not write them
+        data.weighted_totals().to_csv(os.path.join(tmp_dir, "weighted_totals.csv.gz"))
+        data.demog_code_stats().to_csv(os.path.join(tmp_dir, "demog_code_stats.csv.gz"))
+
+    with open(os.path.join(tmp_dir, data.RELEASE_MANIFEST), "w") as f:
+        json.dump(
+            {
+                "version": version,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "source": source,
+                "categories": categories,
+                "replicate_strata": bootstrap.STRATA,
+            },
+            f,
+            indent=2,
+        )
+    os.rename(tmp_dir, os.path.join(data.DATA_RELEASES, version))
+    make_current(version)
+    return version
+
+
+def make_current(version):
+    """points the CURRENT file at a release, atomically"""
+    if not os.path.exists(os.path.join(data.DATA_RELEASES, version)):
+        raise FileNotFoundError(f"no release {version} in {data.DATA_RELEASES}")
+    tmp_path = os.path.join(data.DATA_RELEASES, data.CURRENT + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version + "\n")
+    os.replace(tmp_path, os.path.join(data.DATA_RELEASES, data.CURRENT))
+
+
+def releases():
+    """returns the names of the releases in DATA_RELEASES, oldest first"""
+    names = [
+        name
+        for name in os.listdir(data.DATA_RELEASES)
+        if os.path.exists(os.path.join(data.DATA_RELEASES, name, data.RELEASE_MANIFEST))
+    ]
+    return sorted(
+        names,
+        key=lambda name: os.path.getmtime(
+            os.path.join(data.DATA_RELEASES, name, data.RELEASE_MANIFEST)
+        ),
+    )
+
+
+def prune(keep=KEEP_RELEASES):
+    """deletes all but the keep newest releases, and never the current one
+
+    Returns:
+        the names of the deleted releases
+    """
+    current = data.current_release()
+    names = releases()
+    old = [name for name in names[: max(len(names) - keep, 0)] if name != current]
+    for name in old:
+        shutil.rmtree(os.path.join(data.DATA_RELEASES, name))
+    return old
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    publish_parser = commands.add_parser("publish")
+    publish_parser.add_argument("--version", default=None)
+    publish_parser.add_argument("--source", default=None)
+    current_parser = commands.add_parser("current")
+    current_parser.add_argument("version")
+    prune_parser = commands.add_parser("prune")
+    prune_parser.add_argument("--keep", type=int, default=KEEP_RELEASES)
+    commands.add_parser("list")
+    args = parser.parse_args()
+    if not data.DATA_RELEASES:
+        parser.error("set DATA_RELEASES to the directory of the releases")
+
+    if args.command == "publish":
+        print(publish(args.version, args.source))
+    elif args.command == "current":
+        make_current(args.version)
+    elif args.command == "prune":
+        for name in prune(args.keep):
+            print("deleted", name)
+    else:
+        current = data.current_release()
+        for name in releases():
+            print(name, "(current)" if name == current else "")
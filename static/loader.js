@@ -0,0 +1,102 @@
+// Renders the dashboard's outputs from a static export, see export.py.
+//
+//     ubiStatic.render("https://example.com/ubi-export/", {
+//         state: "US", level: "federal", agi_tax: 10,
+//         benefits: [], taxes: [], include: ["adults", "children"],
+//     });
+//
+// fetches index.json once and the shard of the inputs' state, level and
+// repeals, then fills the elements with the dashboard's ids: the summary
+// lines and the econ-graph, breakdown-graph and decile-graph figures, drawn
+// with Plotly from the skeletons of figures.py.
+(function () {
+    const LINE_IDS = [
+        "ubi-output",
+        "revenue-output",
+        "ubi-population-output",
+        "winners-output",
+        "resources-output",
+    ];
+    const cache = {};
+
+    function fetchJson(url) {
+        if (!(url in cache)) {
+            cache[url] = fetch(url).then(function (response) {
+                if (!response.ok) {
+                    throw new Error(url + ": " + response.status);
+                }
+                return response.json();
+            });
+        }
+        return cache[url];
+    }
+
+    function sameSet(a, b) {
+        return a.length === b.length && a.every((value) => b.includes(value));
+    }
+
+    // the outputs of the inputs, as listed in export.py
+    async function load(baseUrl, inputs) {
+        const index = await fetchJson(baseUrl + "index.json");
+        let benefits = inputs.benefits;
+        let taxes = inputs.taxes;
+        if (inputs.level === "state") {
+            // a state-level reform can only repeal income taxes
+            benefits = [];
+            taxes = taxes.filter((tax) => tax === "fedtaxac");
+        }
+        const repeals = benefits.concat(taxes).sort().join("+") || "none";
+        const path = [inputs.level, inputs.state, repeals + ".json"]
+            .map(encodeURIComponent)
+            .join("/");
+        const shard = await fetchJson(baseUrl + path);
+
+        const levers = index.levers;
+        const i = levers.include.findIndex((include) =>
+            sameSet(include, inputs.include)
+        );
+        const j = levers.agi_tax.indexOf(inputs.agi_tax);
+        if (i < 0 || j < 0) {
+            throw new Error("inputs not in the export");
+        }
+        const outputs = shard.outputs[i * levers.agi_tax.length + j];
+        return {
+            figures: index.figures,
+            decileTitle: shard.decile_title,
+            lines: outputs[0],
+            econ: outputs[1],
+            breakdown: outputs[2],
+            yRange: outputs[3],
+            decileChange: outputs[4],
+            decileWinners: outputs[5],
+        };
+    }
+
+    function bars(skeleton, y, yRange) {
+        const figure = JSON.parse(JSON.stringify(skeleton));
+        figure.data[0].y = y;
+        figure.data[0].text = y;
+        figure.layout.yaxis.range = yRange;
+        return figure;
+    }
+
+    async function render(baseUrl, inputs) {
+        const out = await load(baseUrl, inputs);
+        LINE_IDS.forEach(function (id, k) {
+            document.getElementById(id).textContent = out.lines[k];
+        });
+        Plotly.react("econ-graph", bars(out.figures.econ, out.econ, out.yRange));
+        Plotly.react(
+            "breakdown-graph",
+            bars(out.figures.breakdown, out.breakdown, out.yRange)
+        );
+        const decile = JSON.parse(JSON.stringify(out.figures.decile));
+        decile.data[0].y = out.decileChange;
+        decile.data[1].y = out.decileWinners;
+        decile.layout.title.text = out.decileTitle;
+        Plotly.react("decile-graph", decile);
+        return out;
+    }
+
+    window.ubiStatic = { load: load, render: render };
+})();
@@ -0,0 +1,240 @@
+"""Stratified subsample of the microdata for previews while the slider is dragged.
+
+While the tax rate slider moves, ubi() runs the reform on a fixed subsample
+of SPM units instead of every unit, and the exact result replaces it when the
+slider is released. The subsample is drawn once, on first use (at load time
+in production, see wsgi.py):
+    - strata are the units of each state and survey year, so any state or
+      year the app shows is itself a stratified sample
+    - PREVIEW_FRACTION of the units of each stratum are drawn without
+      replacement, at least 2 * PREVIEW_GROUPS of them (or the whole stratum
+      when it is smaller), with the members of each drawn unit
+    - the weights of the drawn units and their members are multiplied by the
+      inverse of the stratum's sampling fraction, so totals estimate the
+      totals of the full data
+
+Revenue and the UBI population are looked up from the exact weighted totals
+of the full data (see data.weighted_total()), so the monthly UBI and funds
+for UBI of a preview are exact. So is the average change in resources per
+person: the UBI received less the revenue raised, both from those totals
+(see app.resource_change()), rather than the taxes paid by the subsample's
+units, which vary too much between samples. A state reform's preview is
+budget-neutral like its exact result. Only the outcomes measured over units
+are estimated: poverty, the poverty gap, the Gini index, percent better off
+and the breakdowns.
+
+The subsample estimates the change in an outcome far more precisely than
+the outcome itself, so a preview shows the exact baseline plus the change in
+the subsample (see difference_estimates()), which is exactly the baseline for
+a reform that changes nothing. Nobody is better off in the baseline, so
+percent better off is the subsample's winners over its own population, the
+ratio whose bounds intervals() measures, see app.compute_simulation().
+
+Error bounds: the drawn units of each stratum are dealt in turn to
+PREVIEW_GROUPS random groups, so each group is itself a stratified sample.
+intervals() measures the change in each outcome in every group and takes the
+spread of the group estimates (the random group variance estimator) as the
+standard error of the full subsample's estimate. The intervals are
++/- T_QUANTILE standard errors, a 90% interval like the bootstrap intervals of
+bootstrap.py, and are shown the same way. Every group gives the same change
+in resources per person, which has no sampling error, so its interval is
+the estimate itself.
+"""
+import math
+import os
+
+import numpy as np
+
+import data
+from metrics import gini, grouped_gini
+
+PREVIEW_FRACTION = float(os.environ.get("PREVIEW_FRACTION", 0.1))
+PREVIEW_GROUPS = 10
+SEED = 0
+
+# two-sided 90% quantile of Student's t with PREVIEW_GROUPS - 1 degrees of
+# freedom
+T_QUANTILE = 1.833
+
+
+@data.per_version
+def microdata():
+    """returns the subsample as a data.Microdata of person and spmu rows
+
+    Rows keep the labels (and persons the unit) of the full tables, so the
+    lookups of app.simulate() by row label work unchanged. spmu has an extra
+    preview_group column, see intervals().
+    """
+    person, spmu = data.microdata()
+    rng = np.random.default_rng(SEED)
+    rows, factors, groups = [], [], []
+    strata = spmu.groupby(["state", "year"], observed=True).indices
+    for stratum_rows in strata.values():
+        n = len(stratum_rows)
+        size = max(math.ceil(PREVIEW_FRACTION * n), 2 * PREVIEW_GROUPS)
+        drawn = rng.permutation(stratum_rows)[: min(size, n)]
+        rows.append(drawn)
+        factors.append(np.full(len(drawn), n / len(drawn)))
+        start = rng.integers(PREVIEW_GROUPS)
+        groups.append((start + np.arange(len(drawn))) % PREVIEW_GROUPS)
+    rows = np.concatenate(rows)
+    order = np.argsort(rows)
+    rows = rows[order]
+
+    # weight factor of each row of the full spmu table, 0 if not drawn
+    unit_factors = np.zeros(len(spmu))
+    unit_factors[rows] = np.concatenate(factors)[order]
+    sample_spmu = spmu.iloc[rows].copy()
+    sample_spmu["spmwt"] *= unit_factors[rows]
+    sample_spmu["preview_group"] = np.concatenate(groups)[order].astype("int8")
+
+    person_factors = unit_factors[person.unit.to_numpy()]
+    sample_person = person[person_factors > 0].copy()
+    sample_person["asecwt"] *= person_factors[person_factors > 0]
+    return data._shared_microdata(sample_person, sample_spmu)
+
+
+def year_partition(year):
+    """returns the subsample's person and spmu rows of a single survey year,
+    see data.year_partition()"""
+    person, spmu = microdata()
+    spmu = data._year_slice(spmu, year)
+    return data.Microdata(person=data._unit_slice(person, spmu.index), spmu=spmu)
+
+
+@data.per_version
+def baseline(state, year=None):
+    """returns the baseline outcomes estimated from the subsample
+
+    Args:
+        state: state selected in the dropdown, or "US"
+        year: a survey year, or None for all years pooled
+
+    Returns:
+        dict of the same totals as app.simulate() returns for a reform that
+        changes nothing: total_resources, total_poor, poverty_gap, gini and
+        poor_by_code
+    """
+    person, spmu = microdata() if year is None else year_partition(year)
+    scale = 1 if year is None else data.pooled_years()
+    if state != "US":
+        spmu = spmu[spmu.state == state]
+    # 1 + poverty of the units measured, 0 for the others, by row label
+    unit_poor = np.zeros(len(data.microdata().spmu), dtype="int8")
+    unit_poor[spmu.index] = 1 + (spmu.spmtotres < spmu.spmthresh)
+    person_poor = unit_poor[person.unit.to_numpy()]
+    person = person[person_poor > 0]
+    person_w = person.asecwt.to_numpy() * scale
+    poor = person_poor[person_poor > 0] == 2
+
+    spmwt = spmu.spmwt.to_numpy() * scale
+    unit_person_w = np.bincount(
+        person.unit.to_numpy(), person_w, len(data.microdata().spmu)
+    )[spmu.index]
+    return {
+        "total_resources": np.sum(spmwt * spmu.spmtotres.to_numpy()),
+        "total_poor": np.sum(person_w * poor),
+        "poverty_gap": np.sum(
+            spmwt * np.maximum(spmu.spmthresh - spmu.spmtotres, 0).to_numpy()
+        ),
+        "gini": gini(spmu.spmtotres / spmu.numper, unit_person_w),
+        "poor_by_code": np.bincount(
+            person.demog_code.to_numpy(), person_w * poor, data.N_DEMOG_CODES
+        ),
+    }
+
+
+def difference_estimates(results, state, year, exact):
+    """returns the results of a preview as changes from the exact baseline
+
+    The estimate of each outcome is its exact baseline plus the change in the
+    subsample, which varies far less between samples than the outcome
+    itself, and is exactly the baseline for a reform that changes nothing.
+
+    Args:
+        results: dict returned by app.simulate() for the subsample
+        state, year: see baseline()
+        exact: dict of the exact baseline total_poor, poverty_gap and gini
+
+    Returns:
+        a copy of results with those outcomes, poor_by_code and
+        population_by_code estimated from the exact baseline
+    """
+    sample = baseline(state, year)
+    results = dict(results)
+    for outcome, value in exact.items():
+        results[outcome] = value + results[outcome] - sample[outcome]
+
+    # the baseline by code is in pooled weights
+    scale = 1 if year is None else data.pooled_years()
+    population, poor = data.baseline_by_code(state, year)
+    results["poor_by_code"] = (
+        poor * scale + results["poor_by_code"] - sample["poor_by_code"]
+    )
+    results["population_by_code"] = population * scale
+    return results
+
+
+def _by_group(target_spmu, resources):
+    """returns the outcomes of target_spmu with resources in each group"""
+    groups = target_spmu.preview_group.to_numpy()
+    thresh = target_spmu.spmthresh.to_numpy()
+    person_w = target_spmu.person_weight.to_numpy()
+    population = np.bincount(groups, person_w, PREVIEW_GROUPS)
+    return {
+        "poverty_rate": np.bincount(
+            groups, person_w * (resources < thresh), PREVIEW_GROUPS
+        )
+        / population,
+        # each group is a 1 / PREVIEW_GROUPS sample, so totals are scaled up
+        "poverty_gap": np.bincount(
+            groups,
+            target_spmu.spmwt.to_numpy() * np.maximum(thresh - resources, 0),
+            PREVIEW_GROUPS,
+        )
+        * PREVIEW_GROUPS,
+        "gini": grouped_gini(
+            resources / target_spmu.numper.to_numpy(),
+            person_w,
+            groups,
+            PREVIEW_GROUPS,
+        ),
+        "winners": np.bincount(
+            groups,
+            person_w * (resources > target_spmu.spmtotres.to_numpy()),
+            PREVIEW_GROUPS,
+        )
+        / population
+        * 100,
+    }
+
+
+def intervals(target_spmu, estimates, baseline):
+    """returns error bounds of a preview's outcomes, as bootstrap.intervals()
+
+    Args:
+        target_spmu: subsample rows measured, with the new_resources and
+            person_weight columns computed in app.simulate()
+        estimates: dict of the preview's relative changes in "poverty_rate",
+            "poverty_gap" and "gini", "winners", the percent of people better
+            off, and "change_pp", the average change in resources per person
+        baseline: dict of the exact baseline "poverty_rate", "poverty_gap"
+            and "gini" the relative changes are from
+
+    Returns:
+        dict of (low, high) tuples around each of estimates
+    """
+    reform = _by_group(target_spmu, target_spmu.new_resources.to_numpy())
+    # the estimates are changes from the baseline, see difference_estimates()
+    unchanged = _by_group(target_spmu, target_spmu.spmtotres.to_numpy())
+
+    results = {}
+    for metric, values in reform.items():
+        change = values - unchanged[metric]
+        margin = T_QUANTILE * np.std(change, ddof=1) / math.sqrt(PREVIEW_GROUPS)
+        if metric in baseline:
+            margin /= baseline[metric]
+        results[metric] = (estimates[metric] - margin, estimates[metric] + margin)
+    # from the exact weighted totals in every group, see app.resource_change()
+    results["change_pp"] = (estimates["change_pp"], estimates["change_pp"])
+    return results
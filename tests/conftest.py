@@ -0,0 +1,31 @@
+"""Fixtures of the tests, run from the repo root with `python -m pytest`.
+
+The tests run on the microdata pre-processing.py writes to DATA_DIR, or on
+the current release in DATA_RELEASES, and are skipped when there is none.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    """the app module, with its data loaded"""
+    if data.release_manifest() is None and not os.path.exists(
+        data._path("spmu.csv.gz")
+    ):
+        pytest.skip("no microdata, run pre-processing.py first")
+    import app
+
+    return app
+
+
+@pytest.fixture(scope="session")
+def state(app):
+    """a state of the microdata"""
+    return app.states[1]
@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+
+import cache
+
+
+def test_us_units_are_charged_for_their_own_arrays(app):
+    stage = app.pooled(app.units, "US", "federal", None, False)
+    spmu = app.data.microdata().spmu
+    assert stage["funding_spmu"] is stage["target_spmu"]
+    assert cache.nbytes(stage) < spmu.memory_usage().sum()
+    owned = sum(stage[name].nbytes for name in ["person_rows", "asecwt", "demog_code"])
+    assert owned <= cache.nbytes(stage)
+
+
+def test_nbytes_counts_shared_arrays_once():
+    values = np.zeros(1000)
+    frame = pd.DataFrame({"values": values}, copy=False)
+    shallow = frame.copy(deep=False)
+    assert cache.nbytes([frame, shallow, values[:10]]) == values.nbytes
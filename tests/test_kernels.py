@@ -0,0 +1,72 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+import kernels
+
+N_UNITS = 20_000
+N_DECILES = 10
+N_CODES = 16
+
+
+@pytest.fixture
+def backend(request):
+    """switches the kernels to request.param for one test"""
+    previous = kernels.backend
+    kernels.set_backend(request.param)
+    yield request.param
+    kernels.set_backend(previous)
+
+
+def reduce(seed):
+    """runs every kernel on a random population, returns their results"""
+    rng = np.random.default_rng(seed)
+    numper = rng.integers(1, 6, N_UNITS)
+    spmtotres = rng.uniform(0, 1e5, N_UNITS)
+    new_resources = spmtotres + rng.normal(0, 1e4, N_UNITS)
+    spmthresh = rng.uniform(2e4, 4e4, N_UNITS)
+    spmwt = rng.uniform(100, 2000, N_UNITS)
+    person_rows = np.repeat(np.arange(N_UNITS), numper)
+    asecwt = spmwt[person_rows]
+    totals = kernels.unit_totals(
+        new_resources,
+        spmthresh,
+        spmtotres,
+        spmwt,
+        numper,
+        spmwt * numper,
+        rng.integers(0, N_DECILES, N_UNITS),
+        N_DECILES,
+    )
+    totals.update(
+        kernels.person_totals(
+            new_resources,
+            numper,
+            spmthresh,
+            spmtotres,
+            person_rows,
+            asecwt,
+            rng.integers(0, N_CODES, len(person_rows)),
+            N_CODES,
+        )
+    )
+    totals["gini"] = kernels.gini(totals["resources_per_person"], asecwt)
+    return totals
+
+
+@pytest.mark.parametrize("backend", kernels.BACKENDS, indirect=True)
+def test_kernels_run_from_several_threads(backend):
+    # as in a gunicorn worker, the first call is made from the main thread
+    # (see kernels.py), then the threads serving requests call the kernels at
+    # the same time
+    seeds = list(range(32))
+    kernels.set_backend("numpy")
+    expected = [reduce(seed) for seed in seeds]
+    kernels.set_backend(backend)
+    reduce(0)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(reduce, seeds))
+    for result, totals in zip(results, expected):
+        for name, value in totals.items():
+            np.testing.assert_allclose(result[name], value, rtol=1e-9, err_msg=name)
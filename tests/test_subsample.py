@@ -0,0 +1,43 @@
+import pytest
+
+INCLUDE = ["adults", "children", "non_citizens"]
+
+
+@pytest.mark.parametrize("agi_tax", [0, 15, 40])
+def test_state_preview_is_budget_neutral(app, state, agi_tax):
+    key = app.scenario_key(
+        state, "state", agi_tax, [], ["fedtaxac"], INCLUDE, preview=True
+    )
+    assert app.compute_outcomes(key)["change_pp"] == 0
+    assert app.compute_intervals(key)["change_pp"] == (0, 0)
+
+
+def test_federal_preview_change_pp_is_exact(app, state):
+    key = app.scenario_key(state, "federal", 15, [], ["fedtaxac"], INCLUDE)
+    exact = app.compute_outcomes(key)["change_pp"]
+    preview = app.compute_outcomes(key._replace(preview=True))["change_pp"]
+    assert preview == pytest.approx(exact)
+
+
+@pytest.mark.parametrize(
+    "include, agi_tax", [(["children"], 10), (["adults"], 40), (INCLUDE, 60)]
+)
+def test_preview_winners_are_within_their_interval(app, include, agi_tax):
+    key = app.scenario_key("US", "federal", agi_tax, [], [], include)
+    exact = app.compute_outcomes(key)["percent_winners"]
+    preview = key._replace(preview=True)
+    low, high = app.compute_intervals(preview)["winners"]
+    estimate = app.compute_outcomes(preview)["percent_winners"]
+    assert low < estimate < high
+    assert low <= exact <= high
+
+
+@pytest.mark.parametrize("state_index", [0, 1])
+def test_preview_winners_are_a_share_of_the_subsample(app, state_index):
+    state = app.states[state_index]
+    results = app.simulate(state, "federal", 40, [], [], ["adults"], preview=True)
+    share = results["total_winners"] / results["population_by_code"].sum() * 100
+    key = app.scenario_key(state, "federal", 40, [], [], ["adults"], preview=True)
+    assert app.compute_outcomes(key)["percent_winners"] == pytest.approx(
+        share, abs=0.05
+    )
@@ -0,0 +1,168 @@
+"""Pre-computes popular scenarios so visitors after a deploy hit a warm cache.
+
+gunicorn.conf.py calls start() in each worker before it accepts requests.
+start() first computes DEFAULT_SCENARIOS, which between them run every
+stage of app.py, so no request pays for cold code paths. It then
+fills the result cache in a background thread with:
+    - the scenarios listed in the json file named by WARMUP_SCENARIOS, a list
+      of objects with the arguments of app.scenario_key() as keys
+    - the WARMUP_TOP_N (default 20) most requested scenarios in the
+      SCENARIO_LOG file written by the ubi() callback
+`done` is set once both steps have finished, see the /ready route in wsgi.py.
+
+With DATA_RELEASES set, start() also watches for new releases written by
+releases.py: a new release is loaded and warmed up with DEFAULT_SCENARIOS in
+the background, then served to new requests, see watch_releases().
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import app
+import bootstrap
+import chunked
+import data
+import subsample
+
+logger = logging.getLogger(__name__)
+
+# the default view: US, federal, 0% tax, everyone included, nothing repealed
+DEFAULT_INPUTS = dict(
+    state_dropdown="US",
+    level="federal",
+    agi_tax=0,
+    benefits=[],
+    taxes=[],
+    include=["adults", "children", "non_citizens"],
+    uncertainty=[],
+    year="all",
+    intersections=[],
+)
+ALL_BENEFITS = ["ctc", "incssi", "spmsnap", "eitcred", "incunemp", "spmheat"]
+
+DEFAULT_SCENARIOS = [
+    DEFAULT_INPUTS,
+    # federal reform in a single state, repealing everything with exclusions
+    dict(
+        DEFAULT_INPUTS,
+        state_dropdown=app.states[1],
+        agi_tax=10,
+        benefits=ALL_BENEFITS,
+        taxes=["fedtaxac", "fica"],
+        include=["adults"],
+    ),
+    dict(DEFAULT_INPUTS, agi_tax=10, include=["children"]),
+    dict(DEFAULT_INPUTS, agi_tax=10, uncertainty=["show"]),
+    # state-level reforms
+    dict(DEFAULT_INPUTS, level="state", agi_tax=10, taxes=["fedtaxac"]),
+    dict(DEFAULT_INPUTS, state_dropdown=app.states[1], level="state"),
+]
+
+WARMUP_TOP_N = int(os.environ.get("WARMUP_TOP_N", 20))
+# seconds between checks for a new release in DATA_RELEASES
+RELEASE_POLL_SECONDS = float(os.environ.get("RELEASE_POLL_SECONDS", 10))
+
+done = threading.Event()
+
+
+def configured_scenarios():
+    """returns the scenarios listed in the WARMUP_SCENARIOS json file"""
+    path = os.environ.get("WARMUP_SCENARIOS")
+    if not path:
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def popular_scenarios(n=WARMUP_TOP_N):
+    """returns the n most requested scenarios found in SCENARIO_LOG"""
+    path = os.environ.get("SCENARIO_LOG")
+    if not n or not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        counts = collections.Counter(line.strip() for line in f if line.strip())
+    return [json.loads(line) for line, _ in counts.most_common(n)]
+
+
+def warm(scenarios):
+    """computes the outputs of each scenario, filling the result cache
+
+    Args:
+        scenarios: list of dicts of app.scenario_key() arguments, or lists
+            of them in order (the format of the scenario log)
+    """
+    for scenario in scenarios:
+        if isinstance(scenario, dict):
+            key = app.scenario_key(**scenario)
+        else:
+            key = app.scenario_key(*scenario)
+        try:
+            # on one version of the data, even if it is switched meanwhile
+            with data.pinned():
+                app.cached_outputs(key)
+        except Exception:
+            # e.g. a logged state that is missing from refreshed data
+            logger.warning("could not warm up scenario %s", key, exc_info=True)
+
+
+def load_data():
+    """reads the data every request needs, and derives the arrays computed
+    once per version of the data"""
+    if chunked.CHUNKED_DATA_DIR:
+        # the partitions are memory-mapped, so workers share the page cache
+        chunked.partitions()
+        return
+    data.microdata()
+    data.weighted_totals()
+    data.eligible_counts()
+    # bootstrap resampling counts
+    bootstrap.replicate_counts()
+    data.unit_person_weights()
+    # the subsample of previews while the tax rate slider is dragged
+    subsample.microdata()
+
+
+def switch_release(version):
+    """loads and warms up a release of DATA_RELEASES, then serves it"""
+    dataset = data.release(version)
+    with data.pinned(dataset):
+        load_data()
+        warm(DEFAULT_SCENARIOS)
+    app.use_dataset(dataset)
+    logger.info("switched to data release %s", version)
+
+
+def watch_releases():
+    """switches to the release named by the CURRENT file of DATA_RELEASES
+    whenever it changes, checking every RELEASE_POLL_SECONDS"""
+    failed = None
+    while True:
+        time.sleep(RELEASE_POLL_SECONDS)
+        version = None
+        try:
+            version = data.current_release()
+            if version not in [data.current().version, failed]:
+                switch_release(version)
+        except Exception:
+            # keep serving the current release, and retry once CURRENT names
+            # another one
+            logger.exception("could not switch to data release")
+            failed = version
+
+
+def _warm_in_background():
+    try:
+        warm(configured_scenarios() + popular_scenarios())
+    finally:
+        done.set()
+
+
+def start():
+    """warms the hot code paths now and the popular scenarios in the background"""
+    warm(DEFAULT_SCENARIOS)
+    threading.Thread(target=_warm_in_background, daemon=True).start()
+    if data.DATA_RELEASES:
+        threading.Thread(target=watch_releases, daemon=True).start()
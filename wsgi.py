@@ -0,0 +1,75 @@
+"""Production entry point, run with ``gunicorn wsgi:server``.
+
+gunicorn.conf.py sets preload_app, so this module is imported once in the
+gunicorn master. The microdata is parsed here, before the workers are forked,
+and every worker then shares the same arrays copy-on-write. With
+DATA_RELEASES set it is memory-mapped from the current release instead, and
+each worker switches to newer releases on its own, see releases.py. The
+page's layout, with the results of the default inputs embedded, is rendered
+here too, see app.prerender().
+"""
+import gc
+import logging
+import os
+
+import flask
+
+import kernels
+import warmup
+from app import app, prerender, server, scenario_log  # noqa: F401
+
+# no numba kernel runs before the fork, the workers switch to KERNEL_BACKEND
+# in gunicorn.conf.py (see kernels.py)
+kernels.set_backend("numpy")
+# the microdata and the arrays derived from it, shared by every worker
+warmup.load_data()
+# the layout with the results of the default inputs, so no worker computes
+# them on its first page load
+prerender()
+
+# append every requested scenario to SCENARIO_LOG, so the next deploy can
+# warm up the most popular ones (see warmup.py)
+if os.environ.get("SCENARIO_LOG"):
+    handler = logging.FileHandler(os.environ["SCENARIO_LOG"])
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    scenario_log.addHandler(handler)
+    scenario_log.setLevel(logging.INFO)
+    scenario_log.propagate = False
+
+
+@server.route(app.config.routes_pathname_prefix + "ready")
+def ready():
+    """readiness check: 200 once this worker has finished warming up"""
+    if warmup.done.is_set():
+        return "ready"
+    return "warming up", 503
+
+
+@server.route(app.config.routes_pathname_prefix + "_profiles")
+def profiles():
+    """lists the profile captures, see profiling.py"""
+    import profiling
+
+    if not profiling.authorized():
+        flask.abort(404)
+    return flask.jsonify(profiling.captures())
+
+
+@server.route(app.config.routes_pathname_prefix + "_profiles/<name>/<filename>")
+def profile_file(name, filename):
+    """downloads a file of a profile capture, see profiling.py"""
+    import profiling
+
+    if not profiling.authorized() or filename not in profiling.CAPTURE_FILES:
+        flask.abort(404)
+    return flask.send_from_directory(
+        os.path.abspath(profiling.PROFILE_DIR),
+        os.path.join(name, filename),
+        as_attachment=True,
+    )
+
+
+# move everything loaded so far out of the garbage collector's generations,
+# otherwise the first collection in each worker touches (and so copies) the
+# pages holding these objects
+gc.freeze()
@@ -0,0 +1,101 @@
+"""Results of a reform in each survey year, side by side.
+
+Each year funds its own UBI from its own revenue. Every statistic is computed
+for all years at once, with np.bincount and metrics.grouped_gini over the
+year of each SPM unit, rather than rerunning the simulation per year.
+"""
+import dash_bootstrap_components as dbc
+import numpy as np
+import pandas as pd
+
+import data
+from metrics import grouped_gini
+
+
+def year_results(funding_spmu, target_spmu, state):
+    """returns the main results of a reform in each survey year
+
+    Args:
+        funding_spmu: spmu rows whose revenue funds the UBI, with the
+            new_resources, total_ubi and numper_ubi columns computed in
+            compute_outputs()
+        target_spmu: the rows of funding_spmu the results are measured for
+        state: state selected in the dropdown, or "US"
+
+    Returns:
+        dataframe indexed by year with columns monthly_ubi and the relative
+        changes poverty_rate_change, poverty_gap_change, gini_change, and
+        percent_winners
+    """
+    # weights of the pooled data, scaled up to annual totals
+    scale = data.pooled_years()
+    year_codes, years = pd.factorize(funding_spmu.year, sort=True)
+    n_years = len(years)
+
+    # revenue per unit is what the repeals and new taxes took from it
+    spmwt = funding_spmu.spmwt.to_numpy() * scale
+    numper_ubi = funding_spmu.numper_ubi.to_numpy()
+    spmtotres = funding_spmu.spmtotres.to_numpy()
+    pre_ubi_resources = (funding_spmu.new_resources - funding_spmu.total_ubi).to_numpy()
+    revenue = np.bincount(year_codes, spmwt * (spmtotres - pre_ubi_resources), n_years)
+    ubi_population = np.bincount(year_codes, spmwt * numper_ubi, n_years)
+    ubi_annual = revenue / ubi_population
+    new_resources = pre_ubi_resources + ubi_annual[year_codes] * numper_ubi
+
+    # measure outcomes of the target population only
+    target = funding_spmu.index.isin(target_spmu.index)
+    codes = year_codes[target]
+    new_resources = new_resources[target]
+    spmtotres = spmtotres[target]
+    spmwt = spmwt[target]
+    thresh = funding_spmu.spmthresh.to_numpy()[target]
+    numper = funding_spmu.numper.to_numpy()[target]
+    person_w = data.unit_person_weights()[funding_spmu.index[target]] * scale
+
+    population = np.bincount(codes, person_w, n_years)
+    poor = np.bincount(codes, person_w * (new_resources < thresh), n_years)
+    poverty_gap = np.bincount(
+        codes, spmwt * np.maximum(thresh - new_resources, 0), n_years
+    )
+    gini = grouped_gini(new_resources / numper, person_w, codes, n_years)
+    winners = np.bincount(codes, person_w * (new_resources > spmtotres), n_years)
+
+    # baseline statistics of each year, pre-computed by pre-processing.py
+    all_state_stats, demog_stats = data.year_stats()
+    baseline = all_state_stats[all_state_stats.index == state]
+    baseline = baseline.set_index("year").reindex(years)
+    original_poverty_rate = (
+        demog_stats[
+            (demog_stats.state == state)
+            & (demog_stats.demog == "person")
+            & (demog_stats.metric == "pov_rate")
+        ]
+        .set_index("year")
+        .value.reindex(years)
+    )
+
+    return pd.DataFrame(
+        {
+            "monthly_ubi": ubi_annual / 12,
+            "poverty_rate_change": poor / population / original_poverty_rate - 1,
+            "poverty_gap_change": poverty_gap / baseline.poverty_gap - 1,
+            "gini_change": gini / baseline.gini - 1,
+            "percent_winners": winners / population * 100,
+        },
+        index=years,
+    )
+
+
+def year_table(results):
+    """returns year_results() formatted as a table for the summary card"""
+    table = pd.DataFrame(
+        {
+            "Year": results.index.astype(str),
+            "Monthly UBI": results.monthly_ubi.map("${:,.0f}".format),
+            "Poverty rate": results.poverty_rate_change.map("{:+.1%}".format),
+            "Poverty gap": results.poverty_gap_change.map("{:+.1%}".format),
+            "Gini index": results.gini_change.map("{:+.1%}".format),
+            "Better off": results.percent_winners.map("{:.1f}%".format),
+        }
+    )
+    return dbc.Table.from_dataframe(table, bordered=False, hover=True, size="sm")